@@ -0,0 +1,78 @@
+import io
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+from prediction_funcs import Predictions  # noqa: E402
+from step2_DatasetLoading import DataLoadingProcessing  # noqa: E402
+
+
+class FigureFrameBenchmark:
+    """Checks that the model inputs drawn from the measured figure layout are those of the matplotlib figure, and times both."""
+
+    def __init__(self, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.dlp = DataLoadingProcessing()
+
+    def spectrograms(self, count):
+        """Flat, random and audio-like (STFT of noise bursts) normalized spectrograms."""
+
+        spectrograms = [np.zeros((513, 513), dtype=np.uint8), np.full((513, 513), 255, dtype=np.uint8)]
+        spectrograms += [self.rng.integers(0, 256, (513, 513), dtype=np.uint8) for _ in range(count)]
+
+        waveforms = self.rng.standard_normal((count, 10880 * 20)) * np.repeat(self.rng.random((count, 40)) < 0.5, 10880 // 2, axis=1)
+        magnitude_db = 20 * torch.log10(torch.stft(torch.as_tensor(waveforms, dtype=torch.float32), n_fft=1022, hop_length=512,
+                                                   window=torch.hann_window(1022), return_complex=True).abs() + 1e-6)
+        db_min, db_max = magnitude_db.amin(dim=(1, 2), keepdim=True), magnitude_db.amax(dim=(1, 2), keepdim=True)
+        spectrograms += list(((magnitude_db - db_min) / (db_max - db_min) * 255).to(torch.uint8).numpy())
+        return spectrograms
+
+    def matplotlib_input(self, spectrogram, image_size):
+        """Model input as 'UNetDataset' reads it from a PNG rendered by step2."""
+        from PIL import Image
+
+        if spectrogram.shape != (513, 513):
+            spectrogram = self.dlp.resample_spectrogram_db(spectrogram, target_shape=(513, 513))
+        image = Image.open(io.BytesIO(self.dlp.render_spectrogram_png(spectrogram, show_axis=True))).convert('L')
+        image = image.resize((image_size[1], image_size[0]))
+        return torch.from_numpy(np.asarray(image, dtype=np.float32) / 255)
+
+    def run(self, count, image_sizes):
+        spectrograms = self.spectrograms(count)
+        # Loading the layout is not part of the per image cost
+        Predictions().spectrogram_image_tensor(torch.from_numpy(spectrograms[0]).unsqueeze(0))
+
+        print(f"{'image size':>12} {'spectrograms':>13} {'identical':>10} {'ms / image (frame)':>19} {'ms / image (matplotlib)':>24}")
+        for image_size in image_sizes:
+            frame_seconds = matplotlib_seconds = 0.0
+            identical = 0
+            for spectrogram in spectrograms:
+                started = time.perf_counter()
+                drawn = Predictions().spectrogram_image_tensor(torch.from_numpy(spectrogram).unsqueeze(0), image_size=image_size)[0, 0]
+                frame_seconds += time.perf_counter() - started
+
+                started = time.perf_counter()
+                rendered = self.matplotlib_input(spectrogram, image_size)
+                matplotlib_seconds += time.perf_counter() - started
+
+                identical += torch.equal(drawn, rendered)
+
+            print(f"{'x'.join(map(str, image_size)):>12} {len(spectrograms):>13} {identical:>10} "
+                  f"{frame_seconds / len(spectrograms) * 1e3:>19.1f} {matplotlib_seconds / len(spectrograms) * 1e3:>24.1f}")
+            assert identical == len(spectrograms), 'The figure layout is out of date, measure it again with src/figure_frame.py'
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Checks the matplotlib-free model input against the training figure and times both.')
+    parser.add_argument('--count', type=int, default=8, help='Random and audio-like spectrograms to check (of each kind)')
+    parser.add_argument('--image-sizes', type=int, nargs='+', default=[512, 256], help='Model input sizes to check (square)')
+    args = parser.parse_args()
+
+    FigureFrameBenchmark().run(args.count, [(size, size) for size in args.image_sizes])
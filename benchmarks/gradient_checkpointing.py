@@ -0,0 +1,141 @@
+import os
+import sys
+import time
+import json
+import argparse
+import resource
+import multiprocessing
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+# Checkpointing modes measured by default ('none' stores every activation, the original training)
+MODES = ['none', 'decoders', 'encoders', 'all']
+
+
+def training_worker(mode, batch_size, image_size, architecture, steps, num_threads, results):
+    """Runs training steps of one configuration in a fresh process and reports its memory and step time.
+
+    The peak is the high-water mark of the process RSS (the CUDA allocator peak on a GPU) above
+    the memory held once the model, the optimizer and the batch exist, i.e. what the forward
+    and backward passes add.
+    """
+    import numpy as np
+    import torch
+    from memory_instrumentation import resident_set_size
+    from step4_ModelTraining import UNET, EnergyBasedLossFunction
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    model = UNET.from_architecture(architecture).to(device)
+    model.enable_gradient_checkpointing(None if mode == 'none' else mode)
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3)
+    loss_fn = EnergyBasedLossFunction()
+
+    X = torch.rand(batch_size, 1, *image_size, device=device)
+    y = torch.rand(batch_size, 5, *image_size, device=device)
+
+    baseline = torch.cuda.memory_allocated() if device == 'cuda' else resident_set_size()
+
+    timings = list()
+    try:
+        # The first step is a warm-up (allocator, optimizer state)
+        for _ in range(steps + 1):
+            started = time.perf_counter()
+            loss = loss_fn(model(X), y)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            if device == 'cuda':
+                torch.cuda.synchronize()
+            timings.append(time.perf_counter() - started)
+    except (RuntimeError, MemoryError) as e:
+        # Out of memory on the device for this batch size
+        results.put({'mode': mode, 'batch_size': batch_size, 'error': str(e).splitlines()[0]})
+        return
+
+    if device == 'cuda':
+        peak = torch.cuda.max_memory_allocated()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    step_seconds = float(np.median(timings[1:]))
+    results.put({'mode': mode, 'batch_size': batch_size, 'peak_bytes': peak - baseline,
+                 'step_seconds': step_seconds, 'samples_per_second': batch_size / step_seconds})
+
+
+class GradientCheckpointingBenchmark:
+    """Peak training memory vs step time of the UNET for checkpointing modes and batch sizes.
+
+    Every (mode, batch size) pair runs in its own spawned process, so that the peak RSS of one
+    configuration is not hidden by the high-water mark of a previous one.
+    """
+
+    def __init__(self, image_size=(512, 512), architecture=None, steps=3, num_threads=None):
+        self.image_size = image_size
+        self.architecture = architecture
+        self.steps = steps
+        self.num_threads = num_threads
+
+    def run_configuration(self, mode, batch_size):
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        worker = context.Process(target=training_worker, args=(mode, batch_size, self.image_size, self.architecture,
+                                                                self.steps, self.num_threads, results))
+        worker.start()
+        worker.join()
+
+        if worker.exitcode != 0:
+            # Killed, typically by the OOM killer
+            return {'mode': mode, 'batch_size': batch_size, 'error': f'exit code {worker.exitcode}'}
+        return results.get()
+
+    def run(self, modes=MODES, batch_sizes=(1, 2, 4, 8)):
+        print(f"UNET {self.architecture or 'default'} at {self.image_size[0]} x {self.image_size[1]}, "
+              f"median of {self.steps} training steps\n")
+        print(f"{'mode':>10} {'batch':>6} {'peak (MB)':>10} {'step (s)':>9} {'samples/s':>10} {'memory':>7} {'time':>6}")
+
+        results = list()
+        for batch_size in batch_sizes:
+            reference = None
+            for mode in modes:
+                result = self.run_configuration(mode, batch_size)
+                results.append(result)
+
+                if 'error' in result:
+                    print(f"{mode:>10} {batch_size:>6} failed: {result['error']}")
+                    continue
+
+                # Memory and step time relative to the first mode of the batch size
+                reference = reference or result
+                print(f"{mode:>10} {batch_size:>6} {result['peak_bytes'] / 2**20:>10.0f} {result['step_seconds']:>9.2f} "
+                      f"{result['samples_per_second']:>10.2f} {result['peak_bytes'] / reference['peak_bytes']:>7.2f} "
+                      f"{result['step_seconds'] / reference['step_seconds']:>6.2f}")
+
+        return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measures the peak training memory and step time of the UNET with gradient checkpointing.')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 2, 4, 8], help='Training batch sizes to measure')
+    parser.add_argument('--modes', nargs='+', default=MODES, help=f"Checkpointing modes among {', '.join(MODES)}")
+    parser.add_argument('--image-size', type=int, default=512, help='Side of the square model input')
+    parser.add_argument('--base-width', type=int, default=32)
+    parser.add_argument('--depth', type=int, default=5)
+    parser.add_argument('--steps', type=int, default=3, help='Measured training steps (after one warm-up step)')
+    parser.add_argument('--threads', type=int, default=None, help='Torch threads per process (all cores by default)')
+    parser.add_argument('--report', default=None, help='JSON file to write the measurements to')
+    args = parser.parse_args()
+
+    benchmark = GradientCheckpointingBenchmark((args.image_size, args.image_size), {'Base_Width': args.base_width, 'Depth': args.depth},
+                                               steps=args.steps, num_threads=args.threads)
+    results = benchmark.run(args.modes, args.batch_sizes)
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(results, report_file, indent=4)
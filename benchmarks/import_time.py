@@ -0,0 +1,87 @@
+import os
+import sys
+import argparse
+import subprocess
+
+# Modules of 'src' whose cold import cost matters: the web app, the serving code and the pipeline entry points
+MODULES = [
+    'app',
+    'step3_calculate_similarity_scores',
+    'prediction_funcs',
+    'step1_creating_csv',
+    'step2_DatasetLoading',
+    'step4_ModelTraining',
+    'catalog_ingestion',
+]
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+class ImportTimeReport:
+
+    def __init__(self, python=sys.executable):
+        self.python = python
+
+    def measure(self, module):
+        """Imports 'module' in a fresh interpreter with '-X importtime' and parses the report.
+
+        Parameters
+        -----------
+
+        module: Name of the module to import (looked up in the 'src' folder)
+
+        Returns
+        --------
+        List of (cumulative_us, self_us, depth, imported_module) tuples, one per imported module,
+        or None if the import failed
+        """
+
+        completed = subprocess.run([self.python, '-X', 'importtime', '-c', f'import {module}'],
+                                   cwd=SRC_FOLDER, capture_output=True, text=True)
+
+        if completed.returncode != 0:
+            print(f"Could not import '{module}': {completed.stderr.strip().splitlines()[-1]}")
+            return None
+
+        entries = list()
+        for line in completed.stderr.splitlines():
+            # Lines look like 'import time:       412 |       1250 |   package.module'
+            if not line.startswith('import time:') or 'self [us]' in line:
+                continue
+
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            # Nested imports are indented by two spaces per level
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            entries.append((int(cumulative_us), int(self_us), depth, name.strip()))
+
+        return entries
+
+    def report(self, modules=MODULES, top=10):
+        """Prints the total import time of every module followed by its most expensive imports."""
+
+        for module in modules:
+            entries = self.measure(module)
+            if entries is None:
+                continue
+
+            # The module itself is the last (outermost) entry of the report, the entries before
+            # it back to the previous outermost entry (interpreter startup) are its imports
+            start = max([index for index, entry in enumerate(entries[:-1]) if entry[2] == 0], default=-1) + 1
+            module_entries = entries[start:]
+            total_us = module_entries[-1][0]
+            print(f"\n{module}: {total_us / 1e3:.1f} ms, {len(module_entries) - 1} modules imported")
+
+            # Direct imports of the module, most expensive first
+            direct_imports = [entry for entry in module_entries if entry[2] == 1]
+            for cumulative_us, _, _, name in sorted(direct_imports, reverse=True)[:top]:
+                print(f"    {cumulative_us / 1e3:9.1f} ms  {name}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Reports the cold import time of the app and pipeline modules.')
+    parser.add_argument('modules', nargs='*', default=MODULES, help='Modules of src to measure')
+    parser.add_argument('--top', type=int, default=10, help='Number of most expensive imports to list')
+    args = parser.parse_args()
+
+    ImportTimeReport().report(args.modules, top=args.top)
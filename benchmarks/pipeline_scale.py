@@ -0,0 +1,122 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+import yaml
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+PARAMS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'params.yaml')
+sys.path.insert(0, SRC_FOLDER)
+
+from pipeline_runner import STAGES  # noqa: E402
+
+
+class PipelineScaleBenchmark:
+    """Runs the whole pipeline on a synthetic Slakh2100-shaped dataset and measures every stage.
+
+    Every stage (the dataset generation included) runs in its own process, so that its wall
+    time, peak RSS (from the rusage of that process and its children) and the bytes it adds to
+    the working folder are measured separately.
+    """
+
+    def __init__(self, work_folder, num_tracks=100, duration=(60, 240), stems=(4, 10), epochs=1, num_workers=None):
+        self.work_folder = work_folder
+        self.num_tracks = num_tracks
+        self.duration = duration
+        self.stems = stems
+        self.epochs = epochs
+        self.num_workers = num_workers or os.cpu_count()
+
+    def write_params(self):
+        """params.yaml of the working folder: the repository parameters with the benchmark settings."""
+
+        with open(PARAMS_FILE, 'r') as params_file:
+            params = yaml.safe_load(params_file)
+
+        params['Training']['Epochs'] = self.epochs
+        with open(os.path.join(self.work_folder, 'params.yaml'), 'w') as params_file:
+            yaml.safe_dump(params, params_file, sort_keys=False)
+
+    def folder_bytes(self):
+        total = 0
+        for root, _, file_names in os.walk(self.work_folder):
+            total += sum(os.path.getsize(os.path.join(root, file_name)) for file_name in file_names)
+        return total
+
+    def run_process(self, name, command):
+        """Runs one stage and returns its measurements."""
+
+        bytes_before = self.folder_bytes()
+        started = time.perf_counter()
+
+        process = subprocess.Popen(command, cwd=self.work_folder, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        output = process.stdout.read()
+        # wait4 gives the resource usage of this process (and the children it waited for) only
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+
+        wall_seconds = time.perf_counter() - started
+        units = re.search(rf'^{name}: (\d+) unit', output, re.MULTILINE)
+
+        return {'stage': name, 'exit_code': process.returncode, 'wall_seconds': wall_seconds,
+                'units': int(units.group(1)) if units else None,
+                'peak_rss_bytes': rusage.ru_maxrss * 1024, 'bytes_written': self.folder_bytes() - bytes_before,
+                'output': output}
+
+    def run(self, stages=STAGES):
+        os.makedirs(self.work_folder, exist_ok=True)
+        self.write_params()
+
+        commands = [('generate', [sys.executable, os.path.join(SRC_FOLDER, 'synthetic_dataset.py'), '--tracks', str(self.num_tracks),
+                                  '--duration', *map(str, self.duration), '--stems', *map(str, self.stems),
+                                  '--workers', str(self.num_workers)])]
+        commands += [(stage, [sys.executable, os.path.join(SRC_FOLDER, 'pipeline_runner.py'), stage, '--force'])
+                     for stage in STAGES if stage in stages]
+
+        results = list()
+        print(f"{self.num_tracks} synthetic tracks of {self.duration[0]:g}-{self.duration[1]:g} s in {self.work_folder}\n")
+        print(f"{'stage':>12} {'wall (s)':>9} {'units':>6} {'tracks/s':>9} {'peak RSS (MB)':>14} {'written (MB)':>13}")
+
+        for name, command in commands:
+            result = self.run_process(name, command)
+            results.append(result)
+
+            # Throughput over the tracks of the dataset: units are tracks for the per-track stages
+            # but splits for metadata, catalog and training
+            throughput = self.num_tracks / result['wall_seconds']
+            units = f"{result['units']:>6}" if result['units'] is not None else f"{'-':>6}"
+            print(f"{name:>12} {result['wall_seconds']:>9.1f} {units} {throughput:>9.2f} "
+                  f"{result['peak_rss_bytes'] / 2**20:>14.0f} {result['bytes_written'] / 2**20:>13.1f}")
+
+            if result['exit_code'] != 0:
+                print(f"\n'{name}' failed with exit code {result['exit_code']}, stopping:\n{result['output'][-2000:]}")
+                break
+
+        return results
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measures every pipeline stage on a synthetic Slakh2100-shaped dataset.')
+    parser.add_argument('--tracks', type=int, default=100, help='Number of synthetic tracks over all the splits')
+    parser.add_argument('--duration', type=float, nargs=2, default=[60, 240], metavar=('MIN', 'MAX'), help='Track duration in seconds')
+    parser.add_argument('--stems', type=int, nargs=2, default=[4, 10], metavar=('MIN', 'MAX'), help='Stems per track')
+    parser.add_argument('--epochs', type=int, default=1, help='Training epochs')
+    parser.add_argument('--workers', type=int, default=None, help='Processes generating the dataset (all cores by default)')
+    parser.add_argument('--work-folder', default=None, help='Folder to run in, kept afterwards (a temporary folder by default)')
+    parser.add_argument('--report', default=None, help='JSON file to write the measurements to')
+    parser.add_argument('stages', nargs='*', help=f"Stages to run after the generation, among {', '.join(STAGES)} (default: all)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temporary_folder:
+        benchmark = PipelineScaleBenchmark(args.work_folder or temporary_folder, args.tracks, tuple(args.duration),
+                                           tuple(args.stems), args.epochs, args.workers)
+        results = benchmark.run(args.stages or STAGES)
+
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump([{key: value for key, value in result.items() if key != 'output'} for result in results], report_file, indent=4)
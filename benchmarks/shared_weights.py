@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+
+def load_worker(mode, checkpoint_path, weights_path, run_forward, barrier, results):
+    """Loads the model in one of the two modes, runs a forward pass and reports its memory.
+
+    All the workers are alive when the memory is read (barrier), as they would be when serving.
+    """
+    import torch
+    from shared_weights import resident_memory
+    from step4_ModelTraining import UNET
+
+    torch.set_num_threads(1)
+    rss_before, pss_before = resident_memory()
+
+    started = time.perf_counter()
+    if mode == 'checkpoint':
+        model = UNET.from_checkpoint(checkpoint_path).eval()
+    else:
+        model = UNET.from_shared_weights(weights_path)
+    load_seconds = time.perf_counter() - started
+
+    if run_forward:
+        with torch.no_grad():
+            model(torch.rand(1, 1, 512, 512))
+
+    barrier.wait()
+    rss, pss = resident_memory()
+    results.put((load_seconds, rss - rss_before, pss - pss_before))
+    barrier.wait()
+
+
+class SharedWeightsBenchmark:
+    """Load time and per-worker memory of the UNET weights, private copies (torch.load) vs the shared blob."""
+
+    def __init__(self, num_workers=4, run_forward=True):
+        self.num_workers = num_workers
+        self.run_forward = run_forward
+
+    def run_mode(self, mode, checkpoint_path, weights_path):
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(self.num_workers)
+        results = context.Queue()
+
+        workers = [context.Process(target=load_worker, args=(mode, checkpoint_path, weights_path, self.run_forward, barrier, results))
+                   for _ in range(self.num_workers)]
+        for worker in workers:
+            worker.start()
+        measurements = [results.get() for _ in workers]
+        for worker in workers:
+            worker.join()
+
+        return measurements
+
+    def run(self, checkpoint_path=None):
+        import torch
+        from shared_weights import export_checkpoint
+        from step4_ModelTraining import UNET
+
+        with tempfile.TemporaryDirectory() as folder:
+            # Randomly initialized default model if no trained checkpoint is given
+            if checkpoint_path is None:
+                checkpoint_path = os.path.join(folder, 'model_weights.pth')
+                torch.save(UNET(1, 5).state_dict(), checkpoint_path)
+
+            weights_path = os.path.join(folder, 'model_weights.npy')
+            export_checkpoint(checkpoint_path, weights_path)
+
+            print(f"{self.num_workers} workers, weights of {os.path.getsize(weights_path) / 2**20:.1f} MB"
+                  + (", one forward pass each" if self.run_forward else "") + "\n")
+            print(f"{'mode':>12} {'load (ms)':>10} {'RSS/worker (MB)':>16} {'PSS/worker (MB)':>16}")
+            for mode in ('checkpoint', 'shared'):
+                measurements = self.run_mode(mode, checkpoint_path, weights_path)
+                load_ms = sorted(seconds for seconds, _, _ in measurements)[len(measurements) // 2] * 1e3
+                rss = sum(rss for _, rss, _ in measurements) / len(measurements) / 2**20
+                pss = sum(pss for _, _, pss in measurements) / len(measurements) / 2**20
+                print(f"{mode:>12} {load_ms:>10.1f} {rss:>16.1f} {pss:>16.1f}")
+
+        print("\nRSS counts the shared weight pages in every worker; PSS divides them between the workers mapping them.")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compares private and shared (memory-mapped) loading of the model weights.')
+    parser.add_argument('--checkpoint', default=None, help='Trained checkpoint (a random default model if not given)')
+    parser.add_argument('--workers', type=int, default=4, help='Number of worker processes loading the model')
+    parser.add_argument('--no-forward', action='store_true', help='Measure right after loading, without a forward pass')
+    args = parser.parse_args()
+
+    SharedWeightsBenchmark(args.workers, run_forward=not args.no_forward).run(args.checkpoint)
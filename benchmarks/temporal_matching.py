@@ -0,0 +1,78 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+from temporal_embeddings import TemporalEmbedding  # noqa: E402
+
+
+class TemporalMatchingBenchmark:
+    """Query latency of the FFT envelope matching on synthetic catalogs of increasing size."""
+
+    def __init__(self, num_instruments=5, num_frames=360, seed=0):
+        self.num_instruments = num_instruments
+        self.num_frames = num_frames
+        self.rng = np.random.default_rng(seed)
+        self.temporal_embedding = TemporalEmbedding()
+
+    def random_envelopes(self, num_tracks):
+        # Sparse, bursty activity: every instrument plays during a few random sections
+        activity = self.rng.random((num_tracks, self.num_instruments, self.num_frames // 20)) < 0.5
+        envelopes = np.repeat(activity, 20, axis=-1) * self.rng.random((num_tracks, self.num_instruments, self.num_frames))
+        return envelopes.astype(np.float16)
+
+    def check(self, db_envelopes, query, mask, rows=20):
+        """Compares the FFT similarities with a direct cross-correlation on a few catalog rows."""
+
+        max_shift = self.temporal_embedding.max_shift(self.num_frames)
+        fast = self.temporal_embedding.similarity(query, db_envelopes[:rows], mask)
+        assert np.allclose(fast, self.temporal_embedding.similarity(query, db_envelopes[:rows], mask,
+                                                                    catalog_spectra=self.temporal_embedding.catalog_spectra(db_envelopes[:rows])))
+
+        query = query.astype(np.float64)[mask]
+        for row, score in zip(db_envelopes[:rows].astype(np.float64)[:, mask], fast):
+            correlation = sum(np.correlate(row[i], query[i], mode='full') for i in range(len(query)))
+            center = self.num_frames - 1
+            direct = correlation[center - max_shift:center + max_shift + 1].max() / (np.linalg.norm(query) * np.linalg.norm(row))
+            assert abs(direct - score) < 1e-3, (direct, score)
+
+    def run(self, catalog_sizes, repeats=5):
+        mask = np.array([True, True, False, True, True])
+        query = self.random_envelopes(1)[0]
+
+        print(f"{'tracks':>10} {'catalog MB':>11} {'spectra MB':>11} {'ms / query':>11} {'ms / query (cold)':>18}")
+        for num_tracks in catalog_sizes:
+            db_envelopes = self.random_envelopes(num_tracks)
+            self.check(db_envelopes, query, mask)
+
+            # Serving: the catalog spectra are computed once when the catalog is loaded
+            catalog_spectra = self.temporal_embedding.catalog_spectra(db_envelopes)
+            warm = self.median_latency(lambda: self.temporal_embedding.similarity(query, db_envelopes, mask, catalog_spectra=catalog_spectra), repeats)
+            # Cold: the catalog is transformed block by block during the query
+            cold = self.median_latency(lambda: self.temporal_embedding.similarity(query, db_envelopes, mask), repeats)
+
+            print(f"{num_tracks:>10} {db_envelopes.nbytes / 2**20:>11.1f} {catalog_spectra[0].nbytes / 2**20:>11.1f} "
+                  f"{warm * 1e3:>11.1f} {cold * 1e3:>18.1f}")
+
+    def median_latency(self, query, repeats):
+        timings = list()
+        for _ in range(repeats):
+            started = time.perf_counter()
+            query()
+            timings.append(time.perf_counter() - started)
+
+        return float(np.median(timings))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Measures the query latency of the temporal envelope matching.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='Catalog sizes to measure')
+    parser.add_argument('--repeats', type=int, default=5, help='Queries per catalog size (the median is reported)')
+    args = parser.parse_args()
+
+    TemporalMatchingBenchmark().run(args.sizes, repeats=args.repeats)
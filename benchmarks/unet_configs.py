@@ -0,0 +1,118 @@
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+
+SRC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.insert(0, SRC_FOLDER)
+
+from step4_ModelTraining import UNET, UNetDataset, EnergyBasedLossFunction  # noqa: E402
+
+# (base width, depth, block type) of the configurations measured by default, the first one is the original model
+CONFIGS = [
+    (32, 5, 'standard'),
+    (16, 5, 'standard'),
+    (16, 4, 'standard'),
+    (32, 5, 'separable'),
+    (16, 4, 'separable'),
+    (8, 4, 'separable'),
+]
+
+
+class UNetConfigBenchmark:
+    """Parameters, FLOPs, CPU latency and validation loss of UNET configurations at 512 x 512."""
+
+    def __init__(self, image_size=(512, 512), repeats=5, num_threads=None):
+        self.image_size = image_size
+        self.repeats = repeats
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+    def count_flops(self, model):
+        """Multiply-accumulates of one forward pass x 2, counted on the convolutions with forward hooks."""
+
+        flops = list()
+
+        def hook(module, inputs, output):
+            kernel_elements = module.kernel_size[0] * module.kernel_size[1]
+            if isinstance(module, nn.ConvTranspose2d):
+                # Every input element is scattered to kernel_elements outputs for every output channel
+                macs = inputs[0].numel() * kernel_elements * module.out_channels // module.groups
+            else:
+                macs = output.numel() * kernel_elements * module.in_channels // module.groups
+            flops.append(2 * macs)
+
+        handles = [module.register_forward_hook(hook) for module in model.modules() if isinstance(module, (nn.Conv2d, nn.ConvTranspose2d))]
+        with torch.no_grad():
+            model(torch.zeros(1, 1, *self.image_size))
+        for handle in handles:
+            handle.remove()
+
+        return sum(flops)
+
+    def latency(self, model):
+        """Median time of a batch of one on the CPU, after a warm-up pass."""
+
+        model.eval()
+        model_input = torch.rand(1, 1, *self.image_size)
+        timings = list()
+        with torch.no_grad():
+            model(model_input)
+            for _ in range(self.repeats):
+                started = time.perf_counter()
+                model(model_input)
+                timings.append(time.perf_counter() - started)
+
+        return float(np.median(timings))
+
+    def validation_loss(self, model, data_folder):
+        from torchvision import transforms
+
+        dataset = UNetDataset(os.path.join(data_folder, 'Input'), os.path.join(data_folder, 'Output'),
+                              transform=transforms.Compose([transforms.ToTensor()]))
+        loss_fn = EnergyBasedLossFunction()
+
+        model.eval()
+        losses = list()
+        with torch.no_grad():
+            for X, y in torch.utils.data.DataLoader(dataset, batch_size=4):
+                losses.append(loss_fn(model(X), y).item())
+
+        return float(np.mean(losses))
+
+    def run(self, configs=CONFIGS, checkpoints=(), validation_folder=None):
+        """Prints one row per configuration and one per checkpoint (architecture read from the weights).
+
+        The validation loss is only meaningful for trained weights, so it is reported for the
+        checkpoints only.
+        """
+
+        models = [(f'{width}/{depth}/{block_type}', UNET(1, 5, width, depth, block_type), False) for width, depth, block_type in configs]
+        for checkpoint in checkpoints:
+            model = UNET.from_checkpoint(checkpoint)
+            models.append((f'{model.base_width}/{model.depth}/{model.block_type} ({os.path.basename(checkpoint)})', model, True))
+
+        print(f"{'width/depth/block':<40} {'params (M)':>10} {'GFLOPs':>8} {'latency (ms)':>13} {'val loss':>9}")
+        for name, model, trained in models:
+            params = sum(parameter.numel() for parameter in model.parameters())
+            validation = self.validation_loss(model, validation_folder) if trained and validation_folder else None
+
+            print(f"{name:<40} {params / 1e6:>10.2f} {self.count_flops(model) / 1e9:>8.1f} {self.latency(model) * 1e3:>13.0f} "
+                  + (f"{validation:>9.5f}" if validation is not None else f"{'-':>9}"))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compares UNET configurations for CPU serving.')
+    parser.add_argument('--checkpoints', nargs='*', default=[], help='Trained weights to measure as well (e.g. Sweep/trial_*.pth)')
+    parser.add_argument('--validation-folder', default=os.path.join('Final_Dataset', 'validation'),
+                        help='Split used for the validation loss of the checkpoints')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed forward passes per configuration')
+    parser.add_argument('--threads', type=int, default=None, help='Torch CPU threads (all cores by default)')
+    args = parser.parse_args()
+
+    validation_folder = args.validation_folder if os.path.isdir(args.validation_folder) else None
+    UNetConfigBenchmark(repeats=args.repeats, num_threads=args.threads).run(checkpoints=args.checkpoints, validation_folder=validation_folder)
@@ -0,0 +1,282 @@
+import os
+import argparse
+import logging
+import numpy as np
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+
+def kmeans(vectors, num_clusters, num_iterations=10, seed=0, block_size=65536):
+    """Lloyd's k-means in NumPy, with the distances computed block by block.
+
+    Returns
+    --------
+    (centroids, assignments): (num_clusters x dimensions) float32 array and (N,) int array
+    """
+
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+
+    for _ in range(num_iterations):
+        assignments = nearest_centroids(vectors, centroids, block_size)
+
+        counts = np.bincount(assignments, minlength=num_clusters)
+        sums = np.stack([np.bincount(assignments, weights=vectors[:, d], minlength=num_clusters)
+                         for d in range(vectors.shape[1])], axis=1).astype(np.float32)
+
+        # Empty clusters are restarted from random vectors
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, np.newaxis]
+        centroids[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+
+    return centroids, nearest_centroids(vectors, centroids, block_size)
+
+
+def nearest_centroids(vectors, centroids, block_size=65536):
+    """Index of the closest centroid (L2) of every vector."""
+
+    centroid_norms = np.sum(centroids ** 2, axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), block_size):
+        block = vectors[start:start + block_size]
+        # ||x - c||^2 up to the ||x||^2 term, which does not change the argmin
+        assignments[start:start + block_size] = np.argmin(centroid_norms - 2 * block @ centroids.T, axis=1)
+
+    return assignments
+
+
+class IVFPQIndex:
+    """Approximate cosine search over the catalog: inverted lists with product-quantized residuals.
+
+    A coarse k-means quantizer splits the catalog into 'num_lists' lists. Every vector is
+    stored in the list of its closest centroid as the product-quantization code of its residual
+    (vector - centroid): the dimensions are split into 'num_subquantizers' groups and each group
+    is replaced by the index of the closest of 256 codewords, i.e. one byte per group.
+
+    The score of a query restricted to a subset of the instruments (the 'user_preference' of
+    the app) decomposes over the groups, so any subset is served by the same index:
+
+        q_m . x        = q_m . c + sum_s q_m . r_s
+        ||x_m||^2      = ||c_m||^2 + sum_s (2 c_m . r_s + ||(r_s)_m||^2)
+
+    where q_m is the query with the unselected instruments zeroed, c the list centroid and r_s
+    the codeword of group s. The lists are probed in order of masked cosine with their centroid
+    and the best candidates are re-ranked with the exact vectors when these are given.
+    """
+
+    def __init__(self, num_lists=1024, num_subquantizers=None, num_codes=256, num_iterations=10,
+                 training_sample=262144, seed=0):
+        self.num_lists = num_lists
+        self.num_subquantizers = num_subquantizers
+        self.num_codes = num_codes
+        self.num_iterations = num_iterations
+        self.training_sample = training_sample
+        self.seed = seed
+
+        self.centroids = None  # (lists x dimensions)
+        self.codebooks = None  # (subquantizers x codes x dimensions), zero outside the group of each subquantizer
+        self.list_offsets = None  # (lists + 1,) start of every list in 'row_ids' and 'codes'
+        self.row_ids = None  # (N,) catalog row of every stored vector, grouped by list
+        self.codes = None  # (N x subquantizers) uint8
+        self.catalog_version = None  # catalog version the vectors were added from, if known
+
+    @property
+    def dimension_groups(self):
+        dimensions = self.centroids.shape[1]
+        return np.array_split(np.arange(dimensions), self.num_subquantizers or dimensions)
+
+    def train(self, vectors):
+        """Learns the coarse centroids and the residual codebooks on a sample of 'vectors'."""
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.training_sample:
+            vectors = vectors[np.sort(rng.choice(len(vectors), self.training_sample, replace=False))]
+
+        num_lists = min(self.num_lists, len(vectors))
+        self.centroids, assignments = kmeans(vectors, num_lists, self.num_iterations, self.seed)
+        residuals = vectors - self.centroids[assignments]
+
+        groups = self.dimension_groups
+        self.codebooks = np.zeros((len(groups), self.num_codes, vectors.shape[1]), dtype=np.float32)
+        for s, group in enumerate(groups):
+            # Residuals of a low dimensional group can have fewer distinct values than codewords
+            distinct = np.unique(residuals[:, group], axis=0)
+            num_codes = min(self.num_codes, len(distinct))
+            codewords, _ = kmeans(residuals[:, group], num_codes, self.num_iterations, self.seed + s + 1)
+            self.codebooks[s, :num_codes][:, group] = codewords
+            # Unused codewords repeat the first one so that they are never closer than it
+            self.codebooks[s, num_codes:][:, group] = codewords[0]
+
+        return self
+
+    def encode(self, residuals):
+        codes = np.empty((len(residuals), len(self.codebooks)), dtype=np.uint8)
+        for s, group in enumerate(self.dimension_groups):
+            codes[:, s] = nearest_centroids(residuals[:, group], self.codebooks[s][:, group])
+
+        return codes
+
+    def add(self, vectors, block_size=65536, catalog_version=None):
+        """Encodes all the catalog vectors (row i of 'vectors' is catalog row i) of 'catalog_version'."""
+
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        codes = np.empty((len(vectors), len(self.codebooks)), dtype=np.uint8)
+        for start in range(0, len(vectors), block_size):
+            block = np.asarray(vectors[start:start + block_size], dtype=np.float32)
+            assignments[start:start + block_size] = nearest_centroids(block, self.centroids)
+            codes[start:start + block_size] = self.encode(block - self.centroids[assignments[start:start + block_size]])
+
+        # Grouping the vectors by list (stable, so rows stay sorted within a list)
+        order = np.argsort(assignments, kind='stable')
+        self.row_ids = order
+        self.codes = codes[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=len(self.centroids)))])
+        self.catalog_version = catalog_version
+
+        return self
+
+    def matches(self, num_rows, catalog_version=None):
+        """Whether the index was built from a catalog of 'num_rows' rows (and from 'catalog_version', if given).
+
+        The row ids of a stale index point at other tracks, or past the end, of a newer catalog.
+        """
+
+        if len(self.row_ids) != num_rows:
+            return False
+        return catalog_version is None or self.catalog_version == catalog_version
+
+    def search(self, queries, preference_masks, k=10, num_probes=16, rerank=None, vectors=None):
+        """Approximate top k catalog rows of every query by masked cosine similarity.
+
+        Parameters
+        -----------
+
+        queries: (N_queries x dimensions) array
+        preference_masks: (N_queries x dimensions) boolean array of the instruments each query keeps
+        k: Number of results per query
+        num_probes: Number of lists scanned per query
+        rerank: Number of candidates re-scored exactly with 'vectors' (4 x k by default)
+        vectors: Catalog vectors for the exact re-ranking, may be memory-mapped; no re-ranking if None
+
+        Returns
+        --------
+        (rows, scores): (N_queries x k) arrays of catalog rows and similarities, best first
+        (-1 and -inf where fewer than k candidates were found)
+        """
+
+        queries = np.asarray(queries, dtype=np.float32)
+        masks = np.asarray(preference_masks, dtype=np.float32)
+        rerank = max(k, rerank or 4 * k)
+        num_probes = min(num_probes, len(self.centroids))
+
+        rows = np.full((len(queries), k), -1, dtype=np.int64)
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+
+        for index, (query, mask) in enumerate(zip(queries, masks)):
+            masked_query = query * mask
+            query_norm = np.linalg.norm(masked_query)
+            if query_norm == 0:
+                continue
+
+            masked_centroids = self.centroids * mask
+            centroid_dots = masked_centroids @ masked_query
+            centroid_norms = np.sqrt(np.sum(masked_centroids ** 2, axis=1))
+            centroid_scores = np.divide(centroid_dots, centroid_norms * query_norm, out=np.full_like(centroid_dots, -np.inf), where=centroid_norms > 0)
+            probes = np.argpartition(-centroid_scores, num_probes - 1)[:num_probes]
+
+            # Tables of the group terms: dot with the query (same for every list), masked energy
+            # of the codewords, and cross term with each probed centroid
+            dot_table = self.codebooks @ masked_query  # (subquantizers x codes)
+            energy_table = (self.codebooks ** 2) @ mask  # (subquantizers x codes)
+            cross_tables = 2 * np.einsum('pd,scd->psc', masked_centroids[probes], self.codebooks)
+
+            candidate_rows, candidate_scores = list(), list()
+            for probe, cross_table in zip(probes, cross_tables):
+                start, stop = self.list_offsets[probe], self.list_offsets[probe + 1]
+                if start == stop:
+                    continue
+
+                codes = self.codes[start:stop]
+                groups = np.arange(codes.shape[1])
+                dots = centroid_dots[probe] + dot_table[groups, codes].sum(axis=1)
+                energies = centroid_norms[probe] ** 2 + (cross_table + energy_table)[groups, codes].sum(axis=1)
+
+                candidate_rows.append(self.row_ids[start:stop])
+                candidate_scores.append(dots / (query_norm * np.sqrt(np.maximum(energies, 1e-12))))
+
+            if not candidate_rows:
+                continue
+
+            candidate_rows = np.concatenate(candidate_rows)
+            candidate_scores = np.concatenate(candidate_scores)
+
+            if vectors is not None:
+                # Exact masked cosine of the best approximate candidates
+                shortlist = np.argsort(-candidate_scores)[:rerank]
+                candidate_rows = candidate_rows[shortlist]
+                exact = np.asarray(vectors[np.sort(candidate_rows)], dtype=np.float32)[np.argsort(np.argsort(candidate_rows))] * mask
+                exact_norms = np.linalg.norm(exact, axis=1) * query_norm
+                candidate_scores = np.divide(exact @ masked_query, exact_norms, out=np.zeros(len(exact), dtype=np.float32), where=exact_norms > 0)
+
+            best = np.argsort(-candidate_scores, kind='stable')[:k]
+            rows[index, :len(best)] = candidate_rows[best]
+            scores[index, :len(best)] = candidate_scores[best]
+
+        return rows, scores
+
+    def save(self, index_file_path):
+        tmp_path = index_file_path + '.tmp.npz'
+        np.savez(tmp_path, centroids=self.centroids, codebooks=self.codebooks, list_offsets=self.list_offsets,
+                 row_ids=self.row_ids, codes=self.codes, num_subquantizers=len(self.codebooks),
+                 catalog_version=np.array(self.catalog_version or ''))
+        os.replace(tmp_path, index_file_path)
+
+    @classmethod
+    def load(cls, index_file_path):
+        with np.load(index_file_path) as arrays:
+            index = cls(num_lists=len(arrays['centroids']), num_subquantizers=int(arrays['num_subquantizers']),
+                        num_codes=arrays['codebooks'].shape[1])
+            for name in ('centroids', 'codebooks', 'list_offsets', 'row_ids', 'codes'):
+                setattr(index, name, arrays[name])
+            # Indexes saved without it match no published version
+            index.catalog_version = (str(arrays['catalog_version']) or None) if 'catalog_version' in arrays else None
+
+        return index
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Make_Predictions = params['Logs']['Make_Predictions']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Make_Predictions))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    from step3_calculate_similarity_scores import SimScore
+
+    ann_params = params['Catalog']['ANN']
+
+    parser = argparse.ArgumentParser(description='Builds the approximate nearest-neighbour index of the current catalog.')
+    parser.add_argument('--num-lists', type=int, default=ann_params['Num_Lists'], help='Number of inverted lists')
+    args = parser.parse_args()
+
+    catalog = SimScore().catalog(params['Catalog']['Catalog_Folder'])
+    index = IVFPQIndex(num_lists=args.num_lists).train(catalog.vectors).add(catalog.vectors, catalog_version=catalog.version)
+    index.save(ann_params['Index_File'])
+
+    logger.info(f'Index of {len(catalog)} tracks (catalog version {catalog.version}) saved to {ann_params["Index_File"]}.')
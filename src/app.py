@@ -1,16 +1,52 @@
 import streamlit as st
 import os
-import tempfile
+import io
 import logging
 import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from step0_utility_functions import Utility
-from step3_calculate_similarity_scores import SimScore
+
+
+@st.cache_resource
+def background_executor():
+    """Executor shared by all the sessions of the server, embedding uploads in the background."""
+    return ThreadPoolExecutor(max_workers=2)
+
+
+def embed_upload(upload_file, serving_params, submitted_at, model_folder='Models', sample_rate=10880, target_duration=180):
+    """Decodes an upload straight from memory into a model-length buffer and embeds it within the latency budget.
+
+    'upload_file' is a file-like object over the uploaded bytes, read by this thread only, and
+    'submitted_at' the time returned by 'SimScore.register_request' when the upload was queued.
+
+    Returns
+    --------
+    (durations, tier), see 'SimScore.embed_within_budget'
+    """
+    import numpy as np
+    # Imported here so that the page renders before the model stack is loaded
+    from step2_DatasetLoading import DataLoadingProcessing
+    from step3_calculate_similarity_scores import SimScore
+
+    waveform = np.zeros(sample_rate * target_duration, dtype=np.float32)
+    try:
+        DataLoadingProcessing().stream_into_buffer(upload_file, waveform, sample_rate=sample_rate)
+    except Exception:
+        SimScore().release_request()
+        raise
+
+    fast_model_name = serving_params['Fast_Model_Name']
+    return SimScore().embed_within_budget(waveform, serving_params['Latency_Budget'],
+                                          fast_model_path=os.path.join(model_folder, fast_model_name) if fast_model_name else None,
+                                          fast_image_size=tuple(serving_params['Fast_Image_Size']),
+                                          cache_size=serving_params['Cache_Size'], submitted_at=submitted_at)
 
 
 class UI:
 
-    def __init__(self):
-        pass
+    def __init__(self, params=None):
+        self.params = params or Utility().read_params()
 
     def webapp(self):
     # # Streamlit UI Part
@@ -63,22 +99,27 @@ class UI:
         st.divider()
         
         st.subheader('Upload a song file')
-        uploaded_file = st.file_uploader("", type=["wav"])
+        uploaded_file = st.file_uploader("", type=["wav", "flac", "ogg"])
         
         if uploaded_file:
-            with tempfile.NamedTemporaryFile(delete=False, suffix=f".{uploaded_file.name.split('.')[-1]}") as temp_file:
-                temp_file.write(uploaded_file.getbuffer())
-                temp_file_path = temp_file.name
-                
-            if not os.path.exists('user_ip_wavfile_folder'):
-                os.makedirs('user_ip_wavfile_folder')
-                
-            file_path = os.path.join('user_ip_wavfile_folder', 'wavfile.wav')
-            
-            with open(file_path, 'wb') as f:
-                f.write(uploaded_file.getbuffer())
+            # Streamlit reruns this script at every widget change: the embedding of an upload is
+            # started only once, as soon as it arrives, while the user picks preferences.
+            # Streamlit already holds the upload in memory: getvalue() returns those bytes without
+            # copying them (unlike getbuffer(), which unshares them), and the BytesIO given to the
+            # background thread reads the same bytes with its own position, independent of st.audio
+            upload_bytes = uploaded_file.getvalue()
+            upload_id = hashlib.sha1(upload_bytes).hexdigest()
+            if st.session_state.get('upload_id') != upload_id:
+                from step3_calculate_similarity_scores import SimScore
+
+                st.session_state['upload_id'] = upload_id
+                # Pending from now on, so that uploads queued behind the busy workers count as load
+                # and the time they wait is charged to their latency budget
+                submitted_at = SimScore().register_request()
+                st.session_state['embedding_future'] = background_executor().submit(embed_upload, io.BytesIO(upload_bytes), self.params['Serving'], submitted_at,
+                                                                                     self.params['Model']['Model_Folder'])
             
-            st.audio(temp_file_path)
+            st.audio(uploaded_file, format=uploaded_file.type)
 
             st.subheader("Tell us your instrument preferences:")
             guitar_pref = st.radio("Do you prefer Guitar:guitar: in recommendations?", ["No", "Yes"], index=1)
@@ -95,26 +136,31 @@ class UI:
                     user_preferences.append(index)
 
             if st.button("Submit"):
+                from step3_calculate_similarity_scores import SimScore
+
                 with st.spinner():
                     start_time = time.time()
-                    recommendations = SimScore().generate_recommendations(user_preferences)
+                    # Usually done by now: the embedding started when the file was uploaded
+                    try:
+                        instrument_durations, tier = st.session_state['embedding_future'].result()
+                    except Exception as e:
+                        st.error(f"Could not read the uploaded file: {e}")
+                        st.stop()
+                    recommendations = SimScore().recommend_from_durations(instrument_durations, user_preferences)
                     print(f"******************Recommendations: {recommendations}")
                     if recommendations:
                         st.success("Preferences submitted successfully! Here is your recommendation:")
                         # for rec in recommendations:
                         #     st.write(f"- {rec}")
-                        st.audio(os.path.join('Audio_Dataset', 'test', 'Input', f"{recommendations}"))
+                        st.audio(recommendations)
+                        if tier in ('fast', 'cached:fast'):
+                            st.caption("The server is busy: this recommendation comes from a quick approximate analysis of your song.")
                     else:
                         st.warning("No recommendations available based on your preferences. Try adjusting your inputs.")
                     
                     end_time = time.time()
                     print(f"Time taken: {end_time - start_time:.6f} seconds")
 
-            try:
-                os.remove(temp_file_path)
-            except Exception as e:
-                st.error(f"Error cleaning up the file: {e}")
-
         else:
             st.info("Please upload a song to proceed.")
     
@@ -144,7 +190,7 @@ if __name__ == "__main__":
     # STARTING THE EXECUTION OF FUNCTIONS
     logger.info('Webapp launched successfully.')
 
-    ui = UI()
+    ui = UI(params)
     ui.webapp()
 
     logger.info('Webapp Disconnected.')
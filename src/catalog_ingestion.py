@@ -0,0 +1,492 @@
+import os
+import queue
+import argparse
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import librosa
+import numpy as np
+import torch
+import memory_instrumentation
+from prediction_funcs import Predictions
+from step2_DatasetLoading import DataLoadingProcessing
+from step3_calculate_similarity_scores import SimScore
+from temporal_embeddings import TemporalEmbedding
+from catalog_store import CatalogStore
+from step4_ModelTraining import UNET
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream in the queues between the stages
+_END_OF_STREAM = None
+
+
+def decode_mix(mix_path, sample_rate=10880, target_duration=180):
+    """Decodes one mix to a mono waveform of the length the model expects.
+
+    Runs inside the worker processes of the decoding pool, hence a module level function.
+
+    Parameters
+    -----------
+
+    mix_path: Path to the mix audio file
+    sample_rate: Sample rate to resample the mix to
+    target_duration: Duration (in seconds) the mix is padded or truncated to
+
+    Returns
+    --------
+    (mix_path, waveform): waveform is a float32 array or None if the file could not be decoded
+    """
+
+    try:
+        y, sr = librosa.load(mix_path, mono=True, sr=sample_rate)
+        y = DataLoadingProcessing().make_lengths_same(y, sr, target_duration)
+        return mix_path, y.astype(np.float32)
+
+    except Exception as e:
+        print(f"Could not decode '{mix_path}': {e}")
+        return mix_path, None
+
+
+class CatalogIngestion:
+
+    model_sources = Predictions.model_sources
+    catalog_instruments = Predictions.catalog_instruments
+
+    def __init__(self, model, catalog_file_path='db_duration_matrix.npy', ids_file_path='db_track_ids.txt',
+                 num_workers=4, batch_size=16, queue_size=4, n_fft=1022, hop_length=512, catalog_store=None,
+                 envelopes_file_path='db_envelopes.npy'):
+        self.model = model
+        self.catalog_store = catalog_store
+        self.catalog_file_path = catalog_file_path
+        self.ids_file_path = ids_file_path
+        self.envelopes_file_path = envelopes_file_path
+        # Frames of the activity envelopes to compute for the ingested mixes, None if the catalog has none
+        self.num_frames = None
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def find_mixes(self, mix_folder, extensions=('.wav', '.flac', '.mp3', '.ogg')):
+        """Returns the sorted absolute paths of all the audio files below 'mix_folder'."""
+
+        mix_paths = list()
+        for folder, _, file_names in os.walk(mix_folder):
+            for file_name in file_names:
+                if file_name.lower().endswith(extensions):
+                    mix_paths.append(os.path.abspath(os.path.join(folder, file_name)))
+
+        return sorted(mix_paths)
+
+    @property
+    def parts_folder(self):
+        """Batches committed by the ingestion and not merged into the catalog files yet (see 'merge_parts')."""
+
+        return os.path.splitext(self.catalog_file_path)[0] + '_parts'
+
+    def part_paths(self):
+        """Committed batch files, in commit order (temporary files excluded)."""
+
+        if not os.path.isdir(self.parts_folder):
+            return list()
+
+        names = sorted(name for name in os.listdir(self.parts_folder)
+                       if name.startswith('part-') and name.endswith('.npz') and name[5:-4].isdigit())
+        return [os.path.join(self.parts_folder, name) for name in names]
+
+    def load_catalog(self, mmap_mode=None):
+        """Loads the catalog files: the matrix, its ids and its activity envelopes, or empty ones if no catalog exists yet.
+
+        The ids file is replaced last (here and in 'SimScore.calculate_db_durations'), so it is
+        the commit point: a matrix or envelopes file with more rows is the leftover of a merge
+        that crashed before it, and is cut back to the ids. The envelopes are None if the
+        catalog was built without them ('--temporal' of step3) or if they have fewer rows.
+        """
+
+        if not os.path.exists(self.catalog_file_path):
+            return np.zeros((0, len(self.catalog_instruments))), list(), None
+
+        catalog = np.load(self.catalog_file_path, mmap_mode=mmap_mode)
+        track_ids = SimScore().load_track_ids(self.ids_file_path)
+
+        if catalog.shape[0] < len(track_ids):
+            raise ValueError(f"'{self.ids_file_path}' has {len(track_ids)} ids but the catalog has {catalog.shape[0]} rows.")
+
+        envelopes = None
+        if self.envelopes_file_path is not None and os.path.exists(self.envelopes_file_path):
+            envelopes = np.load(self.envelopes_file_path, mmap_mode=mmap_mode)
+            if envelopes.shape[0] < len(track_ids):
+                logger.info(f"Ignoring '{self.envelopes_file_path}': {envelopes.shape[0]} envelopes for {len(track_ids)} catalog rows.")
+                envelopes = None
+            else:
+                envelopes = envelopes[:len(track_ids)]
+
+        return catalog[:len(track_ids)], track_ids, envelopes
+
+    def load_part(self, part_path):
+        """(track_ids, vectors, envelopes or None) of a committed batch."""
+
+        with np.load(part_path) as part:
+            envelopes = part['envelopes'] if 'envelopes' in part else None
+            return np.char.decode(part['track_ids'], 'utf-8').tolist(), part['vectors'], envelopes
+
+    def commit_part(self, track_ids, vectors, envelopes=None):
+        """Commits one embedded batch as a new part file, in a single rename.
+
+        Only the rows of the batch are written, so committing costs the same whatever the size
+        of the catalog, and a crash loses at most the batch being written.
+        """
+
+        os.makedirs(self.parts_folder, exist_ok=True)
+        existing = self.part_paths()
+        index = int(os.path.basename(existing[-1])[5:-4]) + 1 if existing else 0
+        part_path = os.path.join(self.parts_folder, f'part-{index:06d}.npz')
+
+        arrays = {'track_ids': np.array([track_id.encode('utf-8') for track_id in track_ids], dtype=bytes), 'vectors': vectors}
+        if envelopes is not None:
+            arrays['envelopes'] = envelopes
+
+        tmp_part_path = part_path + '.tmp.npz'
+        np.savez(tmp_part_path, **arrays)
+        os.replace(tmp_part_path, part_path)
+
+    def ingested_ids(self):
+        """Ids of the catalog files and of the committed parts, i.e. every mix already ingested."""
+
+        track_ids = set(self.load_catalog(mmap_mode='r')[1])
+        for part_path in self.part_paths():
+            track_ids.update(self.load_part(part_path)[0])
+
+        return track_ids
+
+    def merge_parts(self, block_size=65536):
+        """Appends the committed parts to the catalog files and deletes them.
+
+        The merged matrix and envelopes are written through memory maps, a block at a time, and
+        replaced before the ids file, which commits the merge (see 'load_catalog'). The parts are
+        deleted only then: after a crash, merging again skips the rows the catalog files have.
+
+        Returns
+        --------
+        Number of rows added to the catalog files
+        """
+
+        part_paths = self.part_paths()
+        if not part_paths:
+            return 0
+
+        catalog, track_ids, envelopes = self.load_catalog(mmap_mode='r')
+        catalog_rows = len(track_ids)
+        known = set(track_ids)
+
+        # Rows of the parts not merged yet, read once to size the output files
+        parts = list()
+        for part_path in part_paths:
+            part_ids, vectors, part_envelopes = self.load_part(part_path)
+            new = np.array([track_id not in known for track_id in part_ids], dtype=bool)
+            known.update(part_ids)
+            parts.append((part_path, new))
+
+            if envelopes is not None and part_envelopes is None:
+                logger.info(f"'{part_path}' has no activity envelopes: the merged catalog will have none.")
+                envelopes = None
+
+        num_rows = catalog_rows + sum(int(new.sum()) for _, new in parts)
+        tmp_catalog_path = self.catalog_file_path + '.tmp.npy'
+        merged = np.lib.format.open_memmap(tmp_catalog_path, mode='w+', dtype=catalog.dtype, shape=(num_rows, len(self.catalog_instruments)))
+        merged_envelopes = None
+        if envelopes is not None:
+            tmp_envelopes_path = self.envelopes_file_path + '.tmp.npy'
+            merged_envelopes = np.lib.format.open_memmap(tmp_envelopes_path, mode='w+', dtype=envelopes.dtype,
+                                                         shape=(num_rows,) + envelopes.shape[1:])
+
+        for start in range(0, catalog_rows, block_size):
+            block = slice(start, min(start + block_size, catalog_rows))
+            merged[block] = catalog[block]
+            if merged_envelopes is not None:
+                merged_envelopes[block] = envelopes[block]
+
+        row = catalog_rows
+        track_ids = list(track_ids)
+        for part_path, new in parts:
+            part_ids, vectors, part_envelopes = self.load_part(part_path)
+            merged[row:row + new.sum()] = vectors[new]
+            if merged_envelopes is not None:
+                merged_envelopes[row:row + new.sum()] = part_envelopes[new]
+            track_ids += [track_id for track_id, is_new in zip(part_ids, new) if is_new]
+            row += int(new.sum())
+
+        # Closing the memory maps (and their files) before the renames
+        merged.flush()
+        del merged, catalog
+        if merged_envelopes is not None:
+            merged_envelopes.flush()
+            del merged_envelopes
+            os.replace(tmp_envelopes_path, self.envelopes_file_path)
+        os.replace(tmp_catalog_path, self.catalog_file_path)
+
+        tmp_ids_path = self.ids_file_path + '.tmp'
+        SimScore().save_track_ids(track_ids, tmp_ids_path)
+        os.replace(tmp_ids_path, self.ids_file_path)
+
+        for part_path in part_paths:
+            os.remove(part_path)
+
+        logger.info(f'Merged {len(part_paths)} part(s) into the catalog, which now holds {num_rows} tracks.')
+        return num_rows - catalog_rows
+
+    def unpublished(self):
+        """Whether the catalog files hold rows the current store version does not (e.g. a run stopped after its merge)."""
+
+        num_rows = len(self.load_catalog(mmap_mode='r')[1])
+        return num_rows > 0 and (not self.catalog_store.exists() or len(self.catalog_store.current()) != num_rows)
+
+    def publish_catalog(self):
+        """Publishes the catalog files as a new version of the catalog store.
+
+        Refuses to replace a version that has activity envelopes with one that has none, which
+        would silently break the temporal recommendations.
+        """
+
+        catalog, track_ids, envelopes = self.load_catalog(mmap_mode='r')
+        if envelopes is None and self.catalog_store.exists() and self.catalog_store.current().envelopes is not None:
+            raise ValueError(f"Catalog version {self.catalog_store.current().version} has activity envelopes but "
+                             f"'{self.envelopes_file_path}' does not match the catalog, rebuild it with '--temporal'.")
+
+        return self.catalog_store.publish(catalog, track_ids, envelopes=envelopes)
+
+    def spectrogram_batch(self, waveforms):
+        """Computes the STFT and the model input of a batch of waveforms (see 'Predictions.spectrogram_batch')."""
+
+        return Predictions().spectrogram_batch(waveforms, n_fft=self.n_fft, hop_length=self.hop_length)
+
+    def embed_batch(self, waveforms):
+        """Computes the catalog rows (non-silent fraction of every instrument) of a batch of waveforms,
+        and their activity envelopes if the catalog has envelopes ('num_frames'), else None.
+
+        The batch goes through the model in chunks, smaller than the batch if embedding it
+        exceeds the memory budget of the stage (see 'memory_instrumentation.chunk_size').
+        """
+
+        embeddings, envelopes, start = list(), list(), 0
+        while start < len(waveforms):
+            size = memory_instrumentation.chunk_size('embed_batch', len(waveforms))
+            chunk = waveforms[start:start + size]
+            start += size
+
+            with memory_instrumentation.stage('embed_batch', items=len(chunk)):
+                chunk_embeddings, chunk_envelopes = self.embed_chunk(chunk)
+            embeddings.append(chunk_embeddings)
+            envelopes.append(chunk_envelopes)
+
+        return np.concatenate(embeddings), (np.concatenate(envelopes) if self.num_frames is not None else None)
+
+    def embed_chunk(self, waveforms):
+        waveforms = torch.from_numpy(np.stack(waveforms))
+        stft_results, model_input = self.spectrogram_batch(waveforms)
+        softmasks = Predictions().predict_source_masks_batch(self.model, model_input)
+
+        sim_score = SimScore()
+        column_order = [self.model_sources.index(instrument) for instrument in self.catalog_instruments]
+
+        # All the sources of all the mixes of the batch with one inverse STFT
+        separated_sources = Predictions().separate_sources_batch(waveforms, softmasks, n_fft=self.n_fft, hop_length=self.hop_length,
+                                                                 window_length=self.n_fft, stft_results=stft_results).numpy()
+
+        embeddings, envelopes = list(), list()
+        for sources in separated_sources:
+            durations = [sim_score.get_waveform_duration(sources[channel]) for channel in column_order]
+            embeddings.append(durations)
+            if self.num_frames is not None:
+                envelopes.append(TemporalEmbedding().envelopes(sources[column_order], num_frames=self.num_frames))
+
+        return np.array(embeddings), (np.stack(envelopes) if self.num_frames is not None else None)
+
+    def inference_stage(self, batch_queue, result_queue, errors):
+        """Consumes batches of decoded mixes and produces their catalog rows."""
+
+        while True:
+            batch = batch_queue.get()
+            if batch is _END_OF_STREAM:
+                result_queue.put(_END_OF_STREAM)
+                return
+
+            # After a failure the remaining batches are only drained so that the decoding stage does not block
+            if errors:
+                continue
+
+            mix_paths, waveforms = batch
+            try:
+                with torch.no_grad():
+                    embeddings, envelopes = self.embed_batch(waveforms)
+                result_queue.put((mix_paths, embeddings, envelopes))
+            except Exception as e:
+                errors.append(e)
+
+    def writer_stage(self, result_queue, errors):
+        """Commits every embedded batch (and its envelopes) as a part file of the catalog."""
+
+        committed = 0
+        while True:
+            result = result_queue.get()
+            if result is _END_OF_STREAM:
+                return
+
+            # After a failure the remaining batches are only drained so that the inference stage does not block
+            if errors:
+                continue
+
+            try:
+                mix_paths, embeddings, envelopes = result
+                self.commit_part(mix_paths, embeddings, envelopes.astype(np.float16) if envelopes is not None else None)
+                committed += len(mix_paths)
+                logger.info(f'{committed} mixes committed.')
+            except Exception as e:
+                errors.append(e)
+
+    def collect_decoded(self, future, batch_paths, batch_waveforms, batch_queue):
+        """Adds a decoded mix to the batch being built and hands the batch over once it is full.
+
+        Returns
+        --------
+        Number of mixes handed over to the inference stage
+        """
+
+        mix_path, y = future.result()
+        if y is None:
+            return 0
+
+        batch_paths.append(mix_path)
+        batch_waveforms.append(y)
+
+        if len(batch_paths) < self.batch_size:
+            return 0
+
+        # put() blocks while the queue is full, which is the backpressure on the decoding stage
+        batch_queue.put((list(batch_paths), list(batch_waveforms)))
+        batch_paths.clear()
+        batch_waveforms.clear()
+
+        return self.batch_size
+
+    def ingest(self, mix_folder):
+        """Embeds every mix below 'mix_folder' that is not in the catalog yet and adds it to the catalog.
+
+        Decoding runs in a process pool, the spectrograms and the model run on batches in an
+        inference thread and a writer thread commits the batches to the catalog. The stages are
+        connected with bounded queues so that a slow stage holds back the ones before it.
+        Every batch is committed as a part file, and the parts are merged into the catalog
+        files once at the end. Ingestion is resumable: mixes already in the catalog or in a
+        committed part are skipped, and parts left by an interrupted run are merged. If the
+        catalog has activity envelopes, they are computed for the new mixes as well.
+
+        Parameters
+        -----------
+
+        mix_folder: Folder containing the mixes (searched recursively)
+
+        Returns
+        --------
+        Number of mixes added to the catalog
+        """
+
+        envelopes = self.load_catalog(mmap_mode='r')[2]
+        self.num_frames = envelopes.shape[-1] if envelopes is not None else None
+        done = self.ingested_ids()
+        pending = [mix_path for mix_path in self.find_mixes(mix_folder) if mix_path not in done]
+        logger.info(f'{len(pending)} mixes to ingest, {len(done)} already in the catalog.')
+
+        batch_queue = queue.Queue(maxsize=self.queue_size)
+        result_queue = queue.Queue(maxsize=self.queue_size)
+        errors = list()
+
+        inference_thread = threading.Thread(target=self.inference_stage, args=(batch_queue, result_queue, errors))
+        writer_thread = threading.Thread(target=self.writer_stage, args=(result_queue, errors))
+        inference_thread.start()
+        writer_thread.start()
+
+        ingested = 0
+        try:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                # Bounding the number of decoded mixes held in memory
+                window = self.batch_size * self.queue_size
+                in_flight = deque()
+                batch_paths, batch_waveforms = list(), list()
+
+                for mix_path in pending:
+                    in_flight.append(executor.submit(decode_mix, mix_path))
+                    if len(in_flight) < window:
+                        continue
+
+                    ingested += self.collect_decoded(in_flight.popleft(), batch_paths, batch_waveforms, batch_queue)
+
+                while in_flight:
+                    ingested += self.collect_decoded(in_flight.popleft(), batch_paths, batch_waveforms, batch_queue)
+
+                if batch_paths:
+                    batch_queue.put((batch_paths, batch_waveforms))
+                    ingested += len(batch_paths)
+        finally:
+            batch_queue.put(_END_OF_STREAM)
+            inference_thread.join()
+            writer_thread.join()
+
+        if errors:
+            raise errors[0]
+
+        # Merging and publishing once at the end rather than after every batch
+        merged = self.merge_parts()
+        if self.catalog_store is not None and (merged or self.unpublished()):
+            self.publish_catalog()
+
+        logger.info(f'{ingested} mixes ingested into the catalog.')
+        return ingested
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Make_Predictions = params['Logs']['Make_Predictions']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Make_Predictions))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    memory_instrumentation.enable(params['Memory'])
+
+    parser = argparse.ArgumentParser(description='Adds a folder of mixes to the recommendation catalog.')
+    parser.add_argument('mix_folder', help='Folder containing the mixes to ingest')
+    args = parser.parse_args()
+
+    catalog_params = params['Catalog']
+    ingestion_params = catalog_params['Ingestion']
+
+    # Loading the trained model
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = UNET.load(os.path.join(params['Model']['Model_Folder'], params['Model']['Model_Name']), map_location=device)
+    model = model.to(device)
+
+    ci = CatalogIngestion(model,
+                          catalog_file_path=catalog_params['Catalog_File'],
+                          ids_file_path=catalog_params['Ids_File'],
+                          num_workers=ingestion_params['Num_Workers'],
+                          batch_size=ingestion_params['Batch_Size'],
+                          queue_size=ingestion_params['Queue_Size'],
+                          catalog_store=CatalogStore(catalog_params['Catalog_Folder'], catalog_params['Keep_Versions']),
+                          envelopes_file_path=catalog_params['Envelopes_File'])
+    ci.ingest(args.mix_folder)
@@ -0,0 +1,199 @@
+import os
+import json
+import shutil
+import logging
+import threading
+from datetime import datetime, timezone
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Catalog versions opened by this process, by manifest path: (manifest stat, CatalogVersion)
+_open_catalogs = dict()
+_open_catalogs_lock = threading.Lock()
+
+
+class CatalogVersion:
+    """One published version of the catalog, opened read-only.
+
+    The arrays are memory-mapped, so every process serving the same version shares a single
+    copy of them through the page cache.
+    """
+
+    def __init__(self, version, vectors, track_ids, envelopes=None):
+        self.version = version
+        self.vectors = vectors  # (tracks x instruments)
+        self.track_ids = track_ids  # (tracks,) utf-8 encoded bytes
+        self.envelopes = envelopes  # (tracks x instruments x frames) or None
+
+        # FFTs of the envelopes, by FFT length, computed by the first temporal query of this version
+        self._envelope_spectra = dict()
+        self._envelope_spectra_lock = threading.Lock()
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def track_id(self, index):
+        return self.track_ids[index].decode('utf-8')
+
+    def track_ids_at(self, indices):
+        """Decodes the track ids at an array of row indices, keeping the shape of 'indices'."""
+
+        return np.char.decode(np.asarray(self.track_ids)[indices], 'utf-8').astype(object)
+
+    def envelope_spectra(self, temporal_embedding):
+        """'TemporalEmbedding.catalog_spectra' of the envelopes, computed once per version and FFT length.
+
+        The version object is shared by the requests of a serving process until a new version
+        is published, so the transform of the catalog is paid by the first temporal query only.
+        """
+
+        n_fft = temporal_embedding.fft_length(self.envelopes.shape[-1])
+        with self._envelope_spectra_lock:
+            if n_fft not in self._envelope_spectra:
+                self._envelope_spectra[n_fft] = temporal_embedding.catalog_spectra(self.envelopes)
+            return self._envelope_spectra[n_fft]
+
+
+class CatalogStore:
+    """Versioned catalog on disk, published atomically and hot-reloaded by the serving processes.
+
+    Layout of the catalog folder::
+
+        manifest.json            current version and its files
+        versions/v000001/        vectors.npy, track_ids.npy (and envelopes.npy)
+        versions/v000002/        ...
+
+    A version is written to a staging folder and renamed into 'versions' once complete; the
+    manifest is then replaced in one rename. Readers only follow the manifest, so they see
+    either the previous version or the new one, never a partially written catalog.
+    """
+
+    def __init__(self, catalog_folder='Catalog', keep_versions=3):
+        self.catalog_folder = catalog_folder
+        self.keep_versions = keep_versions
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.catalog_folder, 'manifest.json')
+
+    @property
+    def versions_folder(self):
+        return os.path.join(self.catalog_folder, 'versions')
+
+    def exists(self):
+        return os.path.exists(self.manifest_path)
+
+    def read_manifest(self):
+        with open(self.manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)
+
+    def published_versions(self):
+        if not os.path.isdir(self.versions_folder):
+            return list()
+
+        return sorted(name for name in os.listdir(self.versions_folder) if name.startswith('v') and name[1:].isdigit())
+
+    def publish(self, vectors, track_ids, envelopes=None):
+        """Writes a new catalog version and makes it the current one.
+
+        Parameters
+        -----------
+
+        vectors: (tracks x instruments) array of instrument durations
+        track_ids: Audio file path of every row
+        envelopes: Optional (tracks x instruments x frames) array of activity envelopes
+
+        Returns
+        --------
+        Name of the published version
+        """
+
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(track_ids) != vectors.shape[0] or (envelopes is not None and len(envelopes) != vectors.shape[0]):
+            raise ValueError(f'The catalog has {vectors.shape[0]} rows but {len(track_ids)} ids'
+                             + (f' and {len(envelopes)} envelopes.' if envelopes is not None else '.'))
+
+        os.makedirs(self.versions_folder, exist_ok=True)
+        versions = self.published_versions()
+        version = f'v{int(versions[-1][1:]) + 1 if versions else 1:06d}'
+
+        staging_folder = os.path.join(self.catalog_folder, f'.staging-{version}-{os.getpid()}')
+        os.makedirs(staging_folder)
+
+        files = {'vectors': 'vectors.npy', 'track_ids': 'track_ids.npy'}
+        np.save(os.path.join(staging_folder, files['vectors']), vectors)
+        # Fixed width bytes so that the id table can be memory-mapped like the vectors
+        np.save(os.path.join(staging_folder, files['track_ids']),
+                np.array([track_id.encode('utf-8') for track_id in track_ids], dtype=bytes))
+        if envelopes is not None:
+            files['envelopes'] = 'envelopes.npy'
+            np.save(os.path.join(staging_folder, files['envelopes']), np.asarray(envelopes, dtype=np.float16))
+
+        os.rename(staging_folder, os.path.join(self.versions_folder, version))
+
+        manifest = {'version': version,
+                    'num_tracks': int(vectors.shape[0]),
+                    'instruments': int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                    'files': files,
+                    'published': datetime.now(timezone.utc).isoformat()}
+
+        tmp_manifest_path = self.manifest_path + '.tmp'
+        with open(tmp_manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=4)
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(tmp_manifest_path, self.manifest_path)
+
+        logger.info(f'Catalog version {version} published with {vectors.shape[0]} tracks.')
+        self.prune()
+        return version
+
+    def prune(self):
+        """Deletes the oldest versions beyond 'keep_versions'.
+
+        Processes still reading a deleted version keep their memory maps valid until they
+        switch over (the files are only unlinked); where unlinking open files fails, the version
+        is left for a later prune.
+        """
+
+        current = self.read_manifest()['version']
+        for version in self.published_versions()[:-self.keep_versions]:
+            if version == current:
+                continue
+            try:
+                shutil.rmtree(os.path.join(self.versions_folder, version))
+            except OSError as e:
+                logger.info(f'Could not delete catalog version {version} yet: {e}')
+
+    def open_version(self, manifest):
+        version_folder = os.path.join(self.versions_folder, manifest['version'])
+        files = manifest['files']
+
+        def load(name):
+            return np.load(os.path.join(version_folder, files[name]), mmap_mode='r') if name in files else None
+
+        return CatalogVersion(manifest['version'], load('vectors'), load('track_ids'), load('envelopes'))
+
+    def current(self):
+        """Returns the current catalog version, switching to a newly published one if any.
+
+        Meant to be called at the start of every request: it costs one stat of the manifest
+        when nothing changed. A request keeps using the version object it got, so the vectors
+        and the ids it reads always belong to the same version.
+        """
+
+        manifest_stat = os.stat(self.manifest_path)
+        stat_key = (manifest_stat.st_ino, manifest_stat.st_mtime_ns, manifest_stat.st_size)
+
+        with _open_catalogs_lock:
+            cached = _open_catalogs.get(os.path.abspath(self.manifest_path))
+            if cached is not None and cached[0] == stat_key:
+                return cached[1]
+
+            catalog_version = self.open_version(self.read_manifest())
+            _open_catalogs[os.path.abspath(self.manifest_path)] = (stat_key, catalog_version)
+
+        if cached is not None:
+            logger.info(f'Switched from catalog version {cached[1].version} to {catalog_version.version}.')
+        return catalog_version
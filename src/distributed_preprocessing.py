@@ -0,0 +1,469 @@
+import os
+import sys
+import json
+import glob
+import time
+import uuid
+import errno
+import contextlib
+import shutil
+import socket
+import argparse
+import logging
+import threading
+import subprocess
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Per-track stages a worker can run on its shards, in execution order
+SHARD_STAGES = ['audio', 'spectrogram', 'masks']
+
+
+class LeaseQueue:
+    """Coordinator-free work queue kept as files in a folder on shared storage.
+
+    A shard is claimed by creating '<shard>.lease.<generation>' with O_EXCL, which only one
+    worker can do. The owner refreshes the file's modification time while it works (heartbeat).
+    A lease not refreshed for 'lease_timeout' seconds has expired and the shard is taken over by
+    creating the next generation, so the owner of the highest generation is always the current
+    one. A finished shard is committed by renaming its staging folder, which holds its output
+    files and its summary ('shard.json'), to 'done/<shard>' in one atomic step: a rename onto an
+    existing non-empty folder fails, so only the first worker to commit a shard succeeds.
+    """
+
+    def __init__(self, queue_folder, worker_id, lease_timeout=600, heartbeat_interval=30, max_attempts=3):
+        self.queue_folder = queue_folder
+        self.worker_id = worker_id
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+
+        self.lease_folder = os.path.join(queue_folder, 'leases')
+        self.done_folder = os.path.join(queue_folder, 'done')
+        os.makedirs(self.lease_folder, exist_ok=True)
+        os.makedirs(self.done_folder, exist_ok=True)
+
+        self.held_lease = None
+        self.lost = threading.Event()
+        self.stop_heartbeat = threading.Event()
+        self.heartbeat_thread = None
+
+    def done_path(self, shard_id):
+        return os.path.join(self.done_folder, shard_id)
+
+    def is_done(self, shard_id):
+        return os.path.isdir(self.done_path(shard_id))
+
+    def current_lease(self, shard_id):
+        """Returns (generation, path) of the newest lease of a shard, or (-1, None) if it was never claimed."""
+
+        leases = list()
+        for path in glob.glob(os.path.join(self.lease_folder, f'{shard_id}.lease.*')):
+            try:
+                leases.append((int(path.rsplit('.', 1)[1]), path))
+            except ValueError:
+                continue
+
+        return max(leases) if leases else (-1, None)
+
+    def is_expired(self, lease_path):
+        try:
+            return time.time() - os.path.getmtime(lease_path) > self.lease_timeout
+        except FileNotFoundError:
+            # The owner committed and cleaned up in the meantime
+            return False
+
+    def is_exhausted(self, shard_id):
+        """A shard whose last allowed attempt expired without a commit is given up on."""
+
+        generation, lease_path = self.current_lease(shard_id)
+        return generation + 1 >= self.max_attempts and lease_path is not None and self.is_expired(lease_path)
+
+    def claim(self, shard_id):
+        """Tries to take the lease of a shard that is not done and not held by a live worker.
+
+        Returns
+        --------
+        True if this worker now holds the lease
+        """
+
+        if self.is_done(shard_id):
+            return False
+
+        generation, lease_path = self.current_lease(shard_id)
+        if lease_path is not None and not self.is_expired(lease_path):
+            return False
+
+        # Every takeover is a new generation, so the generation counts the attempts
+        if generation + 1 >= self.max_attempts:
+            return False
+
+        new_lease_path = os.path.join(self.lease_folder, f'{shard_id}.lease.{generation + 1}')
+        try:
+            fd = os.open(new_lease_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            # Another worker claimed it first
+            return False
+
+        with os.fdopen(fd, 'w') as lease_file:
+            json.dump({'worker': self.worker_id, 'claimed_at': time.time()}, lease_file)
+
+        if lease_path is not None:
+            logger.info(f"Worker {self.worker_id} took over expired shard {shard_id} (generation {generation + 1}).")
+
+        self.held_lease = (shard_id, generation + 1, new_lease_path)
+        self.lost.clear()
+        self.start_heartbeat()
+        return True
+
+    def still_owner(self):
+        """Checks that no other worker took the held lease over."""
+
+        shard_id, generation, _ = self.held_lease
+        return self.current_lease(shard_id)[0] == generation
+
+    def heartbeat(self):
+        while not self.stop_heartbeat.wait(self.heartbeat_interval):
+            _, _, lease_path = self.held_lease
+            try:
+                os.utime(lease_path)
+            except FileNotFoundError:
+                pass
+
+            if not self.still_owner():
+                logger.info(f"Worker {self.worker_id} lost the lease of shard {self.held_lease[0]}.")
+                self.lost.set()
+                return
+
+    def start_heartbeat(self):
+        self.stop_heartbeat.clear()
+        self.heartbeat_thread = threading.Thread(target=self.heartbeat, daemon=True)
+        self.heartbeat_thread.start()
+
+    def abandon(self):
+        """Stops the heartbeat but keeps the lease file, so the shard is retried once the lease expires."""
+
+        if self.held_lease is None:
+            return
+
+        self.stop_heartbeat.set()
+        self.heartbeat_thread.join()
+        self.held_lease = None
+
+    def release(self):
+        """Stops the heartbeat and removes the held lease file."""
+
+        if self.held_lease is None:
+            return
+
+        self.stop_heartbeat.set()
+        self.heartbeat_thread.join()
+
+        try:
+            os.remove(self.held_lease[2])
+        except FileNotFoundError:
+            pass
+
+        self.held_lease = None
+
+    def commit(self, staging_root, summary):
+        """Marks the held shard as done by renaming its staging folder (on the same filesystem) to 'done/<shard>'.
+
+        The ownership check only saves work: the rename itself decides, so a worker whose lease
+        expired after the check cannot commit a shard another worker committed.
+
+        Returns
+        --------
+        True if the shard was committed by this worker
+        """
+
+        shard_id = self.held_lease[0]
+        if self.lost.is_set() or not self.still_owner():
+            self.release()
+            return False
+
+        with open(os.path.join(staging_root, 'shard.json'), 'w') as summary_file:
+            json.dump(dict(summary, worker=self.worker_id, committed_at=time.time()), summary_file)
+
+        try:
+            os.rename(staging_root, self.done_path(shard_id))
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise e
+            logger.info(f"Shard {shard_id} was committed by another worker first.")
+            self.release()
+            return False
+
+        # Older generations of the lease are not needed anymore
+        for lease_path in glob.glob(os.path.join(self.lease_folder, f'{shard_id}.lease.*')):
+            if lease_path != self.held_lease[2]:
+                try:
+                    os.remove(lease_path)
+                except FileNotFoundError:
+                    pass
+
+        self.release()
+        return True
+
+
+class DistributedPreprocessing:
+
+    def __init__(self, params, queue_folder, worker_id=None, stages=SHARD_STAGES, shard_size=8,
+                 lease_timeout=600, heartbeat_interval=30, max_attempts=3, poll_interval=10):
+        self.params = params
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.stages = [stage for stage in SHARD_STAGES if stage in stages]
+        self.shard_size = shard_size
+        self.poll_interval = poll_interval
+
+        self.queue = LeaseQueue(queue_folder, self.worker_id, lease_timeout=lease_timeout,
+                                heartbeat_interval=heartbeat_interval, max_attempts=max_attempts)
+        self.staging_folder = os.path.join(queue_folder, 'staging')
+
+        data_params = params['Data']
+        self.dataset_folders = {
+            'audio_dataset_folder': data_params['AudioDatasetFolder'],
+            'spectrogram_dataset_folder': data_params['SpectrogramDatasetFolder'],
+            'final_dataset_folder': data_params['Final_Dataset'],
+        }
+        self.raw_data_folder = data_params['RawDataFolder']
+
+    def plan_shards(self, df, split):
+        """Splits the sorted tracks of a split into shards. Every worker computes the same plan."""
+
+        tracks = sorted(df['Folder Name'].unique())
+        return [(f'{split}-{index // self.shard_size:05d}', tracks[index:index + self.shard_size])
+                for index in range(0, len(tracks), self.shard_size)]
+
+    def expected_outputs(self, dlp, split, track):
+        """Files every stage of this worker writes for an eligible track, below the folders of 'dlp'."""
+        from pipeline_runner import AUDIO_OUTPUTS, IMAGE_OUTPUTS
+
+        outputs = list()
+        if 'audio' in self.stages:
+            outputs += [os.path.join(dlp.audio_dataset_folder, split, 'Output', track, output) for output in AUDIO_OUTPUTS]
+            outputs.append(os.path.join(dlp.audio_dataset_folder, split, 'Input', f'{track}_mix.wav'))
+
+        if 'spectrogram' in self.stages:
+            outputs += [os.path.join(dlp.spectrogram_dataset_folder, split, 'Output', track, output) for output in IMAGE_OUTPUTS]
+            outputs.append(os.path.join(dlp.spectrogram_dataset_folder, split, 'Input', f'{track}_mix.png'))
+
+        if 'masks' in self.stages:
+            outputs += [os.path.join(dlp.final_dataset_folder, split, 'Output', track, output) for output in IMAGE_OUTPUTS]
+            outputs.append(os.path.join(dlp.final_dataset_folder, split, 'Input', f'{track}_mix.png'))
+
+        return outputs
+
+    def process_shard(self, df, split, tracks, staging_root):
+        """Runs the per-track stages on the tracks of a shard, writing into 'staging_root'.
+
+        Raises if an eligible track (see 'DataLoadingProcessing.plan_track') is missing some of
+        its outputs, so that the shard is retried instead of being committed incomplete.
+        """
+        from step2_DatasetLoading import DataLoadingProcessing
+
+        staging_folders = {key: os.path.join(staging_root, folder) for key, folder in self.dataset_folders.items()}
+
+        # Without the spectrogram stage the masks are built from the already published spectrograms
+        if 'spectrogram' not in self.stages:
+            staging_folders['spectrogram_dataset_folder'] = self.dataset_folders['spectrogram_dataset_folder']
+
+        dlp = DataLoadingProcessing(df, raw_data_folder=self.raw_data_folder, **staging_folders)
+        work_plan = dlp.plan_tracks(list(tracks), data=split)
+
+        for entry in work_plan:
+            track = entry['track']
+
+            # Abandoning the shard as soon as another worker took it over
+            if self.queue.lost.is_set():
+                return False
+
+            if 'audio' in self.stages:
+                dlp.create_audio_dataset([track], data=split, work_plan=[entry])
+
+            if 'spectrogram' in self.stages:
+                dlp.create_spectrogram_dataset([track], four_instr=['Piano', 'Drums', 'Bass', 'Guitar'], data=split, work_plan=[entry])
+
+            if 'masks' in self.stages:
+                input_png = os.path.join(dlp.spectrogram_dataset_folder, split, 'Input', f'{track}_mix.png')
+                if os.path.exists(input_png):
+                    dlp.create_mask_dataset(data=split, tracks=[track])
+
+                    # Copying the input spectrogram to the final dataset folder
+                    final_input_folder = os.path.join(staging_folders['final_dataset_folder'], split, 'Input')
+                    os.makedirs(final_input_folder, exist_ok=True)
+                    shutil.copy2(input_png, final_input_folder)
+
+            if entry['eligible']:
+                missing = [output for output in self.expected_outputs(dlp, split, track) if not os.path.exists(output)]
+                if missing:
+                    raise RuntimeError(f"Eligible track {track} is missing {len(missing)} output(s), e.g. '{missing[0]}'.")
+
+        return True
+
+    def publish(self, committed_root):
+        """Moves the files of a committed shard ('done/<shard>') to their final location.
+
+        Every file appears at its destination through an atomic rename, so readers never see a
+        half-written file. Files are copied to a temporary name first when the dataset folders
+        are on another filesystem. Publishing is idempotent: a shard whose committer stopped
+        half-way is finished by any worker, and files another worker moved first are skipped.
+        The shard summary stays in the committed folder.
+
+        Returns
+        --------
+        Number of files published
+        """
+
+        published = 0
+        for folder in self.dataset_folders.values():
+            staged_folder = os.path.join(committed_root, folder)
+            for staged_path in glob.glob(os.path.join(staged_folder, '**', '*'), recursive=True):
+                if not os.path.isfile(staged_path):
+                    continue
+
+                destination = os.path.join(folder, os.path.relpath(staged_path, staged_folder))
+                os.makedirs(os.path.dirname(destination), exist_ok=True)
+
+                try:
+                    os.replace(staged_path, destination)
+                except FileNotFoundError:
+                    continue
+                except OSError as e:
+                    if e.errno != errno.EXDEV:
+                        raise e
+                    tmp_destination = f'{destination}.{self.worker_id}.tmp'
+                    try:
+                        shutil.copy2(staged_path, tmp_destination)
+                        os.replace(tmp_destination, destination)
+                    except FileNotFoundError:
+                        # Published by another worker in the meantime
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(tmp_destination)
+                        continue
+                    except BaseException:
+                        # No partial copy is left next to the published files
+                        with contextlib.suppress(FileNotFoundError):
+                            os.remove(tmp_destination)
+                        raise
+
+                    # Another worker publishing the same shard may have removed it first
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(staged_path)
+
+                published += 1
+
+        return published
+
+    def run(self, split, df):
+        """Claims and processes shards of a split until every shard is committed by some worker.
+
+        Returns
+        --------
+        Number of shards committed by this worker
+        """
+
+        shards = self.plan_shards(df, split)
+        committed = 0
+        logger.info(f'Worker {self.worker_id} started on {len(shards)} shards of {split}.')
+
+        while True:
+            pending = [(shard_id, tracks) for shard_id, tracks in shards
+                       if not self.queue.is_done(shard_id) and not self.queue.is_exhausted(shard_id)]
+            if not pending:
+                break
+
+            claimed_any = False
+            for shard_id, tracks in pending:
+                if not self.queue.claim(shard_id):
+                    continue
+                claimed_any = True
+
+                staging_root = os.path.join(self.staging_folder, f'{shard_id}-{self.worker_id}')
+                try:
+                    finished = self.process_shard(df, split, tracks, staging_root)
+                except Exception as e:
+                    # Leaving the shard to another worker once the lease expires
+                    logger.info(f'Worker {self.worker_id} failed on shard {shard_id}: {e}')
+                    self.queue.abandon()
+                    shutil.rmtree(staging_root, ignore_errors=True)
+                    continue
+
+                if finished and self.queue.commit(staging_root, {'tracks': list(tracks)}):
+                    committed += 1
+                    published = self.publish(self.queue.done_path(shard_id))
+                    logger.info(f'Worker {self.worker_id} committed shard {shard_id} ({published} files).')
+                else:
+                    self.queue.release()
+                    shutil.rmtree(staging_root, ignore_errors=True)
+
+            # Every remaining shard is held by another worker: waiting for it to finish or expire
+            if not claimed_any:
+                time.sleep(self.poll_interval)
+
+        # Finishing the publication of shards whose committer stopped before moving all their files
+        for shard_id, _ in shards:
+            if self.queue.is_done(shard_id):
+                self.publish(self.queue.done_path(shard_id))
+
+        failed = [shard_id for shard_id, _ in shards if not self.queue.is_done(shard_id)]
+        if failed:
+            logger.info(f"Shards given up after {self.queue.max_attempts} attempts: {', '.join(failed)}")
+
+        logger.info(f'Worker {self.worker_id} finished, {committed} shards committed.')
+        return committed
+
+
+def launch_local_workers(num_workers, argv):
+    """Starts 'num_workers' worker processes on this machine and waits for them (for testing the queue)."""
+
+    processes = [subprocess.Popen([sys.executable, os.path.abspath(__file__)] + argv) for _ in range(num_workers)]
+    return [process.wait() for process in processes]
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    data_restructuring_processing_logfile_path = params['Logs']['Data_Restructuring_Processing']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, data_restructuring_processing_logfile_path))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    distributed_params = params['Distributed']
+
+    parser = argparse.ArgumentParser(description='Preprocessing worker claiming track shards through lease files on shared storage.')
+    parser.add_argument('--data', default='train', help='Split to preprocess')
+    parser.add_argument('--queue-folder', default=distributed_params['Queue_Folder'], help='Shared folder holding the leases')
+    parser.add_argument('--local-workers', type=int, default=0, help='Launch this many workers on this machine instead of running one')
+    args = parser.parse_args()
+
+    if args.local_workers > 0:
+        launch_local_workers(args.local_workers, ['--data', args.data, '--queue-folder', args.queue_folder])
+        sys.exit(0)
+
+    import pandas as pd
+    from step2_DatasetLoading import DataLoadingProcessing
+
+    df = pd.read_csv(f'slakh2100_metadata_{args.data}.csv')
+    df = DataLoadingProcessing().replace_other_track_labels(df, ['Piano', 'Drums', 'Bass', 'Guitar'])
+
+    dp = DistributedPreprocessing(params, args.queue_folder,
+                                  stages=distributed_params['Stages'],
+                                  shard_size=distributed_params['Shard_Size'],
+                                  lease_timeout=distributed_params['Lease_Timeout'],
+                                  heartbeat_interval=distributed_params['Heartbeat_Interval'],
+                                  max_attempts=distributed_params['Max_Attempts'])
+    dp.run(args.data, df)
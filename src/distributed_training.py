@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import argparse
+import logging
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from step4_ModelTraining import UNetDataset, UNET, EnergyBasedLossFunction, TrainingTesting
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+
+class DistributedTraining:
+    """Data-parallel CPU training of the UNET with DistributedDataParallel over the gloo backend.
+
+    Every rank trains on its own shard of 'UNetDataset' (DistributedSampler) and gradients are
+    averaged by DDP during the backward pass. Only rank 0 writes the checkpoint and the metrics.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.training_params = params['Training']
+        self.distributed_params = self.training_params['Distributed']
+
+    def setup(self, rank, world_size):
+        os.environ.setdefault('MASTER_ADDR', self.distributed_params['Master_Address'])
+        os.environ.setdefault('MASTER_PORT', str(self.distributed_params['Master_Port']))
+        dist.init_process_group(self.distributed_params['Backend'], rank=rank, world_size=world_size)
+
+        # Splitting the cores of the node between the local ranks so that they do not oversubscribe it
+        local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', world_size))
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // local_world_size))
+
+    def dataloader(self, data, rank, world_size, shuffle):
+        from torchvision import transforms
+
+        dataset = UNetDataset(os.path.join('Final_Dataset', data, 'Input'), os.path.join('Final_Dataset', data, 'Output'),
+                              transform=transforms.Compose([transforms.ToTensor()]))
+        sampler = DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=shuffle)
+
+        # batch size is per rank, the global batch is batch size x world size
+        return DataLoader(dataset, batch_size=self.training_params['Batch_Size'], sampler=sampler), sampler
+
+    def evaluate(self, dataloader, model, loss_fn):
+        """Averages the loss over the whole split, summing the per-rank results with all_reduce."""
+
+        model.eval()
+        totals = torch.zeros(2, dtype=torch.float64)
+        with torch.no_grad():
+            for X, y in dataloader:
+                totals[0] += loss_fn(model(X), y).item()
+                totals[1] += 1
+
+        dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+        return (totals[0] / totals[1]).item() if totals[1] > 0 else float('nan')
+
+    def save_checkpoint(self, model):
+        model_folder = self.params['Model']['Model_Folder']
+        Utility().create_folder(model_folder)
+
+        # Saving the wrapped model so that the checkpoint loads into a plain UNET
+        tmp_path = os.path.join(model_folder, self.params['Model']['Model_Name'] + '.tmp')
+        torch.save(model.module.state_dict(), tmp_path)
+        os.replace(tmp_path, os.path.join(model_folder, self.params['Model']['Model_Name']))
+
+    def write_metrics(self, metrics):
+        metrics_folder_name = self.params['Model']['Metrics']['Metrics_Folder']
+        metrics_file_name = self.params['Model']['Metrics']['Metrics_File']
+
+        Utility().create_folder(metrics_folder_name)
+
+        with open(os.path.join(metrics_folder_name, metrics_file_name), 'w') as json_file:
+            json.dump(metrics, json_file, indent=4)
+
+    def run(self, rank, world_size):
+        """Training loop of one rank."""
+
+        self.setup(rank, world_size)
+        try:
+            torch.manual_seed(0)  # identical initial weights on every rank
+            model = UNET.from_architecture(self.params['Model']['Architecture'])
+            model = DistributedDataParallel(model.enable_gradient_checkpointing(self.training_params['Gradient_Checkpointing']))
+            optimizer = torch.optim.Adam(model.parameters(), lr=self.training_params['Learning_Rate'], betas=(0.9, 0.999),
+                                         eps=1e-8, weight_decay=self.training_params['Weight_Decay'])
+            loss_fn = EnergyBasedLossFunction()
+
+            train_loader, train_sampler = self.dataloader('train', rank, world_size, shuffle=True)
+            has_validation = os.path.exists(os.path.join('Final_Dataset', 'validation', 'Input'))
+            if has_validation:
+                validation_loader, _ = self.dataloader('validation', rank, world_size, shuffle=False)
+
+            for epoch in range(self.training_params['Epochs']):
+                # Reshuffling differently at every epoch while keeping the shards disjoint
+                train_sampler.set_epoch(epoch)
+
+                started = time.time()
+                if rank == 0:
+                    print(f"Epoch {epoch + 1}\n-------------------------")
+                TrainingTesting().train(train_loader, model, loss_fn, optimizer, verbose=(rank == 0))
+                epoch_time = time.time() - started
+
+                metrics = {'epoch': epoch + 1, 'world_size': world_size, 'epoch_seconds': epoch_time,
+                           'samples_per_second': len(train_loader.dataset) / epoch_time}
+                if has_validation:
+                    metrics['weighted_MSE'] = self.evaluate(validation_loader, model, loss_fn)
+
+                if rank == 0:
+                    self.save_checkpoint(model)
+                    self.write_metrics(metrics)
+                    logger.info(f'Epoch {epoch + 1} done in {epoch_time:.1f} s: {metrics}')
+
+                # Keeping the ranks in step so that no rank reads a half-written checkpoint
+                dist.barrier()
+
+        finally:
+            dist.destroy_process_group()
+
+
+def spawned_rank(rank, world_size, params):
+    DistributedTraining(params).run(rank, world_size)
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Model_Training = params['Logs']['Model_Training']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Model_Training))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    parser = argparse.ArgumentParser(description='Data-parallel CPU training of the UNET (DDP over gloo).')
+    parser.add_argument('--nproc', type=int, default=params['Training']['Distributed']['Processes'],
+                        help='Number of ranks to start on this machine (ignored when launched by torchrun)')
+    args = parser.parse_args()
+
+    if 'RANK' in os.environ:
+        # Launched by torchrun, possibly on several nodes: the launcher provides the rank and the rendezvous
+        DistributedTraining(params).run(int(os.environ['RANK']), int(os.environ['WORLD_SIZE']))
+    else:
+        mp.spawn(spawned_rank, args=(args.nproc, params), nprocs=args.nproc, join=True)
+
+    logger.info('Distributed training finished.')
@@ -0,0 +1,294 @@
+import os
+import time
+import argparse
+import logging
+import threading
+import numpy as np
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+SRC_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Layout of the training figure measured by 'measure_frame', shipped with the sources
+FRAME_FILE = os.path.join(SRC_FOLDER, 'figure_frame.npz')
+
+# Frames loaded by this process, by path: (file stat, frame)
+_frames = dict()
+_frames_lock = threading.Lock()
+
+
+def blend_black(pixels, cover):
+    """Agg's blending of an opaque black line with coverage 'cover' (0-255) over opaque RGB pixels."""
+
+    pixels = pixels.astype(np.int64)
+    return pixels * 255 * (256 - cover) // (65280 + cover)
+
+
+def tap_weights(row_weights, col_weights):
+    """Agg's weights (14-bit fixed point) of the (2 x 2) taps of every pixel from the filter weights of its rows and columns."""
+
+    row_weights, col_weights = np.asarray(row_weights, dtype=np.int64), np.asarray(col_weights, dtype=np.int64)
+    return (row_weights[:, None, :, None] * col_weights[None, :, None, :] + 8192) >> 14
+
+
+def render_plot_area(spectrogram, frame):
+    """Pixels of the plot area of the training figure, before the axes spines are drawn over it.
+
+    The spectrogram is normalized to its own range and mapped through the 'viridis' lookup
+    table in float32 as matplotlib does, then resampled with the fixed Hanning taps of the
+    figure, with Agg's integer weights and summation order so that it rounds the same way.
+    """
+
+    values = np.asarray(spectrogram).astype(np.float32)
+    vmin, vmax = float(values.min()), float(values.max())
+    if vmin == vmax:
+        # Widened by the colorbar of the figure ('matplotlib.transforms.nonsingular'), a flat image is mid-range
+        vmin, vmax = (-0.1, 0.1) if vmax == 0 else (vmin - 0.1 * abs(vmin), vmax + 0.1 * abs(vmax))
+    vmin, vmax = np.float32(vmin), np.float32(vmax)
+    values = (values - vmin) / (vmax - vmin)
+
+    lut = frame['lut']
+    indices = values * np.float32(len(lut))
+    indices[indices == len(lut)] = len(lut) - 1
+    colors = lut[indices.astype(np.intp)].reshape(-1, 3)
+
+    plot = np.zeros(frame['total_weight'].shape + (3,))
+    for taps, weights in zip(frame['taps'], frame['weights']):
+        plot += colors[taps] * weights[..., None]
+
+    return (plot / frame['total_weight'][..., None] * 255).astype(np.uint8)
+
+
+def render_figure(spectrogram, frame):
+    """RGB pixels (uint8) of 'DataLoadingProcessing.render_spectrogram_png(spectrogram, show_axis=True)', without matplotlib.
+
+    Everything outside the plot area is the same for every spectrogram and is copied from the
+    frame; the spines are blended over the edges of the plot area as Agg draws them.
+
+    Parameters
+    -----------
+
+    spectrogram: (513 x 513) uint8 array, as given to 'render_spectrogram_png'
+    frame: Layout returned by 'load_frame'
+    """
+
+    plot = render_plot_area(spectrogram, frame)
+    for rows, cols, cover in frame['spine_passes']:
+        plot[rows, cols] = blend_black(plot[rows, cols], cover[:, None])
+
+    top, left = frame['origin']
+    pixels = frame['background'].copy()
+    pixels[top:top + plot.shape[0], left:left + plot.shape[1]] = plot
+    return pixels
+
+
+def prepare_frame(arrays):
+    """Frame used by 'render_figure' from the arrays of a layout file."""
+
+    # Flat source index and integer weight of the four taps of every plot pixel, in Agg's summation order
+    rows, cols = arrays['rows'].astype(np.intp), arrays['cols'].astype(np.intp)
+    num_cols = int(arrays['source_shape'][1])
+    all_weights = tap_weights(arrays['row_weights'], arrays['col_weights']).astype(np.float64)
+    taps, weights = list(), list()
+    for a in range(2):
+        for b in range(2):
+            taps.append(rows[a][:, None] * num_cols + cols[b][None, :])
+            weights.append(all_weights[a, b])
+
+    spine_passes = list()
+    for cover in arrays['spine_cover']:
+        covered_rows, covered_cols = np.nonzero(cover)
+        spine_passes.append((covered_rows, covered_cols, cover[covered_rows, covered_cols].astype(np.int64)))
+
+    return {'background': arrays['background'], 'origin': tuple(int(v) for v in arrays['origin']), 'lut': arrays['lut'],
+            'taps': taps, 'weights': weights, 'total_weight': np.sum(weights, axis=0), 'spine_passes': spine_passes}
+
+
+def load_frame(path=FRAME_FILE):
+    """Layout written by 'save_frame', cached per process and reloaded when the file is replaced."""
+
+    stat = (os.stat(path).st_mtime_ns, os.stat(path).st_size)
+
+    with _frames_lock:
+        cached = _frames.get(path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        with np.load(path) as arrays:
+            frame = prepare_frame(dict(arrays))
+
+        _frames[path] = (stat, frame)
+        return frame
+
+
+def save_frame(arrays, path=FRAME_FILE):
+    tmp_path = path + '.tmp.npz'
+    np.savez_compressed(tmp_path, **arrays)
+    os.replace(tmp_path, path)
+
+
+def measure_frame(num_checks=8, seed=0):
+    """Measures the layout of the training figure with matplotlib, for 'save_frame'.
+
+    The figure is rendered once with a recording of the Agg resampling of its plot area,
+    whose taps and weights are then probed with synthetic images; the placement of the plot
+    area and the coverage of the spines are fitted on a few random spectrograms. The layout
+    is checked against 'render_spectrogram_png' on 'num_checks' other spectrograms.
+
+    The layout depends on the matplotlib version (fonts, tick placement, Agg), so it has to
+    be measured again when matplotlib is upgraded; 'benchmarks/figure_frame.py' tells when.
+    """
+    import io
+    from PIL import Image
+    from matplotlib import _image, colormaps
+    from step2_DatasetLoading import DataLoadingProcessing
+
+    dlp = DataLoadingProcessing()
+    rng = np.random.default_rng(seed)
+    shape = (513, 513)
+
+    def render_png(spectrogram):
+        return np.asarray(Image.open(io.BytesIO(dlp.render_spectrogram_png(spectrogram, show_axis=True))).convert('RGB'))
+
+    # Arguments of the resampling of the plot area
+    calls, resample = list(), _image.resample
+
+    def recording_resample(data, out, *args):
+        resample(data, out, *args)
+        calls.append((out.shape, args))
+
+    _image.resample = recording_resample
+    try:
+        background = render_png(np.zeros(shape, dtype=np.uint8))
+    finally:
+        _image.resample = resample
+    out_shape, resample_args = calls[-1]
+
+    def probe(channels):
+        data = np.ones(shape + (4,))
+        data[..., :len(channels)] = np.stack(channels, axis=-1)
+        out = np.zeros(out_shape)
+        resample(data, out, *resample_args)
+        return out[..., :len(channels)]
+
+    # Source row and column of the taps: a plot pixel sits between two source rows and two source columns
+    row_index, col_index = np.indices(shape) / 1024
+    positions = probe([row_index, col_index]) * 1024
+    rows = np.minimum(np.floor(positions[:, 0, 0] + 1e-6).astype(np.int64), shape[0] - 2)
+    cols = np.minimum(np.floor(positions[0, :, 1] + 1e-6).astype(np.int64), shape[1] - 2)
+    rows, cols = np.stack([rows, rows + 1]), np.stack([cols, cols + 1])
+
+    # Normalized weight of every tap, probed by the parity of its row and column
+    row_parity, col_parity = np.indices(shape) % 2
+    parity_masks = [(row_parity == p) & (col_parity == q) for p in range(2) for q in range(2)]
+    probed = np.concatenate([probe(parity_masks[:3]), probe(parity_masks[3:])], axis=-1)
+    normalized = np.empty((2, 2) + out_shape[:2])
+    for a in range(2):
+        for b in range(2):
+            channel = (rows[a] % 2)[:, None] * 2 + (cols[b] % 2)[None, :]
+            normalized[a, b] = np.take_along_axis(probed, channel[..., None], axis=-1)[..., 0]
+
+    # Agg sums integer weights (their total is not always the filter scale), recovered from the normalized ones
+    # with the total closest to the filter scale (weights of 0.5 fit any even total)
+    weights = np.zeros((2, 2) + out_shape[:2], dtype=np.int64)
+    found = np.zeros(out_shape[:2], dtype=bool)
+    for total in sorted(range(16376, 16393), key=lambda total: abs(total - 16384)):
+        candidate = np.round(normalized * total).astype(np.int64)
+        fits = (np.abs(normalized * total - candidate) < 1e-6).all(axis=(0, 1)) & (candidate.sum(axis=(0, 1)) == total) & ~found
+        weights[:, :, fits] = candidate[:, :, fits]
+        found |= fits
+    if not found.all():
+        raise RuntimeError(f'No integer weights for {np.count_nonzero(~found)} pixels of the plot area.')
+
+    # Product of a row and a column filter weight, both read where the other one is a single full weight tap
+    single_rows, single_cols = np.argwhere((weights == 0).all(axis=(1, 3))), np.argwhere((weights == 0).all(axis=(0, 2)))
+    if not len(single_rows) or not len(single_cols):
+        raise RuntimeError('No row or column of the plot area falls on a single source pixel.')
+    (a, y), (b, x) = single_rows[0], single_cols[0]
+    row_weights, col_weights = weights[:, 1 - b, :, x], weights[1 - a, :, y, :]
+    if not (tap_weights(row_weights, col_weights) == weights).all():
+        raise RuntimeError('The resampling weights of the plot area are not separable.')
+
+    cmap = colormaps['viridis']
+    # Agg fills the plot area from its bottom row, the PNG starts with its top row
+    arrays = {'background': background, 'lut': cmap(np.arange(cmap.N))[:, :3], 'source_shape': np.array(shape),
+              'rows': rows[:, ::-1].astype(np.int16), 'cols': cols.astype(np.int16),
+              'row_weights': row_weights[:, ::-1].astype(np.uint16), 'col_weights': col_weights.astype(np.uint16),
+              'origin': np.zeros(2, dtype=np.int64), 'spine_cover': np.zeros((2,) + out_shape[:2], dtype=np.uint8)}
+
+    # Placement of the plot area: the only offset where the inside of the plot area matches
+    frame = prepare_frame(arrays)
+    samples = [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(4)]
+    # Bright and dark plot areas, so that only one coverage fits every spine pixel
+    for level in (0, 255):
+        samples.append(np.full(shape, level, dtype=np.uint8))
+        samples[-1][0, 0] = 255 - level
+    pngs = [render_png(spectrogram) for spectrogram in samples]
+    plots = [render_plot_area(spectrogram, frame) for spectrogram in samples]
+    height, width = out_shape[:2]
+    center = (slice(height // 2 - 16, height // 2 + 16), slice(width // 2 - 16, width // 2 + 16))
+    origins = [(top, left) for top in range(background.shape[0] - height + 1) for left in range(background.shape[1] - width + 1)
+               if all((png[top:top + height, left:left + width][center] == plot[center]).all() for png, plot in zip(pngs, plots))]
+    if len(origins) != 1:
+        raise RuntimeError(f'The plot area matches the figure at {len(origins)} places.')
+    top, left = arrays['origin'] = np.array(origins[0])
+
+    # Coverage of the spines, blended once or twice (corners) over the pixels they cross
+    drawn = np.stack([png[top:top + height, left:left + width] for png in pngs]).astype(np.int64)
+    plots = np.stack(plots).astype(np.int64)
+    covered_rows, covered_cols = np.nonzero((drawn != plots).any(axis=(0, 3)))
+    covers = np.arange(256)
+    for row, col in zip(covered_rows, covered_cols):
+        before, after = plots[:, row, col], drawn[:, row, col]
+        once = [cover for cover in covers if (blend_black(before, cover) == after).all()]
+        if once:
+            arrays['spine_cover'][0, row, col] = once[0]
+            continue
+
+        twice = [(first, second) for first in covers[1:] for second in covers[1:]
+                 if (blend_black(blend_black(before, first), second) == after).all()]
+        if not twice:
+            raise RuntimeError(f'No spine coverage fits the pixel ({row}, {col}) of the plot area.')
+        arrays['spine_cover'][:, row, col] = twice[0]
+
+    # The layout has to reproduce figures it was not fitted on
+    frame = prepare_frame(arrays)
+    checks = [np.zeros(shape, dtype=np.uint8), np.tile(np.arange(513, dtype=np.uint8), (513, 1))]
+    checks += [rng.integers(0, 256, shape, dtype=np.uint8) for _ in range(num_checks)]
+    for spectrogram in checks:
+        mismatches = np.count_nonzero((render_figure(spectrogram, frame) != render_png(spectrogram)).any(axis=-1))
+        if mismatches:
+            raise RuntimeError(f'The measured layout differs from the matplotlib figure on {mismatches} pixels.')
+
+    return arrays
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Data_Restructuring_Processing = params['Logs']['Data_Restructuring_Processing']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Data_Restructuring_Processing))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    parser = argparse.ArgumentParser(description='Measures the layout of the training figure so that model inputs are built without matplotlib.')
+    parser.add_argument('--output', default=FRAME_FILE, help='Layout file to write')
+    parser.add_argument('--checks', type=int, default=8, help='Random spectrograms the layout is checked on')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    save_frame(measure_frame(num_checks=args.checks), args.output)
+    logger.info(f"Figure layout written to '{args.output}' in {time.perf_counter() - started:.2f} s.")
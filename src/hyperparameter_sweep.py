@@ -0,0 +1,324 @@
+import os
+import csv
+import json
+import time
+import random
+import argparse
+import itertools
+import logging
+import multiprocessing
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Hyperparameters a trial can override, with the names they have in params.yaml: training
+# hyperparameters (Training section) and model architecture (Model/Architecture section)
+TRAINING_KEYS = ['Learning_Rate', 'Weight_Decay', 'Batch_Size', 'Epochs']
+ARCHITECTURE_KEYS = ['Base_Width', 'Depth', 'Block_Type']
+TRIAL_KEYS = TRAINING_KEYS + ARCHITECTURE_KEYS
+
+
+class DatasetCache:
+    """Decoded copy of a split of 'Final_Dataset' shared by all the trials of a sweep.
+
+    The spectrogram and mask images are decoded once into two uint8 arrays, inputs of shape
+    (tracks, 1, 512, 512) and targets of shape (tracks, 5, 512, 512), which the trials
+    memory-map read-only: concurrent trials share one copy in the page cache and none of them
+    decodes a PNG.
+    """
+
+    def __init__(self, cache_folder='Sweep_Cache', dataset_folder='Final_Dataset'):
+        self.cache_folder = cache_folder
+        self.dataset_folder = dataset_folder
+
+    def paths(self, data):
+        return (os.path.join(self.cache_folder, f'{data}_inputs.npy'),
+                os.path.join(self.cache_folder, f'{data}_targets.npy'))
+
+    def build(self, data):
+        """Decodes a split into the cache unless it is already there and not older than the split."""
+        from step4_ModelTraining import UNetDataset
+
+        inputs_path, targets_path = self.paths(data)
+        input_dir = os.path.join(self.dataset_folder, data, 'Input')
+        output_dir = os.path.join(self.dataset_folder, data, 'Output')
+
+        if os.path.exists(targets_path) and os.path.getmtime(targets_path) >= os.path.getmtime(input_dir):
+            return
+
+        Utility().create_folder(self.cache_folder)
+        dataset = UNetDataset(input_dir, output_dir)
+        input_image, output_tensor = dataset[0]
+
+        inputs = np.lib.format.open_memmap(inputs_path + '.tmp.npy', mode='w+', dtype=np.uint8, shape=(len(dataset),) + tuple(input_image.shape))
+        targets = np.lib.format.open_memmap(targets_path + '.tmp.npy', mode='w+', dtype=np.uint8, shape=(len(dataset),) + tuple(output_tensor.shape))
+        for index in range(len(dataset)):
+            input_image, output_tensor = dataset[index]
+            # ToTensor divided the 8 bit pixels by 255, so this is lossless
+            inputs[index] = (input_image * 255).round().byte().numpy()
+            targets[index] = (output_tensor * 255).round().byte().numpy()
+
+        inputs.flush()
+        targets.flush()
+        del inputs, targets
+        os.replace(inputs_path + '.tmp.npy', inputs_path)
+        os.replace(targets_path + '.tmp.npy', targets_path)
+
+        logger.info(f'{len(dataset)} tracks of {data} decoded into the sweep cache.')
+
+    def dataset(self, data):
+        inputs_path, targets_path = self.paths(data)
+        return CachedSplitDataset(np.load(inputs_path, mmap_mode='r'), np.load(targets_path, mmap_mode='r'))
+
+
+class CachedSplitDataset(Dataset):
+    """Items of a memory-mapped 'DatasetCache' split, as the float tensors 'UNetDataset' returns."""
+
+    def __init__(self, inputs, targets):
+        self.inputs = inputs
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __getitem__(self, idx):
+        return (torch.from_numpy(self.inputs[idx].astype(np.float32) / 255),
+                torch.from_numpy(self.targets[idx].astype(np.float32) / 255))
+
+
+def run_trial(trial_id, config, cores, cache_folder, sweep_folder):
+    """Trains one configuration, reporting the validation loss after every epoch.
+
+    Runs in its own process, pinned to 'cores'. The report file is rewritten after every
+    epoch; the runner reads it to decide whether to stop the trial.
+    """
+    from torch.utils.data import DataLoader
+    from step4_ModelTraining import UNET, EnergyBasedLossFunction, TrainingTesting
+
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+    torch.manual_seed(0)
+
+    dataset_cache = DatasetCache(cache_folder)
+    train_loader = DataLoader(dataset_cache.dataset('train'), batch_size=config['Batch_Size'], shuffle=True)
+    validation_loader = DataLoader(dataset_cache.dataset('validation'), batch_size=config['Batch_Size'])
+
+    model = UNET.from_architecture({key: config[key] for key in ARCHITECTURE_KEYS})
+    optimizer = torch.optim.Adam(model.parameters(), lr=config['Learning_Rate'], betas=(0.9, 0.999), eps=1e-8, weight_decay=config['Weight_Decay'])
+    loss_fn = EnergyBasedLossFunction()
+
+    report = {'trial': trial_id, 'config': config, 'cores': list(cores), 'validation_losses': list(), 'started': time.time()}
+    report_path = os.path.join(sweep_folder, f'trial_{trial_id:03d}.json')
+
+    for _ in range(config['Epochs']):
+        TrainingTesting().train(train_loader, model, loss_fn, optimizer, verbose=False)
+
+        model.eval()
+        total_loss = 0.0
+        with torch.no_grad():
+            for X, y in validation_loader:
+                total_loss += loss_fn(model(X), y).item()
+        report['validation_losses'].append(total_loss / max(1, len(validation_loader)))
+
+        # Keeping the weights of the best epoch so that the winning trial does not need retraining
+        if report['validation_losses'][-1] == min(report['validation_losses']):
+            weights_path = os.path.join(sweep_folder, f'trial_{trial_id:03d}.pth')
+            torch.save(model.state_dict(), weights_path + '.tmp')
+            os.replace(weights_path + '.tmp', weights_path)
+
+        with open(report_path + '.tmp', 'w') as report_file:
+            json.dump(report, report_file)
+        os.replace(report_path + '.tmp', report_path)
+
+
+class HyperparameterSweep:
+    """Runs the trials of a search space concurrently, each on its own set of cores.
+
+    Trials read the shared 'DatasetCache'. A running trial is stopped (median stopping rule)
+    when its validation loss after an epoch is worse than the median loss of the trials that
+    reached that epoch, once at least 'Min_Trials' of them have and the trial has trained for
+    'Min_Epochs' epochs.
+    """
+
+    def __init__(self, params):
+        self.params = params
+        self.sweep_params = params['Sweep']
+        self.sweep_folder = self.sweep_params['Sweep_Folder']
+        self.cache_folder = self.sweep_params['Cache_Folder']
+
+    def trial_configs(self):
+        """Configurations to try: the grid of the search space, or a random sample of it."""
+
+        defaults = {key: self.params['Training'][key] for key in TRAINING_KEYS}
+        defaults.update({key: self.params['Model']['Architecture'][key] for key in ARCHITECTURE_KEYS})
+        search_space = self.sweep_params['Search_Space']
+        names = list(search_space)
+
+        grid = [dict(defaults, **dict(zip(names, values))) for values in itertools.product(*(search_space[name] for name in names))]
+
+        num_trials = self.sweep_params.get('Num_Trials')
+        if self.sweep_params['Strategy'] == 'random' and num_trials and num_trials < len(grid):
+            grid = random.Random(self.sweep_params.get('Seed', 0)).sample(grid, num_trials)
+
+        return grid
+
+    def core_sets(self, concurrent_trials):
+        """Splits the cores available to this process into one disjoint set per concurrent trial."""
+
+        cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        concurrent_trials = max(1, min(concurrent_trials, len(cores)))
+        cores_per_trial = len(cores) // concurrent_trials
+
+        return [cores[slot * cores_per_trial:(slot + 1) * cores_per_trial] for slot in range(concurrent_trials)]
+
+    def clear_trials(self):
+        """Removes the reports and weights of the trials of an earlier sweep, which reuse the same trial ids."""
+
+        for file_name in os.listdir(self.sweep_folder):
+            if file_name.startswith('trial_') and file_name.partition('.')[2] in ('json', 'pth', 'json.tmp', 'pth.tmp'):
+                os.remove(os.path.join(self.sweep_folder, file_name))
+
+    def read_report(self, trial_id, started=None):
+        """Last report of a trial, None if it has not reported yet (or only before 'started', i.e. in an earlier sweep)."""
+
+        report_path = os.path.join(self.sweep_folder, f'trial_{trial_id:03d}.json')
+        if not os.path.exists(report_path):
+            return None
+
+        with open(report_path, 'r') as report_file:
+            report = json.load(report_file)
+
+        if started is not None and report['started'] < started:
+            return None
+        return report
+
+    def should_stop(self, trial_id, reports):
+        """Median stopping rule on the last epoch reported by the trial."""
+
+        losses = reports[trial_id]['validation_losses'] if reports.get(trial_id) else list()
+        epoch = len(losses)
+        if epoch < self.sweep_params['Early_Stopping']['Min_Epochs']:
+            return False
+
+        others = [report['validation_losses'][epoch - 1] for other_id, report in reports.items()
+                  if other_id != trial_id and report and len(report['validation_losses']) >= epoch]
+        if len(others) < self.sweep_params['Early_Stopping']['Min_Trials']:
+            return False
+
+        return losses[-1] > np.median(others)
+
+    def run(self, concurrent_trials=None):
+        """Runs the whole sweep and writes the results table.
+
+        Returns
+        --------
+        List of the result rows, best trial first
+        """
+
+        concurrent_trials = concurrent_trials or self.sweep_params['Concurrent_Trials']
+        Utility().create_folder(self.sweep_folder)
+        self.clear_trials()
+
+        # Decoding the dataset once, before any trial starts
+        dataset_cache = DatasetCache(self.cache_folder, self.params['Data']['Final_Dataset'])
+        dataset_cache.build('train')
+        dataset_cache.build('validation')
+
+        configs = self.trial_configs()
+        free_slots = self.core_sets(concurrent_trials)
+        pending = list(enumerate(configs))
+        running = dict()  # trial id -> (process, core set)
+        status, seconds, reports = dict(), dict(), dict()
+        started = dict()
+
+        # Trials start with 'spawn' so that they do not inherit the state of the runner
+        context = multiprocessing.get_context('spawn')
+        logger.info(f'{len(configs)} trials, {len(free_slots)} at a time on {len(free_slots[0])} cores each.')
+
+        while pending or running:
+            while pending and free_slots:
+                trial_id, config = pending.pop(0)
+                cores = free_slots.pop(0)
+                process = context.Process(target=run_trial, args=(trial_id, config, cores, self.cache_folder, self.sweep_folder))
+                process.start()
+                running[trial_id] = (process, cores)
+                started[trial_id] = time.time()
+                logger.info(f'Trial {trial_id} started on cores {cores}: {config}')
+
+            time.sleep(self.sweep_params['Poll_Interval'])
+
+            for trial_id in list(running):
+                reports[trial_id] = self.read_report(trial_id, started[trial_id])
+                process, cores = running[trial_id]
+
+                if not process.is_alive():
+                    status[trial_id] = 'completed' if process.exitcode == 0 else f'failed ({process.exitcode})'
+                elif self.should_stop(trial_id, reports):
+                    process.terminate()
+                    process.join()
+                    status[trial_id] = 'stopped'
+                else:
+                    continue
+
+                process.join()
+                reports[trial_id] = self.read_report(trial_id, started[trial_id])
+                seconds[trial_id] = time.time() - started[trial_id]
+                free_slots.append(cores)
+                del running[trial_id]
+                logger.info(f'Trial {trial_id} {status[trial_id]} after {seconds[trial_id]:.0f} s.')
+
+        rows = list()
+        for trial_id, config in enumerate(configs):
+            losses = (reports.get(trial_id) or {}).get('validation_losses', list())
+            rows.append(dict(trial=trial_id, **config, status=status[trial_id], epochs_run=len(losses),
+                             best_validation_loss=min(losses) if losses else float('nan'),
+                             seconds=round(seconds[trial_id], 1)))
+
+        rows.sort(key=lambda row: (np.isnan(row['best_validation_loss']), row['best_validation_loss']))
+        self.write_results(rows)
+        return rows
+
+    def write_results(self, rows):
+        results_path = os.path.join(self.sweep_folder, 'results.csv')
+        with open(results_path, 'w', newline='') as results_file:
+            writer = csv.DictWriter(results_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+        print(f"{'trial':>5} " + ' '.join(f'{key:>13}' for key in TRIAL_KEYS) + f" {'status':>12} {'epochs':>6} {'val loss':>10} {'seconds':>8}")
+        for row in rows:
+            print(f"{row['trial']:>5} " + ' '.join(f'{row[key]:>13}' for key in TRIAL_KEYS)
+                  + f" {row['status']:>12} {row['epochs_run']:>6} {row['best_validation_loss']:>10.5f} {row['seconds']:>8}")
+
+        logger.info(f'Sweep results written to {results_path}.')
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Model_Training = params['Logs']['Model_Training']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Model_Training))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    parser = argparse.ArgumentParser(description='Runs a hyperparameter sweep of the UNET training, several trials at a time.')
+    parser.add_argument('--concurrent', type=int, default=None, help='Number of trials run at the same time (params.yaml by default)')
+    args = parser.parse_args()
+
+    HyperparameterSweep(params).run(args.concurrent)
@@ -0,0 +1,254 @@
+import os
+import sys
+import json
+import time
+import functools
+import logging
+import threading
+import tracemalloc
+import multiprocessing.util
+from contextlib import contextmanager, nullcontext
+
+logger = logging.getLogger(__name__)
+
+# Monitor of this process, None while the instrumentation is disabled (see 'enable')
+_monitor = None
+
+
+def resident_set_size():
+    """Current RSS of this process in bytes (Linux /proc, 0 elsewhere)."""
+
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return 0
+
+
+class MemoryMonitor:
+    """Records the peak memory of named stages of the pipeline, per track, and enforces budgets.
+
+    Every stage ('with monitor.stage(name)') gets one record with its duration and:
+      'rss_start', 'rss_peak': RSS of the process when the stage started and its highest sampled
+          value during the stage (sampled every 'sample_interval' seconds by a background thread)
+      'traced_peak': peak of the Python allocations (numpy arrays included) above the level at
+          the start of the stage, from tracemalloc, if 'trace_python'
+      'cuda_peak': peak of the torch CUDA allocator during the stage, if a GPU is in use
+
+    Stages can be nested; the track being processed ('with monitor.track(track_id)') is added
+    to the records of the stages run inside it by the same thread. The CUDA peak counter is
+    global, so it is read and reset at every stage boundary and credited to all the stages
+    active at that moment, like the tracemalloc peak: an outer stage keeps the peaks of its
+    nested stages.
+
+    A stage with a budget (bytes) in 'budgets' can be run in chunks: 'chunk_size' returns the
+    number of items per chunk, resized after every record of that stage from the memory used
+    per item so that the next chunks stay within the budget.
+    """
+
+    def __init__(self, budgets=None, sample_interval=0.005, trace_python=True):
+        self.budgets = budgets or dict()
+        self.sample_interval = sample_interval
+        self.trace_python = trace_python
+
+        self.records = list()
+        self.chunk_sizes = dict()  # stage -> (current chunk size, default chunk size)
+        self.active = list()  # records of the stages in progress, updated by the sampler
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+        if trace_python and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+        self.sampler = threading.Thread(target=self.sample, daemon=True)
+        self.sampler.start()
+
+    def flush_peaks(self, torch=None):
+        """Credits the peaks since the last flush to every active stage. Called with the lock held.
+
+        The CUDA peak is only flushed when 'torch' is given (at the stage boundaries, not by
+        the sampler thread).
+        """
+
+        rss = resident_set_size()
+        traced = None
+        if self.trace_python:
+            traced = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+
+        cuda_peak = None
+        if torch is not None:
+            cuda_peak = torch.cuda.max_memory_allocated()
+            torch.cuda.reset_peak_memory_stats()
+
+        for record in self.active:
+            record['rss_peak'] = max(record['rss_peak'], rss)
+            if traced is not None:
+                record['traced_peak'] = max(record['traced_peak'], traced - record['traced_start'])
+            if cuda_peak is not None:
+                record['cuda_peak'] = max(record['cuda_peak'] or 0, cuda_peak)
+
+    def sample(self):
+        while True:
+            time.sleep(self.sample_interval)
+            with self.lock:
+                if self.active:
+                    self.flush_peaks()
+
+    @contextmanager
+    def track(self, track_id):
+        previous = getattr(self.local, 'track', None)
+        self.local.track = str(track_id)
+        try:
+            yield
+        finally:
+            self.local.track = previous
+
+    def cuda_torch(self):
+        """The torch module if this process uses a GPU, else None (torch is not imported by processes that do not use it)."""
+
+        torch = sys.modules.get('torch')
+        if torch is not None and torch.cuda.is_available() and torch.cuda.is_initialized():
+            return torch
+        return None
+
+    @contextmanager
+    def stage(self, name, items=None):
+        """Records the memory of the code run inside it under 'name' ('items': chunk size, if chunked)."""
+
+        with self.lock:
+            self.flush_peaks(self.cuda_torch())
+            record = {'stage': name, 'track': getattr(self.local, 'track', None), 'items': items,
+                      'rss_start': resident_set_size(), 'rss_peak': 0, 'traced_peak': 0,
+                      'traced_start': tracemalloc.get_traced_memory()[0] if self.trace_python else 0,
+                      'cuda_peak': None, 'started': time.perf_counter()}
+            record['rss_peak'] = record['rss_start']
+            self.active.append(record)
+
+        try:
+            yield record
+        finally:
+            with self.lock:
+                self.flush_peaks(self.cuda_torch())
+                self.active.remove(record)
+
+            record['seconds'] = time.perf_counter() - record.pop('started')
+            record.pop('traced_start')
+
+            self.records.append(record)
+            self.resize_chunks(record)
+
+    def stage_peak(self, record):
+        """Memory used by a stage: the larger of its RSS growth, traced peak and CUDA peak."""
+
+        return max(record['rss_peak'] - record['rss_start'], record['traced_peak'], record['cuda_peak'] or 0)
+
+    def chunk_size(self, name, default, minimum=1):
+        """Number of items to process at once in stage 'name' (the default until a budget is exceeded)."""
+
+        if name not in self.budgets:
+            return default
+
+        size, _ = self.chunk_sizes.setdefault(name, (default, default))
+        return max(minimum, size)
+
+    def resize_chunks(self, record):
+        name = record['stage']
+        if name not in self.budgets or not record['items'] or name not in self.chunk_sizes:
+            return
+
+        size, default = self.chunk_sizes[name]
+        per_item = self.stage_peak(record) / record['items']
+        if per_item <= 0:
+            return
+
+        new_size = int(max(1, min(default, self.budgets[name] // per_item)))
+        if new_size != size:
+            logger.info(f"Stage '{name}' used {self.stage_peak(record) / 2**20:.0f} MB for {record['items']} item(s) "
+                        f"(budget {self.budgets[name] / 2**20:.0f} MB): chunk size {size} -> {new_size}.")
+            self.chunk_sizes[name] = (new_size, default)
+
+    def summary(self):
+        """Per stage: number of records, total seconds, and the largest peaks over all its records."""
+
+        stages = dict()
+        for record in self.records:
+            summary = stages.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'max_rss_peak': 0,
+                                                          'max_stage_peak': 0, 'max_traced_peak': 0})
+            summary['count'] += 1
+            summary['seconds'] += record['seconds']
+            summary['max_rss_peak'] = max(summary['max_rss_peak'], record['rss_peak'])
+            summary['max_stage_peak'] = max(summary['max_stage_peak'], self.stage_peak(record))
+            summary['max_traced_peak'] = max(summary['max_traced_peak'], record['traced_peak'])
+
+        for name, summary in stages.items():
+            summary['budget'] = self.budgets.get(name)
+            summary['chunk_size'] = self.chunk_sizes.get(name, (None,))[0]
+
+        return stages
+
+    def write_report(self, report_path):
+        """Writes the summary and all the records as JSON, through a temporary file."""
+
+        report = {'pid': os.getpid(), 'summary': self.summary(), 'records': self.records}
+
+        tmp_path = report_path + '.tmp'
+        with open(tmp_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        os.replace(tmp_path, report_path)
+
+
+def enable(memory_params, report_name=None):
+    """Turns the instrumentation on for this process from the 'Memory' section of params.yaml.
+
+    The report is written when the process exits, to 'Report_File' (or 'report_name', e.g.
+    with the worker pid for worker processes).
+
+    Returns
+    --------
+    The monitor, or None if 'Instrumentation' is off
+    """
+    global _monitor
+
+    if not memory_params.get('Instrumentation'):
+        return None
+
+    budgets = {name: int(megabytes * 2**20) for name, megabytes in (memory_params.get('Budgets_MB') or dict()).items()}
+    _monitor = MemoryMonitor(budgets, sample_interval=memory_params.get('Sample_Interval', 0.005),
+                             trace_python=memory_params.get('Tracemalloc', True))
+
+    # Unlike atexit, multiprocessing finalizers also run when a (forked) worker process exits
+    report_path = report_name or memory_params['Report_File']
+    multiprocessing.util.Finalize(None, _monitor.write_report, args=(report_path,), exitpriority=0)
+    logger.info(f'Memory instrumentation enabled, report in {report_path}.')
+
+    return _monitor
+
+
+def stage(name, items=None):
+    """'MemoryMonitor.stage' of the process monitor, a no-op while the instrumentation is disabled."""
+
+    return _monitor.stage(name, items) if _monitor is not None else nullcontext()
+
+
+def track(track_id):
+    return _monitor.track(track_id) if _monitor is not None else nullcontext()
+
+
+def chunk_size(name, default, minimum=1):
+    """'MemoryMonitor.chunk_size' of the process monitor, 'default' while the instrumentation is disabled."""
+
+    return _monitor.chunk_size(name, default, minimum) if _monitor is not None else default
+
+
+def instrumented(name):
+    """Decorator running every call of the function as the stage 'name' (see 'stage')."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
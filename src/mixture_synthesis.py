@@ -0,0 +1,189 @@
+import os
+import argparse
+import logging
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import Dataset
+from prediction_funcs import Predictions
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+
+class StemCache:
+    """Compact per-track cache of the stem magnitude spectrograms used to synthesize training mixtures.
+
+    Every track is stored as one float16 array of shape (sources, 512, 512): the linear STFT
+    magnitude of each merged instrument, average-pooled from the native STFT grid to the model
+    grid. Sources are in the order of the model output channels.
+    """
+
+    sources = Predictions.model_sources
+
+    def __init__(self, cache_folder='Stem_Cache', image_size=(512, 512), n_fft=1022, hop_length=512):
+        self.cache_folder = cache_folder
+        self.image_size = image_size
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def track_path(self, data, track):
+        return os.path.join(self.cache_folder, data, f'{track}.npy')
+
+    def stem_magnitudes(self, stems):
+        """Computes the pooled magnitude spectrograms of all the stems of a track in one batched STFT.
+
+        Parameters
+        -----------
+
+        stems: float32 array of shape (sources, samples)
+
+        Returns
+        --------
+        float16 array of shape (sources, 512, 512)
+        """
+
+        waveforms = torch.from_numpy(np.ascontiguousarray(stems))
+        stft_results = torch.stft(waveforms, n_fft=self.n_fft, hop_length=self.hop_length, win_length=self.n_fft,
+                                  window=torch.hann_window(self.n_fft), return_complex=True)
+
+        magnitudes = nn.functional.adaptive_avg_pool2d(stft_results.abs().unsqueeze(0), self.image_size)[0]
+        return magnitudes.numpy().astype(np.float16)
+
+    def build(self, df, tracks, data='train'):
+        """Decodes the stems of every track once and caches their magnitudes.
+
+        Tracks already in the cache are skipped, so an interrupted build can be resumed.
+
+        Returns
+        --------
+        Number of tracks added to the cache
+        """
+        from step2_DatasetLoading import DataLoadingProcessing
+
+        dlp = DataLoadingProcessing(df)
+        instruments = ['Piano', 'Guitar', 'Bass', 'Drums', 'Others']
+        buffers = dlp.allocate_track_buffers(instruments)
+        Utility().create_folder(os.path.join(self.cache_folder, data))
+
+        # Tracks without a readable stem of a main instrument are left out from their headers, before any decoding
+        pending = [track for track in tracks if not os.path.exists(self.track_path(data, track))]
+        work_plan = dlp.plan_tracks(pending, data=data)
+
+        added = 0
+        for entry in work_plan:
+            track = entry['track']
+            if not entry['eligible']:
+                continue
+
+            stems = dlp.merge_planned_stems(entry, buffers, instruments=instruments)
+
+            magnitudes = self.stem_magnitudes(np.stack([stems[source] for source in self.sources]))
+
+            tmp_path = self.track_path(data, track) + '.tmp.npy'
+            np.save(tmp_path, magnitudes)
+            os.replace(tmp_path, self.track_path(data, track))
+            added += 1
+
+        logger.info(f'{added} tracks added to the stem cache of {data}.')
+        return added
+
+
+class StemCacheDataset(Dataset):
+    """Dataset over the stem cache returning the stems of one track per item.
+
+    The mixtures and their mask targets are synthesized per batch by 'MixtureCollator', so the
+    dataset can be given any number of examples per epoch: every draw is a new mixture.
+    """
+
+    def __init__(self, cache_folder, data='train', examples_per_epoch=None):
+        self.track_files = sorted(os.path.join(cache_folder, data, file_name)
+                                  for file_name in os.listdir(os.path.join(cache_folder, data)) if file_name.endswith('.npy'))
+        self.examples_per_epoch = examples_per_epoch or len(self.track_files)
+
+    def __len__(self):
+        return self.examples_per_epoch
+
+    def __getitem__(self, idx):
+        stems = np.load(self.track_files[idx % len(self.track_files)])
+        return torch.from_numpy(stems.astype(np.float32))
+
+
+class MixtureCollator:
+    """Builds a batch of random mixtures and their soft mask targets from a batch of cached stems.
+
+    With B tracks of S stems each, the whole batch is augmented with tensor operations:
+    a random gain per stem, a random subset of stems kept per mixture and, with probability
+    'remix_probability' per stem, the stem taken from another song of the batch. The mixture
+    magnitude is approximated by the sum of the stem magnitudes (phase is not cached) and the
+    targets are the ratio masks of every stem in that mixture.
+    """
+
+    def __init__(self, gain_range_db=(-6.0, 6.0), stem_dropout=0.2, remix_probability=0.5, epsilon=1e-6):
+        self.gain_range_db = gain_range_db
+        self.stem_dropout = stem_dropout
+        self.remix_probability = remix_probability
+        self.epsilon = epsilon
+
+    def __call__(self, batch):
+        stems = torch.stack(batch)  # (B, S, H, W)
+        batch_size, num_sources = stems.shape[:2]
+
+        # Cross-song remixing: stem s of mixture b comes from song permutation[s][b]
+        remix = torch.rand(num_sources, batch_size) < self.remix_probability
+        permutations = torch.stack([torch.randperm(batch_size) for _ in range(num_sources)])
+        donors = torch.where(remix, permutations, torch.arange(batch_size).expand(num_sources, batch_size))
+        stems = stems[donors.T, torch.arange(num_sources)]
+
+        # Random gain (in dB) and random subset of stems, always keeping at least one stem
+        low, high = self.gain_range_db
+        gains = 10 ** ((low + (high - low) * torch.rand(batch_size, num_sources)) / 20)
+        keep = torch.rand(batch_size, num_sources) >= self.stem_dropout
+        keep[torch.arange(batch_size), torch.randint(num_sources, (batch_size,))] = True
+        stems = stems * (gains * keep)[:, :, None, None]
+
+        mixtures = stems.sum(dim=1)
+        masks = stems / (mixtures.unsqueeze(1) + self.epsilon)
+
+        # Model input: log magnitude normalized to [0, 255] per mixture, as for the spectrogram images
+        magnitude_db = 20 * torch.log10(mixtures + self.epsilon)
+        db_min = magnitude_db.amin(dim=(1, 2), keepdim=True)
+        db_max = magnitude_db.amax(dim=(1, 2), keepdim=True)
+        magnitude_db_normalized = ((magnitude_db - db_min) / (db_max - db_min + self.epsilon) * 255).to(torch.uint8)
+        inputs = Predictions().spectrogram_image_tensor(magnitude_db_normalized, image_size=tuple(mixtures.shape[-2:]))
+
+        # Targets in the same (image) orientation as the inputs
+        return inputs, torch.flip(masks, dims=[-2])
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    data_restructuring_processing_logfile_path = params['Logs']['Data_Restructuring_Processing']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, data_restructuring_processing_logfile_path))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    import pandas as pd
+    from step2_DatasetLoading import DataLoadingProcessing
+
+    parser = argparse.ArgumentParser(description='Builds the stem cache used to synthesize training mixtures on the fly.')
+    parser.add_argument('--data', default='train', help='Split to cache')
+    args = parser.parse_args()
+
+    df = pd.read_csv(f'slakh2100_metadata_{args.data}.csv')
+    df = DataLoadingProcessing().replace_other_track_labels(df, ['Piano', 'Drums', 'Bass', 'Guitar'])
+
+    StemCache(params['Mixture_Synthesis']['Cache_Folder']).build(df, sorted(df['Folder Name'].unique()), data=args.data)
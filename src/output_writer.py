@@ -0,0 +1,102 @@
+import os
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the jobs in the queue of the writer threads
+_END_OF_JOBS = object()
+
+
+def temporary_path(path):
+    """Name a file is written under before being renamed to 'path' (the extension is kept for the encoders)."""
+
+    root, extension = os.path.splitext(path)
+    return f'{root}.tmp{extension}'
+
+
+def is_temporary(path):
+    return os.path.splitext(os.path.splitext(path)[0])[1] == '.tmp'
+
+
+def write_bytes(path, data):
+    with open(path, 'wb') as output_file:
+        output_file.write(data)
+
+
+class OutputWriter:
+    """Writes the output files of a stage on background threads, so that its compute overlaps with disk I/O.
+
+    'submit' hands a file over to the writer threads through a bounded queue and returns at
+    once, unless the queue is full: the stage then waits for the writers, which bounds the
+    memory held by the pending files. Every file is written under a temporary name (see
+    'temporary_path') and renamed into place once complete, so a crash never leaves a
+    half-written file under its final name.
+
+    Used as a context manager, every submitted file is written on exit; the first error of a
+    writer thread is raised by the next 'submit' or on exit.
+    """
+
+    def __init__(self, num_threads=2, queue_size=8):
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.errors = list()
+
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(num_threads)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, path, function, *args):
+        """Queues the writing of 'path' by 'function(file_path, *args)'.
+
+        The arguments must not be modified afterwards (copy reused buffers before submitting).
+        """
+
+        if self.errors:
+            raise self.errors[0]
+
+        # put() blocks while the queue is full, which is the backpressure on the stage
+        self.jobs.put((path, function, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is _END_OF_JOBS:
+                return
+
+            # After a failure the remaining jobs are only drained so that 'submit' does not block
+            if self.errors:
+                continue
+
+            path, function, args = job
+            file_path = temporary_path(path)
+            try:
+                function(file_path, *args)
+                os.replace(file_path, path)
+            except Exception as e:
+                logger.error(f"Writing '{path}' failed: {e}")
+                self.errors.append(e)
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+
+    def close(self):
+        """Waits until every submitted file is written."""
+
+        for _ in self.threads:
+            self.jobs.put(_END_OF_JOBS)
+        for thread in self.threads:
+            thread.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # Not hiding the error of the stage itself
+            if exc_type is None:
+                raise
@@ -0,0 +1,395 @@
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import hashlib
+import argparse
+import logging
+import subprocess
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+SRC_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Stages in execution order
+STAGES = ['metadata', 'audio', 'spectrogram', 'masks', 'catalog', 'training']
+
+# Key used in the state file for the stages that run once per split instead of once per track
+WHOLE_SPLIT = '__all__'
+
+# Output file names of every instrument in the audio and spectrogram datasets
+AUDIO_OUTPUTS = ['Piano.wav', 'Drum.wav', 'Bass.wav', 'Guitar.wav', 'Others.wav']
+IMAGE_OUTPUTS = ['Piano.png', 'Guitar.png', 'Bass.png', 'Drums.png', 'Others.png']
+
+
+class PipelineRunner:
+
+    def __init__(self, params, force=False, dry_run=False):
+        self.params = params
+        self.force = force
+        self.dry_run = dry_run
+
+        pipeline_params = params['Pipeline']
+        self.state_file = pipeline_params['State_File']
+        self.splits = pipeline_params['Splits']
+        self.catalog_split = pipeline_params['Catalog_Split']
+
+        # Folders of the raw data and of the datasets
+        data_params = params['Data']
+        self.raw_data_folder = data_params['RawDataFolder']
+        self.audio_dataset_folder = data_params['AudioDatasetFolder']
+        self.spectrogram_dataset_folder = data_params['SpectrogramDatasetFolder']
+        self.final_dataset_folder = data_params['Final_Dataset']
+
+        self.state = self.load_state()
+        self.last_save = time.time()
+
+    def load_state(self):
+        """Loads the fingerprints of the previous runs, or an empty state on the first run."""
+
+        if not os.path.exists(self.state_file):
+            return {'file_hashes': dict(), 'stages': dict()}
+
+        with open(self.state_file, 'r') as state_file:
+            return json.load(state_file)
+
+    def save_state(self):
+        """Writes the state through a temporary file so that an interrupted run keeps the previous state."""
+
+        if self.dry_run:
+            return
+
+        tmp_state_file = self.state_file + '.tmp'
+        with open(tmp_state_file, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(tmp_state_file, self.state_file)
+
+        self.last_save = time.time()
+
+    def file_fingerprint(self, path):
+        """Returns the sha256 of a file's content, or None if the file does not exist.
+
+        Hashes are cached against the file size and modification time so that unchanged files
+        are not read again on the next run.
+        """
+
+        if not os.path.exists(path):
+            return None
+
+        stat = os.stat(path)
+        cached = self.state['file_hashes'].get(path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for block in iter(lambda: file.read(1 << 20), b''):
+                sha.update(block)
+
+        digest = sha.hexdigest()
+        self.state['file_hashes'][path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def fingerprint(self, input_paths, params=None, extra=None):
+        """Combines the content of the input files, the stage parameters and any extra data into one hash."""
+
+        sha = hashlib.sha256()
+        for path in sorted(input_paths):
+            sha.update(f"{path}:{self.file_fingerprint(path)}\n".encode())
+
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+        if extra is not None:
+            sha.update(extra.encode())
+
+        return sha.hexdigest()
+
+    def dataset_params(self):
+        """Settings of the 'Data' section the datasets depend on (the writer settings only change the throughput)."""
+
+        return {key: value for key, value in self.params['Data'].items() if not key.startswith('Writer_')}
+
+    def data_processing(self, df=None):
+        """'DataLoadingProcessing' with the folders, the preprocessing mode and the writer settings of params.yaml."""
+        from step2_DatasetLoading import DataLoadingProcessing
+
+        data_params = self.params['Data']
+        return DataLoadingProcessing(df, raw_data_folder=self.raw_data_folder, audio_dataset_folder=self.audio_dataset_folder,
+                                     spectrogram_dataset_folder=self.spectrogram_dataset_folder, final_dataset_folder=self.final_dataset_folder,
+                                     fused=data_params['Fused_Preprocessing'], writer_threads=data_params['Writer_Threads'],
+                                     writer_queue_size=data_params['Writer_Queue_Size'])
+
+    def files_below(self, folder):
+        """Returns all the files below 'folder'."""
+
+        return [path for path in glob.glob(os.path.join(folder, '**', '*'), recursive=True) if os.path.isfile(path)]
+
+    def run_unit(self, stage, split, unit, fingerprint, outputs, execute):
+        """Runs one unit of work (a track, or a whole split) unless its fingerprint is unchanged.
+
+        A unit is skipped when its fingerprint matches the previous run and the outputs it
+        produced back then still exist. Tracks that produced no outputs (e.g. missing
+        instruments) are not retried until their inputs change, but units whose execution
+        raised are recorded as failed and retried on the next run; the error is raised.
+
+        Returns
+        --------
+        True if the unit was executed
+        """
+
+        stage_state = self.state['stages'].setdefault(f'{stage}/{split}', dict())
+        previous = stage_state.get(unit)
+
+        if not self.force and previous is not None and previous['fingerprint'] == fingerprint and not previous.get('failed'):
+            if not previous['produced_outputs'] or all(os.path.exists(output) for output in outputs):
+                return False
+
+        if self.dry_run:
+            print(f"Would run '{stage}' on {split}/{unit}")
+            return True
+
+        logger.info(f"Running stage '{stage}' on {split}/{unit}.")
+        try:
+            execute()
+        except Exception as e:
+            # Not to be mistaken for a unit without outputs, which would never be retried
+            stage_state[unit] = {'fingerprint': fingerprint, 'produced_outputs': False, 'failed': True}
+            logger.error(f"Stage '{stage}' failed on {split}/{unit}: {e}")
+            raise
+
+        stage_state[unit] = {'fingerprint': fingerprint,
+                             'produced_outputs': all(os.path.exists(output) for output in outputs)}
+
+        # Saving regularly so that an interrupted run resumes where it stopped
+        if time.time() - self.last_save > 10:
+            self.save_state()
+
+        return True
+
+    def metadata_csv(self, split):
+        return f'slakh2100_metadata_{split}.csv'
+
+    def stage_metadata(self, split):
+        from step1_creating_csv import MetadataExtraction
+
+        slakh_split_dir = os.path.join(self.raw_data_folder, split)
+        inputs = glob.glob(os.path.join(slakh_split_dir, '*', 'metadata.yaml'))
+        inputs.append(os.path.join(SRC_FOLDER, 'step1_creating_csv.py'))
+        fingerprint = self.fingerprint(inputs)
+
+        output_csv = self.metadata_csv(split)
+        execute = lambda: MetadataExtraction().extract_slakh_metadata(slakh_split_dir, output_csv)
+
+        return int(self.run_unit('metadata', split, WHOLE_SPLIT, fingerprint, [output_csv], execute))
+
+    def load_metadata(self, split):
+        """Reads the metadata table of a split with the 'Others' labels applied."""
+        import pandas as pd
+
+        df = pd.read_csv(self.metadata_csv(split))
+        return self.data_processing().replace_other_track_labels(df, ['Piano', 'Drums', 'Bass', 'Guitar'])
+
+    def track_inputs(self, track_df, split, track):
+        """Source audio files of a track: every stem listed in the metadata and the mix."""
+
+        stems = [os.path.join(self.raw_data_folder, split, track, 'stems', stem) for stem in track_df['Track Name']]
+        return stems + [os.path.join(self.raw_data_folder, split, track, 'mix.flac')]
+
+    def stage_audio(self, split, df):
+        dlp = self.data_processing(df)
+        code = os.path.join(SRC_FOLDER, 'step2_DatasetLoading.py')
+        executed = 0
+
+        for track, track_df in df.groupby('Folder Name'):
+            fingerprint = self.fingerprint(self.track_inputs(track_df, split, track) + [code], params=self.dataset_params(),
+                                           extra=track_df.to_csv(index=False))
+            outputs = [os.path.join(self.audio_dataset_folder, split, 'Output', track, output) for output in AUDIO_OUTPUTS]
+            outputs.append(os.path.join(self.audio_dataset_folder, split, 'Input', f'{track}_mix.wav'))
+
+            execute = lambda track=track: dlp.create_datasets([track], data=split, outputs=['audio'])
+            executed += self.run_unit('audio', split, track, fingerprint, outputs, execute)
+
+        return executed
+
+    def stage_spectrogram(self, split, df):
+        dlp = self.data_processing(df)
+        code = os.path.join(SRC_FOLDER, 'step2_DatasetLoading.py')
+        executed = 0
+
+        for track, track_df in df.groupby('Folder Name'):
+            fingerprint = self.fingerprint(self.track_inputs(track_df, split, track) + [code], params=self.dataset_params(),
+                                           extra=track_df.to_csv(index=False))
+            outputs = [os.path.join(self.spectrogram_dataset_folder, split, 'Output', track, output) for output in IMAGE_OUTPUTS]
+            outputs.append(os.path.join(self.spectrogram_dataset_folder, split, 'Input', f'{track}_mix.png'))
+
+            execute = lambda track=track: dlp.create_datasets([track], data=split, outputs=['spectrogram'])
+            executed += self.run_unit('spectrogram', split, track, fingerprint, outputs, execute)
+
+        return executed
+
+    def stage_masks(self, split, df):
+        dlp = self.data_processing(df)
+        code = os.path.join(SRC_FOLDER, 'step2_DatasetLoading.py')
+        executed = 0
+
+        for track, track_df in df.groupby('Folder Name'):
+            final_input_png = os.path.join(self.final_dataset_folder, split, 'Input', f'{track}_mix.png')
+            outputs = [os.path.join(self.final_dataset_folder, split, 'Output', track, output) for output in IMAGE_OUTPUTS]
+            outputs.append(final_input_png)
+
+            if dlp.fused:
+                # The fused pass computes the masks from the decoded stems, not from the spectrogram dataset
+                fingerprint = self.fingerprint(self.track_inputs(track_df, split, track) + [code], params=self.dataset_params(),
+                                               extra=track_df.to_csv(index=False))
+                execute = lambda track=track: dlp.create_datasets([track], data=split, outputs=['masks'])
+                executed += self.run_unit('masks', split, track, fingerprint, outputs, execute)
+                continue
+
+            input_png = os.path.join(self.spectrogram_dataset_folder, split, 'Input', f'{track}_mix.png')
+            inputs = [os.path.join(self.spectrogram_dataset_folder, split, 'Output', track, output) for output in IMAGE_OUTPUTS]
+
+            # Tracks without spectrograms were not eligible
+            if not all(os.path.exists(path) for path in inputs + [input_png]):
+                continue
+
+            fingerprint = self.fingerprint(inputs + [input_png, code], params=self.dataset_params())
+
+            def execute(track=track, input_png=input_png, final_input_png=final_input_png):
+                dlp.create_mask_dataset(data=split, tracks=[track])
+
+                # Copying the input spectrogram to the final dataset folder
+                os.makedirs(os.path.dirname(final_input_png), exist_ok=True)
+                shutil.copy2(input_png, final_input_png)
+
+            executed += self.run_unit('masks', split, track, fingerprint, outputs, execute)
+
+        return executed
+
+    def stage_catalog(self):
+        """Rebuilds the catalog of the catalog split and publishes it as a new version of the catalog store.
+
+        Serving reads the store once a version exists, so writing the matrix files alone would
+        not reach it. The activity envelopes are rebuilt too when the current version has them.
+        """
+        import numpy as np
+        from step3_calculate_similarity_scores import SimScore
+        from catalog_store import CatalogStore
+
+        split = self.catalog_split
+        test_folder = os.path.join(self.audio_dataset_folder, split, 'Output')
+        model_path = os.path.join(self.params['Model']['Model_Folder'], self.params['Model']['Model_Name'])
+        inputs = self.files_below(test_folder) + [model_path, os.path.join(SRC_FOLDER, 'step3_calculate_similarity_scores.py')]
+
+        catalog_params = {key: value for key, value in self.params['Catalog'].items() if key != 'Ingestion'}
+        catalog_store = CatalogStore(catalog_params['Catalog_Folder'], catalog_params['Keep_Versions'])
+        temporal = catalog_store.exists() and catalog_store.current().envelopes is not None
+        envelopes_file_path = catalog_params['Envelopes_File'] if temporal else None
+
+        fingerprint = self.fingerprint(inputs, params=dict(catalog_params, Temporal=temporal))
+        outputs = [catalog_params['Catalog_File'], catalog_params['Ids_File'], catalog_store.manifest_path]
+
+        def execute():
+            # Envelopes of an earlier temporal build would not match the rebuilt rows
+            if envelopes_file_path is None and os.path.exists(catalog_params['Envelopes_File']):
+                os.remove(catalog_params['Envelopes_File'])
+
+            sim_score = SimScore()
+            sim_score.calculate_db_durations(test_folder=test_folder,
+                                             output_file_path=catalog_params['Catalog_File'],
+                                             ids_file_path=catalog_params['Ids_File'],
+                                             envelopes_file_path=envelopes_file_path)
+
+            catalog_store.publish(np.load(catalog_params['Catalog_File']), sim_score.load_track_ids(catalog_params['Ids_File']),
+                                  envelopes=np.load(envelopes_file_path) if envelopes_file_path else None)
+
+        return int(self.run_unit('catalog', split, WHOLE_SPLIT, fingerprint, outputs, execute))
+
+    def stage_training(self):
+        inputs = self.files_below(os.path.join(self.final_dataset_folder, 'train')) + [os.path.join(SRC_FOLDER, 'step4_ModelTraining.py')]
+        fingerprint = self.fingerprint(inputs, params={'Training': self.params['Training'], 'Architecture': self.params['Model']['Architecture']})
+        outputs = [os.path.join(self.params['Model']['Model_Folder'], self.params['Model']['Model_Name'])]
+
+        # Training reads its settings from params.yaml and runs in its own process
+        execute = lambda: subprocess.run([sys.executable, os.path.join(SRC_FOLDER, 'step4_ModelTraining.py'), '--data', 'train'], check=True)
+
+        return int(self.run_unit('training', 'train', WHOLE_SPLIT, fingerprint, outputs, execute))
+
+    def run(self, stages=STAGES):
+        """Runs the requested stages in pipeline order, re-executing only what changed.
+
+        Parameters
+        -----------
+
+        stages: Names of the stages to run
+
+        Returns
+        --------
+        Dictionary mapping every stage to the number of units (tracks or splits) executed
+        """
+
+        executed = dict()
+        try:
+            for stage in [stage for stage in STAGES if stage in stages]:
+                started = time.time()
+
+                if stage == 'metadata':
+                    executed[stage] = sum(self.stage_metadata(split) for split in self.splits
+                                          if os.path.isdir(os.path.join(self.raw_data_folder, split)))
+
+                elif stage in ('audio', 'spectrogram', 'masks'):
+                    stage_function = getattr(self, f'stage_{stage}')
+                    executed[stage] = 0
+                    for split in self.splits:
+                        if os.path.exists(self.metadata_csv(split)):
+                            executed[stage] += stage_function(split, self.load_metadata(split))
+
+                elif stage == 'catalog':
+                    has_inputs = os.path.isdir(os.path.join(self.audio_dataset_folder, self.catalog_split, 'Output'))
+                    executed[stage] = self.stage_catalog() if has_inputs else 0
+
+                elif stage == 'training':
+                    has_inputs = os.path.isdir(os.path.join(self.final_dataset_folder, 'train'))
+                    executed[stage] = self.stage_training() if has_inputs else 0
+
+                print(f"{stage}: {executed[stage]} unit(s) executed in {time.time() - started:.1f} s")
+
+        finally:
+            self.save_state()
+
+        return executed
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    data_restructuring_processing_logfile_path = params['Logs']['Data_Restructuring_Processing']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, data_restructuring_processing_logfile_path))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    parser = argparse.ArgumentParser(description='Runs the pipeline stages whose inputs or parameters changed.')
+    parser.add_argument('stages', nargs='*', help=f"Stages to run, among {', '.join(STAGES)} (default: all)")
+    parser.add_argument('--force', action='store_true', help='Run the stages even if nothing changed')
+    parser.add_argument('--dry-run', action='store_true', help='Only print what would run')
+    args = parser.parse_args()
+
+    unknown_stages = set(args.stages) - set(STAGES)
+    if unknown_stages:
+        parser.error(f"Unknown stage(s): {', '.join(sorted(unknown_stages))}")
+
+    PipelineRunner(params, force=args.force, dry_run=args.dry_run).run(args.stages or STAGES)
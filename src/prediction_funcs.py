@@ -1,19 +1,20 @@
-from PIL import Image
 import torch
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
-import soundfile as sf
 import os
-import logging
-import json
-from step0_utility_functions import Utility
 import numpy as np
-from step2_DatasetLoading import DataLoadingProcessing
+import memory_instrumentation
 
 class Predictions:
 
+    # Order of the model output channels (the mask folders are read in sorted order during training)
+    model_sources = ['Bass', 'Drums', 'Guitar', 'Others', 'Piano']
+
+    # Order of the columns of the catalog matrix and of the user preferences
+    catalog_instruments = ['Bass', 'Drums', 'Guitar', 'Piano', 'Others']
+
     def predict_source_masks(self, model, spectrogram_image_path):
+        from PIL import Image
+        from torchvision import transforms
         
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         # Loading the image
@@ -39,68 +40,150 @@ class Predictions:
         
         return softmasks
 
-    def stft(self, wavform, n_fft=1022, hop_length=512, window_length=1022):
-        
-        stft_results = torch.stft(wavform, n_fft=1022, hop_length=hop_length, win_length=window_length, window=torch.hann_window(window_length), return_complex=True)
-        
-        # Computing magnitude and phase
-        magnitude = stft_results.abs()
-        phase = torch.angle(stft_results)
+    def spectrogram_image_tensor(self, magnitude_db_normalized, image_size=(512, 512)):
+        """Builds the model input for a batch of normalized spectrograms exactly as the training inputs are built.
 
-        # Convert magnitude to decibels (log-compressed)
-        magnitude_db = 20 * torch.log10(magnitude + 1e-6)
+        The model was trained on the mix images of step2: the spectrogram resampled to
+        513 x 513, rendered with the 'viridis' colormap in a 7 x 7 inch figure with its axes,
+        tick labels and margins ('DataLoadingProcessing.render_spectrogram_png'), read back in
+        grayscale and resized by 'UNetDataset'. The figure is drawn without matplotlib from its
+        measured layout ('figure_frame'), pixel for pixel, so that serving, ingestion and
+        evaluation see the training input distribution at a fraction of the rendering cost.
 
-        # Normalize the magnitude spectrogram to range [0, 255] for grayscale
-        magnitude_db_normalized = (magnitude_db - magnitude_db.min()) / (magnitude_db.max() - magnitude_db.min()) * 255
-        magnitude_db_normalized = magnitude_db_normalized.squeeze().cpu().numpy().astype(np.uint8)
-        
-        magnitude_db_normalized = DataLoadingProcessing().resample_spectrogram_db(magnitude_db_normalized, target_shape=(512, 512))
-        resampled_phase = DataLoadingProcessing().resample_spectrogram_phase(phase)
-        
-        return magnitude_db_normalized, resampled_phase
+        Parameters
+        -----------
 
-    def istft(self, magnitude, phase, n_fft=1022, hop_length=512, window_length=1022):
-        spec = magnitude * torch.exp(1j * torch.tensor(phase))
-        return torch.istft(spec, n_fft=1022, hop_length=hop_length, win_length=window_length)
+        magnitude_db_normalized: uint8 tensor of shape (batch, freq_bins, frames) with values in [0, 255]
+        image_size: Spatial size expected by the model
 
-    def separate_sources(self, mixed_audio_waveform, softmask, n_fft=1022, hop_length=512, window_length=1024):
-        # Finding the magnitude and the phase of the mixed audio waveform
-        mixed_magnitude, mixed_phase = self.stft(mixed_audio_waveform)
-        
-        # Multiplying the mixed audio waveform magnitude with the source mask
-        masked_magnitude = torch.tensor(softmask) * torch.tensor(mixed_magnitude).unsqueeze(0)
-        
-        separated_sources = list()
-        
-        for index in range(softmask.shape[1]):  # Repeating this operation along the channel dimension
-            source_magnitude = masked_magnitude[:, index, :, :]
-            source_phase = mixed_phase 
-            separate_source = self.istft(source_magnitude, source_phase)
-            separated_sources.append(separate_source)
-        
-        # Save each separated source to a .wav file
-        for i in range(len(separated_sources)):
-            waveform = separated_sources[i]
-            print(waveform.shape)
-            waveform = waveform.cpu().numpy()  # Convert to numpy array
-            
-            # Normalize waveform to the range [-1, 1] for 16-bit PCM audio
-            waveform = waveform.reshape(-1)  # Flatten to 1D if it's 1D already (samples,)
-            waveform = np.clip(waveform, -1.0, 1.0)  # Normalize to [-1, 1]
-            waveform = waveform.astype(np.float32)  # Convert to float32
-            
-            # Define sample rate (assuming it's 92160)
-            sr = 10880
-            
-            # Ensure the 'Outputs' directory exists
-            if not os.path.exists('Outputs'):
-                os.makedirs('Outputs')
-            
-            instruments = ['Bass', 'Drums', 'Guitar', 'Piano', 'Others']
-            
-            # Save the waveform to a .wav file
-            output_file = os.path.join('Outputs', f"waveform_{instruments[i]}.wav")  # Ensure .wav extension
-            sf.write(output_file, waveform, sr)
-            print(f"Saved waveform {i+1} to {output_file}")
-            
-        return separated_sources
+        Returns
+        --------
+        Float tensor of shape (batch, 1, height, width) with values in [0, 1]
+        """
+        from PIL import Image
+        import figure_frame
+        from step2_DatasetLoading import DataLoadingProcessing
+
+        frame = figure_frame.load_frame()
+        images = list()
+        for spectrogram in torch.as_tensor(magnitude_db_normalized).cpu().numpy():
+            if spectrogram.shape != (513, 513):
+                spectrogram = DataLoadingProcessing().resample_spectrogram_db(spectrogram, target_shape=(513, 513))
+
+            image = Image.fromarray(figure_frame.render_figure(spectrogram, frame)).convert('L')
+            # Same resampling as 'UNetDataset' (PIL sizes are (width, height))
+            image = image.resize((image_size[1], image_size[0]))
+            images.append(torch.from_numpy(np.asarray(image, dtype=np.float32) / 255))
+
+        return torch.stack(images).unsqueeze(1)
+
+    @memory_instrumentation.instrumented('unet_forward')
+    def predict_source_masks_batch(self, model, input_tensor):
+        """Predicts the source masks for a batch of model inputs built by 'spectrogram_image_tensor'."""
+
+        device = next(model.parameters()).device
+
+        model.eval()
+
+        with torch.no_grad():
+            softmasks = model(input_tensor.to(device)).cpu()
+
+        return softmasks
+
+    @memory_instrumentation.instrumented('model_input')
+    def spectrogram_batch(self, waveforms, n_fft=1022, hop_length=512, image_size=(512, 512)):
+        """Computes the STFT and the model input of a batch of waveforms in one go.
+
+        Returns
+        --------
+        (stft_results, model_input): complex tensor of shape (batch, freq_bins, frames) and
+        float tensor of shape (batch, 1, *image_size)
+        """
+
+        stft_results = torch.stft(waveforms, n_fft=n_fft, hop_length=hop_length, win_length=n_fft,
+                                  window=torch.hann_window(n_fft), return_complex=True)
+
+        # Log-compressed magnitude normalized to [0, 255] per track
+        magnitude_db = 20 * torch.log10(stft_results.abs() + 1e-6)
+        db_min = magnitude_db.amin(dim=(1, 2), keepdim=True)
+        db_max = magnitude_db.amax(dim=(1, 2), keepdim=True)
+        magnitude_db_normalized = ((magnitude_db - db_min) / (db_max - db_min) * 255).to(torch.uint8)
+
+        return stft_results, self.spectrogram_image_tensor(magnitude_db_normalized, image_size=image_size)
+
+    def separate_sources(self, mixed_audio_waveform, softmask, n_fft=1022, hop_length=512, window_length=1022, stft_result=None):
+        """Separates a mix into its sources by masking its STFT at native resolution.
+
+        Single mix version of 'separate_sources_batch'. Writing the sources to disk is left to
+        the caller (see 'write_sources').
+
+        Parameters
+        -----------
+
+        mixed_audio_waveform: Tensor of shape (samples,) holding the mix
+        softmask: Masks predicted by the model, of shape (sources, 512, 512) or (1, sources, 512, 512)
+        n_fft, hop_length, window_length: STFT parameters, the same as for the model input
+        stft_result: STFT of the mix if the caller already computed it
+
+        Returns
+        --------
+        Tensor of shape (sources, samples) with the separated waveforms in model channel order
+        """
+
+        masks = torch.as_tensor(softmask, dtype=torch.float32)
+        if masks.ndim == 3:
+            masks = masks.unsqueeze(0)
+
+        return self.separate_sources_batch(mixed_audio_waveform.unsqueeze(0), masks, n_fft=n_fft, hop_length=hop_length, window_length=window_length,
+                                           stft_results=None if stft_result is None else stft_result.unsqueeze(0))[0]
+
+    @memory_instrumentation.instrumented('separate_sources')
+    def separate_sources_batch(self, mixed_audio_waveforms, softmasks, n_fft=1022, hop_length=512, window_length=1022, stft_results=None):
+        """Separates a batch of mixes into their sources by masking their STFTs at native resolution.
+
+        The masks are upsampled once from the model grid to the STFT grid of the mixes, applied
+        to the complex STFTs in a single broadcast, and all the sources of all the mixes are
+        inverted with one batched ISTFT.
+
+        Parameters
+        -----------
+
+        mixed_audio_waveforms: Tensor of shape (batch, samples) holding the mixes
+        softmasks: Masks predicted by the model, of shape (batch, sources, 512, 512)
+        n_fft, hop_length, window_length: STFT parameters, the same as for the model input
+        stft_results: STFTs of the mixes if the caller already computed them
+
+        Returns
+        --------
+        Tensor of shape (batch, sources, samples) with the separated waveforms in model channel order
+        """
+
+        window = torch.hann_window(window_length)
+        if stft_results is None:
+            stft_results = torch.stft(mixed_audio_waveforms, n_fft=n_fft, hop_length=hop_length, win_length=window_length,
+                                      window=window, return_complex=True)
+
+        masks = torch.as_tensor(softmasks, dtype=torch.float32)
+        batch_size, num_sources = masks.shape[:2]
+
+        # Undoing the image orientation of the masks and resizing them to the (freq_bins, frames) grid
+        masks = torch.flip(masks, dims=[-2])
+        masks = nn.functional.interpolate(masks, size=stft_results.shape[-2:], mode='bilinear', align_corners=False)
+
+        masked_stft = masks * stft_results.unsqueeze(1)
+
+        sources = torch.istft(masked_stft.reshape(batch_size * num_sources, *masked_stft.shape[-2:]), n_fft=n_fft, hop_length=hop_length,
+                              win_length=window_length, window=window, length=mixed_audio_waveforms.shape[-1])
+
+        return sources.reshape(batch_size, num_sources, -1)
+
+    def write_sources(self, separated_sources, output_folder='Outputs', sample_rate=10880):
+        """Writes every separated source to '<output_folder>/waveform_<instrument>.wav'."""
+        import soundfile as sf
+
+        if not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+
+        for instrument, waveform in zip(self.model_sources, separated_sources):
+            waveform = np.clip(waveform.cpu().numpy(), -1.0, 1.0).astype(np.float32)
+            sf.write(os.path.join(output_folder, f"waveform_{instrument}.wav"), waveform, sample_rate)
@@ -0,0 +1,292 @@
+import os
+import json
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+import memory_instrumentation
+from prediction_funcs import Predictions
+from step4_ModelTraining import UNET
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Evaluator of the current worker process, created once by the pool initializer
+_worker_evaluator = None
+
+
+def si_sdr(estimates, references, epsilon=1e-8):
+    """Scale-invariant SDR (in dB) of every estimate, computed on the whole batch at once.
+
+    Parameters
+    -----------
+
+    estimates, references: Tensors of shape (..., samples)
+
+    Returns
+    --------
+    Tensor of shape (...), NaN where the reference is silent
+    """
+
+    estimates = estimates - estimates.mean(dim=-1, keepdim=True)
+    references = references - references.mean(dim=-1, keepdim=True)
+
+    reference_energy = torch.sum(references ** 2, dim=-1, keepdim=True)
+    scale = torch.sum(estimates * references, dim=-1, keepdim=True) / (reference_energy + epsilon)
+    target = scale * references
+    noise = estimates - target
+
+    ratio = torch.sum(target ** 2, dim=-1) / (torch.sum(noise ** 2, dim=-1) + epsilon)
+    scores = 10 * torch.log10(ratio + epsilon)
+
+    return torch.where(reference_energy[..., 0] > epsilon, scores, torch.full_like(scores, float('nan')))
+
+
+def sdr(estimates, references, epsilon=1e-8):
+    """Signal to distortion ratio (in dB) of every estimate, computed on the whole batch at once.
+
+    This is the plain energy ratio ||s||^2 / ||s - s_hat||^2 used by recent separation
+    challenges, not the BSS Eval v4 version with its distortion filters.
+
+    Returns
+    --------
+    Tensor of shape (...), NaN where the reference is silent
+    """
+
+    reference_energy = torch.sum(references ** 2, dim=-1)
+    error_energy = torch.sum((references - estimates) ** 2, dim=-1)
+    scores = 10 * torch.log10(reference_energy / (error_energy + epsilon) + epsilon)
+
+    return torch.where(reference_energy > epsilon, scores, torch.full_like(scores, float('nan')))
+
+
+class SeparationEvaluator:
+    """Scores the separated waveforms of the model against the reference stems of a split.
+
+    The mixes of a batch go through the model and one batched inverse STFT, and the SI-SDR and
+    SDR of all the sources of all the tracks are computed as tensor operations. Tracks are
+    spread over worker processes by 'evaluate', each worker holding its own copy of the model.
+    """
+
+    sources = Predictions.model_sources
+
+    # The drum stems of the audio dataset are written as 'Drum.wav'
+    source_files = {'Drums': 'Drum.wav'}
+
+    def __init__(self, model, audio_dataset_folder='Audio_Dataset', sample_rate=10880, target_duration=180,
+                 batch_size=4, n_fft=1022, hop_length=512):
+        self.model = model
+        self.audio_dataset_folder = audio_dataset_folder
+        self.sample_rate = sample_rate
+        self.target_duration = target_duration
+        self.batch_size = batch_size
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+
+    def split_tracks(self, data='validation'):
+        """Tracks of a split that have a mix and a folder of reference stems."""
+
+        input_folder = os.path.join(self.audio_dataset_folder, data, 'Input')
+        output_folder = os.path.join(self.audio_dataset_folder, data, 'Output')
+
+        tracks = [file_name[:-len('_mix.wav')] for file_name in sorted(os.listdir(input_folder)) if file_name.endswith('_mix.wav')]
+        return [track for track in tracks if os.path.isdir(os.path.join(output_folder, track))]
+
+    def read_waveform(self, file_path):
+        import soundfile as sf
+
+        y, sample_rate = sf.read(file_path, dtype='float32', always_2d=True)
+        if sample_rate != self.sample_rate:
+            raise ValueError(f"'{file_path}' is sampled at {sample_rate} Hz, expected {self.sample_rate} Hz.")
+
+        # Downmixing and padding or truncating to the length the model was trained on
+        waveform = np.zeros(self.sample_rate * self.target_duration, dtype=np.float32)
+        y = y.mean(axis=1)[:len(waveform)]
+        waveform[:len(y)] = y
+
+        return waveform
+
+    def load_track(self, track, data='validation'):
+        """Returns the mix (samples,) and the reference stems (sources x samples) of a track.
+
+        A stem file that does not exist (instrument absent from the track) is silent.
+        """
+
+        mix = self.read_waveform(os.path.join(self.audio_dataset_folder, data, 'Input', f'{track}_mix.wav'))
+
+        references = np.zeros((len(self.sources), len(mix)), dtype=np.float32)
+        for index, source in enumerate(self.sources):
+            stem_path = os.path.join(self.audio_dataset_folder, data, 'Output', track, self.source_files.get(source, f'{source}.wav'))
+            if os.path.exists(stem_path):
+                references[index] = self.read_waveform(stem_path)
+
+        return mix, references
+
+    def evaluate_batch(self, mixes, references):
+        """SI-SDR and SDR of every source of a batch of tracks.
+
+        Parameters
+        -----------
+
+        mixes: Tensor of shape (batch, samples)
+        references: Tensor of shape (batch, sources, samples)
+
+        Returns
+        --------
+        (si_sdr, sdr): tensors of shape (batch, sources)
+        """
+
+        predictions = Predictions()
+        stft_results, model_input = predictions.spectrogram_batch(mixes, n_fft=self.n_fft, hop_length=self.hop_length)
+        softmasks = predictions.predict_source_masks_batch(self.model, model_input)
+        estimates = predictions.separate_sources_batch(mixes, softmasks, n_fft=self.n_fft, hop_length=self.hop_length,
+                                                       window_length=self.n_fft, stft_results=stft_results)
+
+        return si_sdr(estimates, references), sdr(estimates, references)
+
+    def evaluate_tracks(self, tracks, data='validation'):
+        """Scores a list of tracks batch by batch.
+
+        Returns
+        --------
+        (si_sdr, sdr): float arrays of shape (tracks, sources)
+        """
+
+        si_sdr_scores, sdr_scores = list(), list()
+        start = 0
+        while start < len(tracks):
+            # Smaller batches if a batch exceeded the memory budget of the stage
+            batch = tracks[start:start + memory_instrumentation.chunk_size('evaluate_batch', self.batch_size)]
+            start += len(batch)
+
+            with memory_instrumentation.stage('evaluate_batch', items=len(batch)):
+                loaded = [self.load_track(track, data) for track in batch]
+                mixes = torch.from_numpy(np.stack([mix for mix, _ in loaded]))
+                references = torch.from_numpy(np.stack([stems for _, stems in loaded]))
+
+                with torch.no_grad():
+                    batch_si_sdr, batch_sdr = self.evaluate_batch(mixes, references)
+            si_sdr_scores.append(batch_si_sdr.numpy())
+            sdr_scores.append(batch_sdr.numpy())
+
+        if not si_sdr_scores:
+            return np.zeros((0, len(self.sources))), np.zeros((0, len(self.sources)))
+
+        return np.concatenate(si_sdr_scores), np.concatenate(sdr_scores)
+
+    def aggregate(self, si_sdr_scores, sdr_scores):
+        """Per-instrument mean and median of the scores, ignoring the tracks where the instrument is silent."""
+
+        metrics = dict()
+        for index, source in enumerate(self.sources):
+            valid = ~np.isnan(si_sdr_scores[:, index])
+            metrics[source] = {'tracks': int(valid.sum()),
+                               'SI-SDR_mean': float(np.mean(si_sdr_scores[valid, index])) if valid.any() else None,
+                               'SI-SDR_median': float(np.median(si_sdr_scores[valid, index])) if valid.any() else None,
+                               'SDR_mean': float(np.mean(sdr_scores[valid, index])) if valid.any() else None,
+                               'SDR_median': float(np.median(sdr_scores[valid, index])) if valid.any() else None}
+
+        return metrics
+
+    def evaluate(self, model_path, data='validation', num_workers=4, memory_params=None):
+        """Scores all the tracks of a split on 'num_workers' processes.
+
+        Every worker loads the checkpoint at 'model_path' once and scores contiguous chunks of
+        tracks, so each process runs full batches. With 'memory_params' (the 'Memory' section of
+        params.yaml) every worker writes its own memory report, suffixed with its pid.
+
+        Returns
+        --------
+        Per-instrument aggregates, see 'aggregate'
+        """
+
+        tracks = self.split_tracks(data)
+        chunk_size = self.batch_size * 2
+        chunks = [tracks[start:start + chunk_size] for start in range(0, len(tracks), chunk_size)]
+
+        with ProcessPoolExecutor(max_workers=num_workers, initializer=initialize_worker,
+                                 initargs=(model_path, num_workers, self.settings(), memory_params)) as executor:
+            results = list(executor.map(evaluate_chunk, chunks, [data] * len(chunks)))
+
+        si_sdr_scores = np.concatenate([result[0] for result in results]) if results else np.zeros((0, len(self.sources)))
+        sdr_scores = np.concatenate([result[1] for result in results]) if results else np.zeros((0, len(self.sources)))
+
+        logger.info(f'Separation quality evaluated on {len(tracks)} tracks of {data}.')
+        return self.aggregate(si_sdr_scores, sdr_scores)
+
+    def settings(self):
+        """Constructor arguments (other than the model) used to build the evaluator of every worker."""
+
+        return {'audio_dataset_folder': self.audio_dataset_folder, 'sample_rate': self.sample_rate,
+                'target_duration': self.target_duration, 'batch_size': self.batch_size,
+                'n_fft': self.n_fft, 'hop_length': self.hop_length}
+
+    def write_metrics(self, metrics, metrics_file_path):
+        """Adds the separation metrics to the metrics file, keeping the metrics already in it."""
+
+        all_metrics = dict()
+        if os.path.exists(metrics_file_path):
+            with open(metrics_file_path, 'r') as json_file:
+                all_metrics = json.load(json_file)
+
+        all_metrics['separation'] = metrics
+
+        with open(metrics_file_path, 'w') as json_file:
+            json.dump(all_metrics, json_file, indent=4)
+
+
+def initialize_worker(model_path, num_workers, settings, memory_params=None):
+    global _worker_evaluator
+
+    if memory_params is not None:
+        report_root, report_extension = os.path.splitext(memory_params['Report_File'])
+        memory_instrumentation.enable(memory_params, report_name=f'{report_root}_{os.getpid()}{report_extension}')
+
+    # Sharing the cores between the workers instead of every worker using all of them
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // num_workers))
+
+    model = UNET.load(model_path)
+    _worker_evaluator = SeparationEvaluator(model, **settings)
+
+
+def evaluate_chunk(tracks, data):
+    return _worker_evaluator.evaluate_tracks(tracks, data)
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Model_Evaluation = params['Logs']['Model_Evaluation']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Model_Evaluation))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    evaluation_params = params['Evaluation']
+
+    parser = argparse.ArgumentParser(description='Scores the separation quality (SI-SDR, SDR) of the trained model on a split.')
+    parser.add_argument('--data', default='validation', choices=['train', 'validation', 'test'], help='Split to evaluate')
+    parser.add_argument('--workers', type=int, default=evaluation_params['Num_Workers'], help='Number of worker processes')
+    args = parser.parse_args()
+
+    model_path = os.path.join(params['Model']['Model_Folder'], params['Model']['Model_Name'])
+    metrics_folder_name = params['Model']['Metrics']['Metrics_Folder']
+    Utility().create_folder(metrics_folder_name)
+
+    evaluator = SeparationEvaluator(None, audio_dataset_folder=params['Data']['AudioDatasetFolder'], batch_size=evaluation_params['Batch_Size'])
+    metrics = evaluator.evaluate(model_path, data=args.data, num_workers=args.workers, memory_params=params['Memory'])
+    evaluator.write_metrics(metrics, os.path.join(metrics_folder_name, params['Model']['Metrics']['Metrics_File']))
+
+    logger.info(f'Separation metrics: {metrics}')
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import argparse
+import logging
+import threading
+import warnings
+import numpy as np
+import torch
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Weights mapped by this process, by blob path: (blob and index stat, state dict)
+_mapped_weights = dict()
+_mapped_weights_lock = threading.Lock()
+
+# Offsets of the tensors in the blob are multiples of this (cache line and SIMD friendly)
+ALIGNMENT = 64
+
+
+def index_path(weights_path):
+    """Path of the index describing the tensors of a weights blob (model_weights.npy -> model_weights.json)."""
+
+    return os.path.splitext(weights_path)[0] + '.json'
+
+
+def export_state_dict(state_dict, weights_path):
+    """Writes a state dict as one flat byte blob (.npy) and a JSON index of its tensors.
+
+    Every tensor is stored contiguously at an aligned offset, so that 'map_state_dict' can
+    expose it as a view of the memory-mapped blob. The blob is written before the index and
+    both are renamed into place, so readers never see an index pointing into a partial blob.
+    """
+
+    entries, offset = dict(), 0
+    arrays = dict()
+    for name, tensor in state_dict.items():
+        array = tensor.detach().cpu().contiguous().numpy()
+        offset = -(-offset // ALIGNMENT) * ALIGNMENT
+        entries[name] = {'offset': offset, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+        arrays[name] = array
+        offset += array.nbytes
+
+    blob = np.zeros(offset, dtype=np.uint8)
+    for name, array in arrays.items():
+        start = entries[name]['offset']
+        blob[start:start + array.nbytes] = array.reshape(-1).view(np.uint8)
+
+    tmp_path = weights_path + '.tmp.npy'
+    np.save(tmp_path, blob)
+    os.replace(tmp_path, weights_path)
+
+    tmp_path = index_path(weights_path) + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+        json.dump(entries, json_file, indent=2)
+    os.replace(tmp_path, index_path(weights_path))
+
+
+def export_checkpoint(checkpoint_path, weights_path):
+    state_dict = torch.load(checkpoint_path, map_location='cpu', weights_only=True)
+    export_state_dict(state_dict, weights_path)
+    logger.info(f"Weights of '{checkpoint_path}' exported to '{weights_path}'.")
+
+
+def map_state_dict(weights_path):
+    """State dict whose tensors are read-only views of the memory-mapped weights blob.
+
+    No weight is copied: every process mapping the same blob shares one copy of it through
+    the page cache. The mapping is cached per process and renewed when the blob or its index
+    is replaced.
+    """
+
+    stat = tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in (weights_path, index_path(weights_path)))
+
+    with _mapped_weights_lock:
+        cached = _mapped_weights.get(weights_path)
+        if cached is not None and cached[0] == stat:
+            return cached[1]
+
+        blob = np.load(weights_path, mmap_mode='r')
+        with open(index_path(weights_path), 'r') as json_file:
+            entries = json.load(json_file)
+
+        state_dict = dict()
+        with warnings.catch_warnings():
+            # The views are not writable, which torch warns about; the weights are never written
+            warnings.simplefilter('ignore', UserWarning)
+            for name, entry in entries.items():
+                dtype = np.dtype(entry['dtype'])
+                count = int(np.prod(entry['shape'], dtype=np.int64))
+                array = np.frombuffer(blob, dtype=dtype, count=count, offset=entry['offset']).reshape(entry['shape'])
+                state_dict[name] = torch.from_numpy(array)
+
+        _mapped_weights[weights_path] = (stat, state_dict)
+        return state_dict
+
+
+def resident_memory():
+    """(RSS, PSS) of this process in bytes, PSS splitting shared pages between the processes mapping them.
+
+    Read from /proc, so Linux only; (None, None) elsewhere.
+    """
+
+    values = dict()
+    try:
+        with open('/proc/self/smaps_rollup', 'r') as smaps:
+            for line in smaps:
+                fields = line.split()
+                if fields[0] in ('Rss:', 'Pss:'):
+                    values[fields[0]] = int(fields[1]) * 1024
+    except OSError:
+        return None, None
+
+    return values.get('Rss:'), values.get('Pss:')
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    Model_Training = params['Logs']['Model_Training']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, Model_Training))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    model_params = params['Model']
+    checkpoint_path = os.path.join(model_params['Model_Folder'], model_params['Model_Name'])
+
+    parser = argparse.ArgumentParser(description='Exports the trained weights as a memory-mappable blob shared by the serving processes.')
+    parser.add_argument('--checkpoint', default=checkpoint_path, help='Checkpoint to export')
+    parser.add_argument('--output', default=os.path.join(model_params['Model_Folder'], model_params['Shared_Weights_Name']),
+                        help='Weights blob to write (its index is written next to it as .json)')
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    export_checkpoint(args.checkpoint, args.output)
+    logger.info(f'Export took {time.perf_counter() - started:.2f} s.')
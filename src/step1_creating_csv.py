@@ -4,6 +4,7 @@ import csv
 import logging
 from step0_utility_functions import Utility
 
+logger = logging.getLogger(__name__)
 
 class MetadataExtraction:
 
@@ -73,7 +74,6 @@ class MetadataExtraction:
 if __name__ == "__main__":
 
     # SETTING UP THE LOGGING MECHANISM
-    logger = logging.getLogger(__name__)
     logger.setLevel(logging.INFO)
 
     Utility().create_folder('Logs')
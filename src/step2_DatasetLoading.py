@@ -1,22 +1,46 @@
 
 # Importing required libraries
-import librosa
 import numpy as np
-import pandas as pd
-import soundfile as sf
 import os
-import torch
-import matplotlib.pyplot as plt
-from PIL import Image
-import shutil
-import scipy.ndimage as ndimage
 import logging
+import memory_instrumentation
+from output_writer import OutputWriter, is_temporary, write_bytes
 from step0_utility_functions import Utility
 
+# The audio, plotting and scientific libraries are imported inside the methods that use them,
+# so that the web app and the worker processes only pay for what they call
+
+# Read-only buffers of zeros shared by all the tracks without 'Others' stems, keyed by length
+_silent_buffers = dict()
+
+logger = logging.getLogger(__name__)
+
 class DataLoadingProcessing:
    
-  def __init__(self):
-    pass
+  def __init__(self, metadata_df=None, raw_data_folder='Slakh2100', audio_dataset_folder='Audio_Dataset',
+               spectrogram_dataset_folder='Spectrogram_Dataset', final_dataset_folder='Final_Dataset', fused=False,
+               writer_threads=2, writer_queue_size=8):
+    # Metadata table (one row per stem) with the 'Others' labels already applied
+    self.metadata_df = metadata_df
+
+    # 'create_datasets' builds every artifact of a track in one pass ('process_track_fused')
+    # instead of running the audio, spectrogram and mask stages one after the other
+    self.fused = fused
+
+    # Folders the raw data is read from and the datasets are written to
+    self.raw_data_folder = raw_data_folder
+    self.audio_dataset_folder = audio_dataset_folder
+    self.spectrogram_dataset_folder = spectrogram_dataset_folder
+    self.final_dataset_folder = final_dataset_folder
+
+    # Background threads writing the output files and number of files they can have pending
+    self.writer_threads = writer_threads
+    self.writer_queue_size = writer_queue_size
+
+  def output_writer(self):
+    """Writer the dataset stages hand their finished files to, see 'output_writer.OutputWriter'."""
+
+    return OutputWriter(self.writer_threads, self.writer_queue_size)
 
   # Replacing all the instruments except in ['Piano', 'Drums', 'Bass', 'Guitar'] with 'Others' tag
   def replace_other_track_labels(self, df, four_instr):
@@ -52,6 +76,7 @@ class DataLoadingProcessing:
           raise e
       
   def merge_tracks(self, track_df, instrument, data='train'):
+    import librosa
 
     try:
       # Filtering the track_df dataframe to get only the records with required instrument
@@ -68,7 +93,7 @@ class DataLoadingProcessing:
 
       # Iterating through each row of the filtered dataframe
       for index in range(instr_df.shape[0]):
-        audio_path = os.path.join('Slakh2100', data, instr_df.iloc[index, 0], 'stems', instr_df.iloc[index, 2])
+        audio_path = os.path.join(self.raw_data_folder, data, instr_df.iloc[index, 0], 'stems', instr_df.iloc[index, 2])
 
         # Checking if the audio file exists
         if os.path.exists(audio_path):
@@ -97,7 +122,7 @@ class DataLoadingProcessing:
 
     try:
       # Filtering the data for the particular track
-      track_df = df[df['Folder Name'] == unique_track]
+      track_df = self.metadata_df[self.metadata_df['Folder Name'] == unique_track]
       
       # Merging the piano records if required
       y_piano, sr_piano = self.merge_tracks(track_df, 'Piano', data=data)
@@ -125,68 +150,284 @@ class DataLoadingProcessing:
       print(f"Error encountered in the function 'merge_main_four_tracks': {e}")
       raise e
 
-  def create_audio_dataset(self, unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar', 'Others'], data='train'):
+  def allocate_track_buffers(self, names, sample_rate=10880, target_duration=180):
+    """Allocates one float32 accumulator of the target length per name.
+
+    The buffers are meant to be reused for every track processed by a worker, so that
+    preprocessing does not allocate new arrays per stem and per track.
+
+    Parameters
+    -----------
+
+    names: Names of the buffers e.g., the instruments and 'Mix'
+    sample_rate: Sample rate of the audio held in the buffers
+    target_duration: Duration (in seconds) of the audio held in the buffers
+
+    Returns
+    --------
+    Dictionary mapping every name to its buffer
+    """
+
+    target_length = int(sample_rate * target_duration)
+    return {name: np.zeros(target_length, dtype=np.float32) for name in names}
+
+  def silent_buffer(self, sample_rate=10880, target_duration=180):
+    """Returns the shared read-only buffer of zeros used for instruments absent from a track."""
+
+    target_length = int(sample_rate * target_duration)
+    if target_length not in _silent_buffers:
+      buffer = np.zeros(target_length, dtype=np.float32)
+      buffer.flags.writeable = False
+      _silent_buffers[target_length] = buffer
+
+    return _silent_buffers[target_length]
+
+  def load_into_buffer(self, audio_path, buffer, sample_rate=10880):
+    """Decodes an audio file and adds it to 'buffer' in place.
+
+    Only the duration covered by the buffer is decoded; shorter audio leaves the rest of the
+    buffer untouched, which is the zero padding of 'make_lengths_same'.
+    """
+    import librosa
+
+    y, _ = librosa.load(audio_path, mono=True, sr=sample_rate, duration=len(buffer) / sample_rate, dtype=np.float32)
+    length = min(len(y), len(buffer))
+    buffer[:length] += y[:length]
+
+  def stream_into_buffer(self, source, buffer, sample_rate=10880, block_size=65536):
+    """Decodes a WAV, FLAC or OGG file (path or file-like object) into 'buffer' block by block.
+
+    Every block is downmixed and resampled to 'sample_rate' with a streaming resampler, so
+    only one block of the original audio is in memory at a time, and decoding stops as soon as
+    the buffer is full. Audio shorter than the buffer leaves the rest of it untouched (zeros
+    for a fresh buffer, the padding of 'make_lengths_same').
+
+    Returns
+    --------
+    Number of samples written to the buffer
+    """
+    import soundfile as sf
+    import soxr
+
+    written = 0
+    with sf.SoundFile(source) as audio_file:
+      resampler = soxr.ResampleStream(audio_file.samplerate, sample_rate, 1, dtype='float32') if audio_file.samplerate != sample_rate else None
+
+      for block in audio_file.blocks(blocksize=block_size, dtype='float32', always_2d=True):
+        samples = block.mean(axis=1)
+        if resampler is not None:
+          samples = resampler.resample_chunk(samples)
+
+        length = min(len(samples), len(buffer) - written)
+        buffer[written:written + length] = samples[:length]
+        written += length
+        if written == len(buffer):
+          return written
+
+      if resampler is not None:
+        # Samples still held back by the resampler at the end of the audio
+        samples = resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+        length = min(len(samples), len(buffer) - written)
+        buffer[written:written + length] = samples[:length]
+        written += length
+
+    return written
+
+  def normalize_in_place(self, buffer, epsilon=1e-10):
+    """Scales 'buffer' in place so that its peak amplitude is one."""
+
+    peak = max(float(buffer.max()), -float(buffer.min()))
+    buffer /= peak + epsilon
+    return buffer
+
+  def read_stem_header(self, audio_path):
+    """Duration (in seconds) of an audio file read from its header only, None if it is missing or unreadable."""
+    import soundfile as sf
+
+    if not os.path.exists(audio_path):
+      return None
+
+    try:
+      info = sf.info(audio_path)
+    except RuntimeError as e:
+      logger.warning(f"Unreadable audio header '{audio_path}': {e}")
+      return None
+
+    return info.frames / info.samplerate if info.frames > 0 else None
+
+  def plan_track(self, track_df, unique_track, required_instruments=['Piano', 'Drums', 'Bass', 'Guitar'],
+                 optional_instruments=['Others'], data='train'):
+    """Decides from the metadata and the audio headers whether a track can go through step2.
+
+    No sample is decoded: the stems listed in the metadata are checked with header reads only.
+    A track is eligible when it has a readable mix and at least one readable stem of every
+    required instrument; optional instruments without readable stems are synthesized as silence.
+
+    Returns
+    --------
+    Work plan entry of the track (a JSON serializable dictionary):
+      'track', 'eligible', 'missing' (required instruments without readable stems),
+      'stems' (instrument -> readable stem paths), 'silent' (instruments synthesized as silence),
+      'durations' (instrument -> longest stem in seconds), 'mix' and 'mix_duration'
+    """
+
+    entry = {'track': str(unique_track), 'stems': dict(), 'durations': dict(), 'silent': list(), 'missing': list()}
+
+    for instrument in required_instruments + optional_instruments:
+      instr_df = track_df[track_df['Instrument Class'] == instrument]
+
+      stems, durations = list(), list()
+      for index in range(instr_df.shape[0]):
+        audio_path = os.path.join(self.raw_data_folder, data, instr_df.iloc[index, 0], 'stems', instr_df.iloc[index, 2])
+        duration = self.read_stem_header(audio_path)
+        if duration is not None:
+          stems.append(audio_path)
+          durations.append(duration)
+
+      if stems:
+        entry['stems'][instrument] = stems
+        entry['durations'][instrument] = max(durations)
+      elif instrument in optional_instruments:
+        entry['silent'].append(instrument)
+      else:
+        entry['missing'].append(instrument)
+
+    entry['mix'] = os.path.join(self.raw_data_folder, data, str(unique_track), 'mix.flac')
+    entry['mix_duration'] = self.read_stem_header(entry['mix'])
+    entry['eligible'] = not entry['missing'] and entry['mix_duration'] is not None
+
+    return entry
+
+  def plan_tracks(self, unique_tracks, required_instruments=['Piano', 'Drums', 'Bass', 'Guitar'],
+                  optional_instruments=['Others'], data='train'):
+    """Work plan of a list of tracks, one 'plan_track' entry per track, in the same order."""
+
+    grouped = dict(tuple(self.metadata_df[self.metadata_df['Folder Name'].isin(unique_tracks)].groupby('Folder Name')))
+
+    plan = list()
+    for unique_track in unique_tracks:
+      track_df = grouped.get(unique_track, self.metadata_df.iloc[:0])
+      plan.append(self.plan_track(track_df, unique_track, required_instruments, optional_instruments, data=data))
+
+    eligible = sum(entry['eligible'] for entry in plan)
+    logger.info(f'Work plan of {data}: {eligible} of {len(plan)} tracks eligible.')
+    return plan
+
+  def write_work_plan(self, plan, plan_file_path):
+    import json
+
+    tmp_path = plan_file_path + '.tmp'
+    with open(tmp_path, 'w') as json_file:
+      json.dump(plan, json_file, indent=2)
+    os.replace(tmp_path, plan_file_path)
+
+  def read_work_plan(self, plan_file_path):
+    import json
+
+    with open(plan_file_path, 'r') as json_file:
+      return json.load(json_file)
+
+  @memory_instrumentation.instrumented('merge_stems')
+  def merge_planned_stems(self, entry, buffers, instruments=['Piano', 'Guitar', 'Bass', 'Drums', 'Others']):
+    """Merges the stems of an eligible work plan entry into the reusable 'buffers'.
+
+    Only the stems the plan found readable are decoded, and the instruments it marked as
+    silent get the shared silent buffer.
+
+    Returns
+    --------
+    Dictionary mapping every instrument to its merged audio
+    """
+
+    stems = dict()
+    for instrument in instruments:
+      if instrument in entry['silent']:
+        stems[instrument] = self.silent_buffer()
+        continue
+
+      buffer = buffers[instrument]
+      buffer.fill(0)
+      for audio_path in entry['stems'][instrument]:
+        self.load_into_buffer(audio_path, buffer)
+      stems[instrument] = self.normalize_in_place(buffer)
+
+    return stems
+
+  def required_instruments(self, four_instr):
+    # 'Others' is never required: tracks without it get silence
+    return [instr for instr in four_instr if instr != 'Others']
+
+  def create_audio_dataset(self, unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar', 'Others'], data='train', work_plan=None):
+    import soundfile as sf
 
     try:
       # If the folder to store the data is not present then it is created
-      if not os.path.exists('Audio_Dataset'):
-        os.makedirs('Audio_Dataset', exist_ok=True)
+      if not os.path.exists(self.audio_dataset_folder):
+        os.makedirs(self.audio_dataset_folder, exist_ok=True)
       
       # Creating input and output folder
-      if not os.path.exists(os.path.join('Audio_Dataset', data ,'Input')):
-        os.makedirs(os.path.join('Audio_Dataset', data, 'Input'), exist_ok=True)
+      if not os.path.exists(os.path.join(self.audio_dataset_folder, data ,'Input')):
+        os.makedirs(os.path.join(self.audio_dataset_folder, data, 'Input'), exist_ok=True)
 
-      if not os.path.exists(os.path.join('Audio_Dataset', data, 'Output')):
-        os.makedirs(os.path.join('Audio_Dataset', data, 'Output'), exist_ok=True)
+      if not os.path.exists(os.path.join(self.audio_dataset_folder, data, 'Output')):
+        os.makedirs(os.path.join(self.audio_dataset_folder, data, 'Output'), exist_ok=True)
 
-      for unique_track in unique_tracks: # For every unique trackk
-        track_df = df[df['Folder Name'] == unique_track] # Filtering the data base on the unique track
-        if all(True for instr in four_instr if instr in track_df['Instrument Class']): # If all the four main instruments and at least one other instrument are present in the mixed audio
+      # float32 accumulators reused for every track
+      sample_rate = 10880
+      buffers = self.allocate_track_buffers(['Piano', 'Guitar', 'Bass', 'Drums', 'Others', 'Mix'], sample_rate=sample_rate)
 
-          # Merging the multiple audio files of same instrument if required
-          y_piano, y_guitar, y_bass, y_drums, sr_piano, sr_guitar, sr_bass, sr_drums = self.merge_main_four_tracks(unique_track, data=data)
+      # Deciding from the audio headers which tracks are eligible before decoding anything
+      if work_plan is None:
+        work_plan = self.plan_tracks(unique_tracks, self.required_instruments(four_instr), data=data)
 
-          # If there is not other instrument present other than the main four then dummy others audio is created.
-          if 'Others' not in track_df.iloc[:, 3].unique():
-            y_others = np.zeros(int(180 * 10880)).reshape(-1, 1)
-            sr_others = 10880
-          else:
-            y_others, sr_others = self.merge_tracks(track_df, 'Others', data=data)
-              
-          # Saving all four main audio files
-          if y_piano is not None and y_drums is not None and y_bass is not None and y_guitar is not None and y_others is not None:
-            # Creating a folder for each unique track if it is not already present
-            if not os.path.exists(os.path.join('Audio_Dataset', data, 'Output', str(unique_track))):
-              os.makedirs(os.path.join('Audio_Dataset', data, 'Output' ,str(unique_track)), exist_ok=True)
+      with self.output_writer() as writer:
+        for entry in work_plan: # For every track of the plan
+          with memory_instrumentation.track(entry['track']):
+            unique_track = entry['track']
+            if entry['eligible']: # If all the four main instruments and the mix are readable
+
+              # Merging the multiple audio files of same instrument if required (dummy silent audio for missing 'Others')
+              stems = self.merge_planned_stems(entry, buffers)
               
-            sf.write(os.path.join('Audio_Dataset', data, 'Output',  str(unique_track), 'Piano.wav'), y_piano, sr_piano)
-            sf.write(os.path.join('Audio_Dataset', data, 'Output' , str(unique_track), 'Drum.wav'), y_drums, sr_drums)
-            sf.write(os.path.join('Audio_Dataset', data, 'Output' , str(unique_track), 'Bass.wav'), y_bass, sr_bass)
-            sf.write(os.path.join('Audio_Dataset', data, 'Output' , str(unique_track), 'Guitar.wav'), y_guitar, sr_guitar)
-
-            # Saving others audio
-            if y_others is not None and sr_others is not None:
-              sf.write(os.path.join('Audio_Dataset', data, 'Output' , str(unique_track), 'Others.wav'), y_others, sr_others)
-
-            # Saving the mixed audio
-            y_mix, sr_mix = librosa.load(os.path.join('Slakh2100', data, str(unique_track), 'mix.flac'), mono=True, sr=10880)
-            y_mix = self.make_lengths_same(y_mix, sr_mix)
+              # Saving all four main audio files (copies: the buffers are reused by the next track while they are written)
+              # Creating a folder for each unique track if it is not already present
+              if not os.path.exists(os.path.join(self.audio_dataset_folder, data, 'Output', str(unique_track))):
+                os.makedirs(os.path.join(self.audio_dataset_folder, data, 'Output' ,str(unique_track)), exist_ok=True)
             
-            if y_mix is not None and sr_mix is not None:
-              sf.write(os.path.join('Audio_Dataset', data, 'Input', f'{unique_track}_mix.wav'), y_mix, sr_mix)
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Output',  str(unique_track), 'Piano.wav'), sf.write, stems['Piano'].copy(), sample_rate)
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Output' , str(unique_track), 'Drum.wav'), sf.write, stems['Drums'].copy(), sample_rate)
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Output' , str(unique_track), 'Bass.wav'), sf.write, stems['Bass'].copy(), sample_rate)
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Output' , str(unique_track), 'Guitar.wav'), sf.write, stems['Guitar'].copy(), sample_rate)
+
+              # Saving others audio
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Output' , str(unique_track), 'Others.wav'), sf.write, stems['Others'].copy(), sample_rate)
 
-        logger.info('Audio Dataset Created.')
+              # Saving the mixed audio
+              y_mix = buffers['Mix']
+              y_mix.fill(0)
+              self.load_into_buffer(entry['mix'], y_mix, sample_rate=sample_rate)
+              writer.submit(os.path.join(self.audio_dataset_folder, data, 'Input', f'{unique_track}_mix.wav'), sf.write, y_mix.copy(), sample_rate)
+
+            logger.info('Audio Dataset Created.')
 
     except Exception as e:
       print("Error encountered in the 'create_dataset' function.")
+      raise e
     
   def resample_spectrogram_db(self, spectrogram, target_shape=(512, 512)):
+      import scipy.ndimage as ndimage
+
       return ndimage.zoom(spectrogram, (target_shape[0] / spectrogram.shape[0], target_shape[1] / spectrogram.shape[1]), order=3)
     
   def resample_spectrogram_phase(self, phase, target_shape=(512, 512)):
+      import scipy.ndimage as ndimage
+
       return ndimage.zoom(phase, (target_shape[0] / phase.shape[0], target_shape[1] / phase.shape[1]), order=3)
   
+  @memory_instrumentation.instrumented('spectrogram')
   def create_log_magnitude_spectrogram(self, waveform, window_length=1022, hop_length=512, sample_rate=10880):
+      import torch
+
       # Ensure waveform is a torch tensor
       if not isinstance(waveform, torch.Tensor):
           waveform = torch.tensor(waveform, dtype=torch.float32)
@@ -216,79 +457,130 @@ class DataLoadingProcessing:
     
       return magnitude_db_normalized
 
-  def create_spectrogram_dataset(self, unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar', 'Others'], data='train'):
+  def create_log_magnitude_spectrograms(self, waveforms, window_length=1022, hop_length=512):
+      """Batched 'create_log_magnitude_spectrogram': one STFT for all the rows of a (signals x samples) array.
+
+      Every spectrogram is normalized to [0, 255] on its own range, as the single signal version does.
+
+      Returns
+      --------
+      List of (513 x 513) uint8 based spectrograms, one per row
+      """
+      import torch
+
+      waveforms = torch.as_tensor(np.asarray(waveforms), dtype=torch.float32)
+
+      # The rows go through the STFT in chunks, smaller ones if the stage exceeds its memory budget
+      spectrograms, start = list(), 0
+      while start < len(waveforms):
+          size = memory_instrumentation.chunk_size('spectrogram_batch', len(waveforms))
+          chunk = waveforms[start:start + size]
+          start += size
+
+          with memory_instrumentation.stage('spectrogram_batch', items=len(chunk)):
+              stft_results = torch.stft(chunk, n_fft=1022, hop_length=hop_length, win_length=window_length, window=torch.hann_window(window_length), return_complex=True)
+
+              magnitude_db = 20 * torch.log10(stft_results.abs() + 1e-6)
+              minimum = magnitude_db.amin(dim=(1, 2), keepdim=True)
+              maximum = magnitude_db.amax(dim=(1, 2), keepdim=True)
+              magnitude_db_normalized = ((magnitude_db - minimum) / (maximum - minimum) * 255).cpu().numpy().astype(np.uint8)
+
+              spectrograms.extend(self.resample_spectrogram_db(spectrogram, target_shape=(513, 513)) for spectrogram in magnitude_db_normalized)
+
+      return spectrograms
+
+  def render_spectrogram_png(self, spectrogram_db, show_axis=True):
+      """PNG image (bytes) of a spectrogram as stored in the spectrogram dataset.
+
+      The mix spectrograms are rendered with their axes and the sources without, which the
+      masks and the model inputs depend on. The figure does not go through pyplot, so that
+      images can be rendered by several threads (see 'output_writer').
+      """
+      import io
+      from matplotlib.figure import Figure
+
+      fig = Figure(figsize=(7, 7))
+      ax = fig.add_subplot()
+      cax = ax.imshow(spectrogram_db, aspect='auto', origin='lower', interpolation=None,  cmap='viridis')
+      if not show_axis:
+          ax.axis('off')
+      # fig.colorbar(cax, format='%+2.0f dB')
+      cbar = fig.colorbar(cax)
+      cbar.remove()
+      fig.tight_layout()
+
+      image = io.BytesIO()
+      fig.savefig(image, format='png')
+      return image.getvalue()
+
+  def save_spectrogram_image(self, spectrogram_db, image_path, show_axis=True):
+      write_bytes(image_path, self.render_spectrogram_png(spectrogram_db, show_axis=show_axis))
+
+  def create_spectrogram_dataset(self, unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar', 'Others'], data='train', work_plan=None):
+      import functools
+      import librosa
+
       try:
           # If the folder to store the data is not present then it is created
-          if not os.path.exists('Spectrogram_Dataset'):
-              os.makedirs('Spectrogram_Dataset', exist_ok=True)
+          if not os.path.exists(self.spectrogram_dataset_folder):
+              os.makedirs(self.spectrogram_dataset_folder, exist_ok=True)
 
           # Creating input and output folder
-          if not os.path.exists(os.path.join('Spectrogram_Dataset', data, 'Input')):
-              os.makedirs(os.path.join('Spectrogram_Dataset', data, 'Input'), exist_ok=True)
+          if not os.path.exists(os.path.join(self.spectrogram_dataset_folder, data, 'Input')):
+              os.makedirs(os.path.join(self.spectrogram_dataset_folder, data, 'Input'), exist_ok=True)
 
-          if not os.path.exists(os.path.join('Spectrogram_Dataset', data, 'Output')):
-              os.makedirs(os.path.join('Spectrogram_Dataset', data, 'Output'), exist_ok=True)
+          if not os.path.exists(os.path.join(self.spectrogram_dataset_folder, data, 'Output')):
+              os.makedirs(os.path.join(self.spectrogram_dataset_folder, data, 'Output'), exist_ok=True)
 
-          for unique_track in unique_tracks: # For every unique trackk
-              track_df = df[df['Folder Name'] == unique_track] # Filtering the data base on the unique track
-              if all(True for instr in four_instr if instr in track_df['Instrument Class']):  # If all the four main instruments are present in the mixed audio
+          # float32 accumulators reused for every track
+          buffers = self.allocate_track_buffers(['Piano', 'Guitar', 'Bass', 'Drums', 'Others'])
 
-                  # Merging the multiple audio files of same instrument if required
-                  y_piano, y_guitar, y_bass, y_drums, sr_piano, sr_guitar, sr_bass, sr_drums = self.merge_main_four_tracks(unique_track, data=data)
+          # Deciding from the audio headers which tracks are eligible before decoding anything
+          if work_plan is None:
+              work_plan = self.plan_tracks(unique_tracks, self.required_instruments(four_instr), data=data)
 
-                  # If there is not other instrument present other than the main four then dummy others audio is created.
-                  if 'Others' not in track_df.iloc[:, 3].unique():
-                      y_others = np.zeros(int(180 * 10880)).reshape(-1, 1)
-                      sr_others = 10880
-                  else:
-                      y_others, sr_others = self.merge_tracks(track_df, 'Others', data=data)
+          with self.output_writer() as writer:
+              for entry in work_plan: # For every track of the plan
+                  with memory_instrumentation.track(entry['track']):
+                      unique_track = entry['track']
+                      if entry['eligible']:  # If all the four main instruments and the mix are readable
+
+                          # Merging the multiple audio files of same instrument if required (dummy silent audio for missing 'Others')
+                          stems = self.merge_planned_stems(entry, buffers)
+                          y_piano, y_guitar, y_bass, y_drums, y_others = stems['Piano'], stems['Guitar'], stems['Bass'], stems['Drums'], stems['Others']
                   
-                  if y_piano is not None and y_drums is not None and y_bass is not None and y_guitar is not None and y_others is not None:
-                      # Creating a folder for each unique track if it is not already present
-                      if not os.path.exists(os.path.join('Spectrogram_Dataset', data, 'Output', str(unique_track))):
-                          os.makedirs(os.path.join('Spectrogram_Dataset', data, 'Output' ,str(unique_track)), exist_ok=True)
-
-                      y_mix, sr_mix = librosa.load(os.path.join('Slakh2100', data, str(unique_track), 'mix.flac'), mono=True, sr=10880)
-
-                      # Defining the parameters for the mel spectrogram
-                      window_length = 1022
-                      hop_length = 512
-                      sample_rate = 10880
-
-                      # for input audio
-                      # performing short time fourier transform (STFT) with hanning window
-                      y_mix = y_mix.reshape(1, -1) # torchaudio needs the shape (num_channels, num_samples)
-
-                      input_log_magnitude_spectrogram_db = self.create_log_magnitude_spectrogram(y_mix, window_length, hop_length, sample_rate)
-
-                      # plotting and saving the mel-spectrogram
-                      fig = plt.figure(figsize=(7,7))
-                      cax = plt.imshow(input_log_magnitude_spectrogram_db, aspect='auto', origin='lower', interpolation=None,  cmap='viridis')
-                      # plt.colorbar(format='%+2.0f dB')
-                      cbar = plt.colorbar(cax)
-                      cbar.remove()
-                      plt.tight_layout()
-                      plt.savefig(os.path.join('Spectrogram_Dataset', data, 'Input', f"{unique_track}_mix.png"))
-                      plt.close(fig)
-
-                      outputs = [y_piano, y_guitar, y_bass, y_drums, y_others]
-                      instr_names = ['Piano', 'Guitar', 'Bass', 'Drums', 'Others']
-                      # for output audios
-                      for index, output in enumerate(outputs):
-                          if output is not None:
-                              output = output.reshape(1, -1) # torchaudio needs the shape (num_channels, num_samples)
-                              output_mel_spectrogram_db = self.create_log_magnitude_spectrogram(output, window_length, hop_length, sample_rate)
+                          # Creating a folder for each unique track if it is not already present
+                          if not os.path.exists(os.path.join(self.spectrogram_dataset_folder, data, 'Output', str(unique_track))):
+                              os.makedirs(os.path.join(self.spectrogram_dataset_folder, data, 'Output' ,str(unique_track)), exist_ok=True)
+
+                          y_mix, sr_mix = librosa.load(entry['mix'], mono=True, sr=10880)
+
+                          # Defining the parameters for the mel spectrogram
+                          window_length = 1022
+                          hop_length = 512
+                          sample_rate = 10880
+
+                          # for input audio
+                          # performing short time fourier transform (STFT) with hanning window
+                          y_mix = y_mix.reshape(1, -1) # torchaudio needs the shape (num_channels, num_samples)
+
+                          input_log_magnitude_spectrogram_db = self.create_log_magnitude_spectrogram(y_mix, window_length, hop_length, sample_rate)
+
+                          # plotting and saving the mel-spectrogram (rendered by the writer threads)
+                          writer.submit(os.path.join(self.spectrogram_dataset_folder, data, 'Input', f"{unique_track}_mix.png"),
+                                        functools.partial(self.save_spectrogram_image, input_log_magnitude_spectrogram_db, show_axis=True))
+
+                          outputs = [y_piano, y_guitar, y_bass, y_drums, y_others]
+                          instr_names = ['Piano', 'Guitar', 'Bass', 'Drums', 'Others']
+                          # for output audios
+                          for index, output in enumerate(outputs):
+                              if output is not None:
+                                  output = output.reshape(1, -1) # torchaudio needs the shape (num_channels, num_samples)
+                                  output_mel_spectrogram_db = self.create_log_magnitude_spectrogram(output, window_length, hop_length, sample_rate)
           
-                              # plotting and saving the spectrogram
-                              fig = plt.figure(figsize=(7, 7))
-                              cax = plt.imshow(output_mel_spectrogram_db, aspect='auto', origin='lower', interpolation=None,  cmap='viridis')
-                              plt.axis('off')
-                              # plt.colorbar(format='%+2.0f dB')
-                              cbar = plt.colorbar(cax)
-                              cbar.remove()
-                              plt.tight_layout()
-                              plt.savefig(os.path.join('Spectrogram_Dataset', data, 'Output', str(unique_track), f"{instr_names[index]}.png"))
-                              plt.close(fig)
+                                  # plotting and saving the spectrogram
+                                  writer.submit(os.path.join(self.spectrogram_dataset_folder, data, 'Output', str(unique_track), f"{instr_names[index]}.png"),
+                                                functools.partial(self.save_spectrogram_image, output_mel_spectrogram_db, show_axis=False))
 
           logger.info('Spectrogram Dataset Created.')                            
 
@@ -297,54 +589,182 @@ class DataLoadingProcessing:
           raise e
 
   def load_spectrogram_image(self, image_path):
+      from PIL import Image
+
       # Opening the image using PIL and convert to grayscale
       img = Image.open(image_path).convert('L')
       img_array = np.array(img)
       return img_array
     
-  def create_mask_dataset(self, data='train'):
-      
-      output_dirs = os.listdir(os.path.join('Spectrogram_Dataset', data, 'Output'))
+  @memory_instrumentation.instrumented('soft_masks')
+  def compute_soft_masks(self, source_img_array):
+      # Calculate the sum of all sources' magnitudes at each time-frequency point
+      magnitude_sum = np.sum(source_img_array, axis=0)  # along the dimension of sources
 
-      for output_dir in output_dirs:
+      # Computing the soft masks
+      epsilon = 1e-10
+      magnitude_sum = np.maximum(magnitude_sum, epsilon) # ensuring no zero values are present in the sum
 
-          output_dir_path = os.path.join('Spectrogram_Dataset', data, 'Output', output_dir)
-          source_images = os.listdir(output_dir_path)
+      return source_img_array / magnitude_sum
 
-          source_img_array = [self.load_spectrogram_image(os.path.join(output_dir_path, source_image)) for source_image in source_images]
-          
-          # Calculate the sum of all sources' magnitudes at each time-frequency point
-          magnitude_sum = np.sum(source_img_array, axis=0)  # along the dimension of sources
+  def save_mask_image(self, softmask, image_path):
+      from matplotlib.figure import Figure
+
+      # Without pyplot, so that the writer threads can render masks concurrently
+      fig = Figure(figsize=(7,7))
+      ax = fig.add_subplot()
+      ax.axis('off')
+      ax.imshow(softmask, cmap='gray', origin='lower', aspect='auto')
+      fig.savefig(image_path, bbox_inches='tight', transparent=True)
+
+  def create_mask_dataset(self, data='train', tracks=None):
+      import functools
 
-          # Computing the soft masks
-          epsilon = 1e-10
-          magnitude_sum = np.maximum(magnitude_sum, epsilon) # ensuring no zero values are present in the sum
+      output_dirs = os.listdir(os.path.join(self.spectrogram_dataset_folder, data, 'Output'))
 
-          softmasks = source_img_array / magnitude_sum
+      # Restricting to the given tracks if required
+      if tracks is not None:
+          output_dirs = [output_dir for output_dir in output_dirs if output_dir in tracks]
 
-          if not os.path.exists('Final_Dataset'):
-              os.makedirs('Final_Dataset', exist_ok=True)
+      with self.output_writer() as writer:
+          for output_dir in output_dirs:
+              with memory_instrumentation.track(output_dir):
+                  output_dir_path = os.path.join(self.spectrogram_dataset_folder, data, 'Output', output_dir)
+                  # Leftovers of an interrupted writer are not spectrograms of the track
+                  source_images = [source_image for source_image in os.listdir(output_dir_path) if not is_temporary(source_image)]
 
-          if not os.path.exists(os.path.join('Final_Dataset', data, 'Output')):
-              os.makedirs(os.path.join('Final_Dataset', data, 'Output'))
+                  source_img_array = [self.load_spectrogram_image(os.path.join(output_dir_path, source_image)) for source_image in source_images]
+                  softmasks = self.compute_soft_masks(source_img_array)
 
-          for index, softmask in enumerate(softmasks):
+                  if not os.path.exists(self.final_dataset_folder):
+                      os.makedirs(self.final_dataset_folder, exist_ok=True)
 
-              if not os.path.exists(os.path.join('Final_Dataset', data, 'Output', output_dir)):
-                  os.makedirs(os.path.join('Final_Dataset', data, 'Output', output_dir), exist_ok=True)
+                  if not os.path.exists(os.path.join(self.final_dataset_folder, data, 'Output')):
+                      os.makedirs(os.path.join(self.final_dataset_folder, data, 'Output'))
 
-              fig = plt.figure(figsize=(7,7))
-              plt.axis('off')
-              plt.imshow(softmask, cmap='gray', origin='lower', aspect='auto')
-              plt.savefig(os.path.join('Final_Dataset', data, 'Output', output_dir, source_images[index]), bbox_inches='tight', transparent=True)
-              plt.close(fig)
+                  for index, softmask in enumerate(softmasks):
+
+                      if not os.path.exists(os.path.join(self.final_dataset_folder, data, 'Output', output_dir)):
+                          os.makedirs(os.path.join(self.final_dataset_folder, data, 'Output', output_dir), exist_ok=True)
+
+                      writer.submit(os.path.join(self.final_dataset_folder, data, 'Output', output_dir, source_images[index]),
+                                    functools.partial(self.save_mask_image, softmask))
 
       logger.info('Output Mask Created.')
+
+  def process_track_fused(self, entry, buffers, writer, data='train', outputs=('audio', 'spectrogram', 'masks'), sample_rate=10880):
+    """Builds the requested artifacts of one eligible track in a single pass.
+
+    Every stem and the mix are decoded once into 'buffers', the spectrograms of the mix and
+    the five sources come from one batched STFT, and the soft masks are computed from the
+    spectrogram images in memory. Only the artifacts in 'outputs' are written:
+      'audio': the audio dataset (WAVs)
+      'spectrogram': the spectrogram dataset (PNGs)
+      'masks': the final dataset, i.e. the mix spectrogram as input and the soft masks as output
+
+    Unlike 'create_spectrogram_dataset', the mix spectrogram is computed on the mix cut or
+    padded to the target duration, the same span as the stems it is paired with.
+
+    The files are handed to 'writer' (an 'OutputWriter'), which writes them while the next
+    track is processed.
+    """
+    import io
+    import functools
+    import soundfile as sf
+
+    track = entry['track']
+    stems = self.merge_planned_stems(entry, buffers)
+
+    y_mix = buffers['Mix']
+    y_mix.fill(0)
+    self.load_into_buffer(entry['mix'], y_mix, sample_rate=sample_rate)
+
+    if 'audio' in outputs:
+      output_folder = os.path.join(self.audio_dataset_folder, data, 'Output', track)
+      os.makedirs(output_folder, exist_ok=True)
+      os.makedirs(os.path.join(self.audio_dataset_folder, data, 'Input'), exist_ok=True)
+
+      # The drum stems of the audio dataset are written as 'Drum.wav' (copies: the buffers are reused by the next track)
+      for instrument in ['Piano', 'Drums', 'Bass', 'Guitar', 'Others']:
+        file_name = 'Drum.wav' if instrument == 'Drums' else f'{instrument}.wav'
+        writer.submit(os.path.join(output_folder, file_name), sf.write, stems[instrument].copy(), sample_rate)
+      writer.submit(os.path.join(self.audio_dataset_folder, data, 'Input', f'{track}_mix.wav'), sf.write, y_mix.copy(), sample_rate)
+
+    if 'spectrogram' not in outputs and 'masks' not in outputs:
+      return
+
+    instr_names = ['Piano', 'Guitar', 'Bass', 'Drums', 'Others']
+    spectrograms = self.create_log_magnitude_spectrograms(np.stack([y_mix] + [stems[instrument] for instrument in instr_names]))
+
+    mix_png = self.render_spectrogram_png(spectrograms[0], show_axis=True)
+    source_pngs = [self.render_spectrogram_png(spectrogram, show_axis=False) for spectrogram in spectrograms[1:]]
+
+    if 'spectrogram' in outputs:
+      output_folder = os.path.join(self.spectrogram_dataset_folder, data, 'Output', track)
+      os.makedirs(output_folder, exist_ok=True)
+      os.makedirs(os.path.join(self.spectrogram_dataset_folder, data, 'Input'), exist_ok=True)
+
+      writer.submit(os.path.join(self.spectrogram_dataset_folder, data, 'Input', f'{track}_mix.png'), write_bytes, mix_png)
+      for instrument, png in zip(instr_names, source_pngs):
+        writer.submit(os.path.join(output_folder, f'{instrument}.png'), write_bytes, png)
+
+    if 'masks' in outputs:
+      output_folder = os.path.join(self.final_dataset_folder, data, 'Output', track)
+      os.makedirs(output_folder, exist_ok=True)
+      os.makedirs(os.path.join(self.final_dataset_folder, data, 'Input'), exist_ok=True)
+
+      # The masks are computed from the rendered images, exactly as 'create_mask_dataset' reads them back
+      softmasks = self.compute_soft_masks([self.load_spectrogram_image(io.BytesIO(png)) for png in source_pngs])
+      for instrument, softmask in zip(instr_names, softmasks):
+        writer.submit(os.path.join(output_folder, f'{instrument}.png'), functools.partial(self.save_mask_image, softmask))
+
+      writer.submit(os.path.join(self.final_dataset_folder, data, 'Input', f'{track}_mix.png'), write_bytes, mix_png)
+
+  def create_datasets(self, unique_tracks, data='train', outputs=('audio', 'spectrogram', 'masks'), work_plan=None):
+    """Builds the requested datasets ('audio', 'spectrogram', 'masks') of a list of tracks.
+
+    In fused mode every track goes through 'process_track_fused', one decode per stem;
+    otherwise the audio, spectrogram and mask stages run one after the other.
+    """
+    import shutil
+
+    # Deciding from the audio headers which tracks are eligible before decoding anything
+    if work_plan is None:
+      work_plan = self.plan_tracks(list(unique_tracks), data=data)
+
+    if self.fused:
+      # float32 accumulators reused for every track
+      buffers = self.allocate_track_buffers(['Piano', 'Guitar', 'Bass', 'Drums', 'Others', 'Mix'])
+
+      with self.output_writer() as writer:
+        for entry in work_plan:
+          if entry['eligible']:
+            with memory_instrumentation.track(entry['track']):
+              self.process_track_fused(entry, buffers, writer, data=data, outputs=outputs)
+
+      logger.info(f"Datasets {', '.join(outputs)} of {data} created in fused mode.")
+      return
+
+    if 'audio' in outputs:
+      self.create_audio_dataset(unique_tracks, data=data, work_plan=work_plan)
+
+    if 'spectrogram' in outputs:
+      self.create_spectrogram_dataset(unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar'], data=data, work_plan=work_plan)
+
+    if 'masks' in outputs:
+      tracks = [entry['track'] for entry in work_plan if entry['eligible']]
+      self.create_mask_dataset(data=data, tracks=tracks)
+
+      # Copying input sepctrograms to the final dataset folder
+      os.makedirs(os.path.join(self.final_dataset_folder, data, 'Input'), exist_ok=True)
+      for track in tracks:
+        shutil.copy2(os.path.join(self.spectrogram_dataset_folder, data, 'Input', f'{track}_mix.png'),
+                     os.path.join(self.final_dataset_folder, data, 'Input', f'{track}_mix.png'))
       
 if __name__ == "__main__":
+  import pandas as pd
 
   # SETTING UP THE LOGGING MECHANISM
-  logger = logging.getLogger(__name__)
   logger.setLevel(logging.INFO)
 
   Utility().create_folder('Logs')
@@ -362,6 +782,8 @@ if __name__ == "__main__":
   logger.addHandler(file_handler)
 
   # STARTING THE EXECUTION OF FUNCTIONS
+  memory_instrumentation.enable(params['Memory'])
+
   # Type of data
   data = 'test'
     
@@ -374,26 +796,19 @@ if __name__ == "__main__":
   # Unique track folders
   unique_tracks = df['Folder Name'].unique()
 
-  # Creating an instance of the class
-  dlp = DataLoadingProcessing()
+  # Creating an instance of the class (fused mode: one decode per stem for all the datasets)
+  dlp = DataLoadingProcessing(fused=params['Data']['Fused_Preprocessing'], writer_threads=params['Data']['Writer_Threads'],
+                              writer_queue_size=params['Data']['Writer_Queue_Size'])
   
   # Replacing all the instruments except in ['Piano', 'Drums', 'Bass', 'Guitar'] with 'Others' tag in csv file
   df = dlp.replace_other_track_labels(df, four_instr)
+  dlp.metadata_df = df
 
-  # create audio dataset
-  dlp.create_audio_dataset(unique_tracks, data=data)
-  
-  # create spectrogram dataset
-  # dlp.create_spectrogram_dataset(unique_tracks, four_instr=['Piano', 'Drums', 'Bass', 'Guitar'], data=data)
-  
-  # Creating final dataset i.e., input --> spectrogram, output --> softmasks
-  
-  # Copying input sepctrograms to the final dataset folder
-  # source_folder = os.path.join('Spectrogram_Dataset', data, 'Input')
-  # destination_folder = os.path.join('Final_Dataset', data, 'Input')
-  # shutil.copytree(source_folder, destination_folder, dirs_exist_ok=True)
-  
-  # dlp.create_mask_dataset(data=data)
-  
-  
-  
\ No newline at end of file
+  # Planning the work from the metadata and the audio headers: eligible tracks, stems to decode, silent instruments
+  work_plan = dlp.plan_tracks(list(unique_tracks), data=data)
+  dlp.write_work_plan(work_plan, f'work_plan_{data}.json')
+
+  # create audio dataset; add 'spectrogram' and 'masks' to also create the spectrogram dataset and
+  # the final dataset (input --> spectrogram, output --> softmasks)
+  outputs = ['audio']
+  dlp.create_datasets(unique_tracks, data=data, outputs=outputs, work_plan=work_plan)
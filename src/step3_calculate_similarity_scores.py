@@ -1,83 +1,283 @@
 import os
 import time
-import librosa
-import numpy as np
+import hashlib
 import logging
-import torch
-import matplotlib.pyplot as plt
-from sklearn.metrics.pairwise import cosine_similarity
-from prediction_funcs import Predictions
-from step2_DatasetLoading import DataLoadingProcessing
-from step4_ModelTraining import UNET
+import threading
+from collections import OrderedDict
+import numpy as np
+import memory_instrumentation
 from step0_utility_functions import Utility
 
+# librosa, torch and the model code are imported inside the methods that need them
+# so that importing this module (e.g. from the web app) stays cheap
+
+# Serving state shared by the requests of this process, see 'embed_within_budget':
+# embeddings by content hash (least recently used first), moving average of the unloaded
+# cost (seconds) of every tier, and number of embedding requests submitted and not finished
+# (waiting for a worker thread or being computed)
+_embedding_cache = OrderedDict()
+_tier_costs = dict()
+_requests_pending = 0
+_serving_lock = threading.Lock()
+
+# Models of the 'fast' tier by checkpoint path, with the stat of the files they were loaded
+# from so that a retrained model is picked up (own lock: loading must not block the counters)
+_fast_models = dict()
+_fast_models_lock = threading.Lock()
+
+logger = logging.getLogger(__name__)
+
 class SimScore:
 
     def __init__(self):
         pass
 
     def get_instrument_duration(self, file_path):
+        import librosa
 
         # load audio file
         y, sr = librosa.load(file_path)
 
+        return self.get_waveform_duration(y)
+
+    def get_waveform_duration(self, y):
+        """Returns the fraction of an in-memory waveform that is not silent."""
+        import librosa
+
         # identity non-silent intervals
         intervals = librosa.effects.split(y, top_db=20)
 
-        # calculate total duration of non-silent segment
-        duration = np.sum([(end - start) / sr for start, end in intervals])
+        # calculate total number of non-silent samples
+        duration = np.sum([end - start for start, end in intervals])
 
-        # Total duration of an audio
-        total_duration = librosa.get_duration(y=y, sr=sr)  
-        
-        return duration/total_duration
+        return duration / len(y)
+
+    @memory_instrumentation.instrumented('separate_user_song')
+    def separate_user_song(self, song_file_path=os.path.join('user_ip_wavfile_folder', 'wavfile.wav'), waveform=None):
+        """Separates the sources of a song with the trained model.
 
-    def calculate_instrument_durations(self, song_file_path=os.path.join('user_ip_wavfile_folder', 'wavfile.wav')):
+        'waveform' is the song already decoded at 10880 Hz and 180 seconds long (see
+        'DataLoadingProcessing.stream_into_buffer'); the file is read otherwise.
+
+        Returns
+        --------
+        (sources x samples) array, sources in the order of the model outputs
+        """
+        import librosa
+        import torch
+        from prediction_funcs import Predictions
+        from step2_DatasetLoading import DataLoadingProcessing
+        from step4_ModelTraining import UNET
         
         device = 'cuda' if torch.cuda.is_available() else 'cpu'
         # Loading the trained model
-        model = UNET(1, 5)
-        state_dict = torch.load(os.path.join('Models', 'model_weights.pth'), map_location=torch.device(device), weights_only=True)
-        model.load_state_dict(state_dict)
-        
-        # Finding the wavform and sample rate
-        y, sr = librosa.load(song_file_path, mono=True, sr=10880)
+        model = UNET.load(os.path.join('Models', 'model_weights.pth'), map_location=device)
+        model = model.to(device)
         
-        # Making length = 180 seconds
-        y = DataLoadingProcessing().make_lengths_same(y, sr)
+        if waveform is not None:
+            y = waveform
+        else:
+            # Finding the wavform and sample rate
+            y, sr = librosa.load(song_file_path, mono=True, sr=10880)
+            
+            # Making length = 180 seconds
+            y = DataLoadingProcessing().make_lengths_same(y, sr)
         
         user_ip_spectrogram = DataLoadingProcessing().create_log_magnitude_spectrogram(y, window_length=1022, hop_length=512, sample_rate=10880)
         
-        if not os.path.exists('User_ip_spectrogram'):
-            os.makedirs('User_ip_spectrogram')
-        
-        fig = plt.figure(figsize=(7,7))
-        cax = plt.imshow(user_ip_spectrogram, aspect='auto', origin='lower', interpolation=None,  cmap='viridis')
-        cbar = plt.colorbar(cax)
-        cbar.remove()
-        plt.tight_layout()
-        plt.savefig(os.path.join('User_ip_spectrogram', f"user_ip_spectrogram.png"))
-        plt.close(fig)
+        # Rendering the model input in memory (same figure layout as the training images) instead of through a png file
+        model_input = Predictions().spectrogram_image_tensor(torch.from_numpy(user_ip_spectrogram).unsqueeze(0))
         
         # Predicting the softmask of sources
-        softmasks = Predictions().predict_source_masks(model, os.path.join('User_ip_spectrogram', f"user_ip_spectrogram.png"))
+        softmasks = Predictions().predict_source_masks_batch(model, model_input).numpy()
         
-        # Separating sources i.e., saving separated sources into wavforms
-        separated_sources = Predictions().separate_sources(torch.tensor(y, dtype=torch.float32), softmasks)
+        # Separating sources (one batched inverse STFT for all of them)
+        separated_sources = Predictions().separate_sources(torch.tensor(y, dtype=torch.float32), softmasks).numpy()
+
+        return separated_sources
+
+    def calculate_instrument_durations(self, song_file_path=os.path.join('user_ip_wavfile_folder', 'wavfile.wav'), waveform=None):
+        from prediction_funcs import Predictions
+
+        separated_sources = self.separate_user_song(song_file_path, waveform=waveform)
         
-        # Calculating the durations of sources
+        # Calculating the durations of sources, in the order of the catalog columns
         durations = list()
-        source_files = os.listdir(os.path.join('Outputs'))
-        
-        for source in source_files:
-            path = os.path.join('Outputs', source)
-            durations.append(self.get_instrument_duration(path))
+        for instrument in Predictions.catalog_instruments:
+            source = separated_sources[Predictions.model_sources.index(instrument)]
+            durations.append(self.get_waveform_duration(source))
             
-        return durations  # Guitar, Drums, Piano, Bass, Others
+        return durations  # Bass, Drums, Guitar, Piano, Others
+
+    def calculate_instrument_envelopes(self, song_file_path=os.path.join('user_ip_wavfile_folder', 'wavfile.wav'), num_frames=360):
+        """Activity envelopes of the separated sources of a song, in the order of the catalog columns."""
+        from prediction_funcs import Predictions
+        from temporal_embeddings import TemporalEmbedding
+
+        separated_sources = self.separate_user_song(song_file_path)
+        order = [Predictions.model_sources.index(instrument) for instrument in Predictions.catalog_instruments]
+
+        return TemporalEmbedding().envelopes(separated_sources[order], num_frames=num_frames)
+
+    def fast_instrument_durations(self, waveform, model_path=os.path.join('Models', 'model_weights.pth'), image_size=(256, 256), top_db=20):
+        """Approximate 'calculate_instrument_durations' for the 'fast' serving tier.
+
+        The model runs on a lower resolution input ('image_size') and the separated sources
+        are never synthesized: a frame of a source is active when the energy of its masked STFT
+        is within 'top_db' of the loudest frame of that source, like the silence split of
+        'get_waveform_duration' but on the STFT frames. The model is loaded once per process
+        ('fast_model') and its input is drawn from the measured figure layout, without matplotlib.
+        """
+        import torch
+        import torch.nn as nn
+        from prediction_funcs import Predictions
+
+        model = self.fast_model(model_path)
+
+        stft_results, model_input = Predictions().spectrogram_batch(torch.as_tensor(waveform, dtype=torch.float32).unsqueeze(0), image_size=image_size)
+        softmasks = Predictions().predict_source_masks_batch(model, model_input)
+
+        # Masks back to the (freq_bins, frames) grid of the STFT, as in 'separate_sources_batch'
+        masks = nn.functional.interpolate(torch.flip(softmasks, dims=[-2]), size=stft_results.shape[-2:], mode='bilinear', align_corners=False)[0]
+        frame_energy = torch.sum((masks * stft_results.abs()) ** 2, dim=1)  # (sources, frames)
+
+        frame_db = 10 * torch.log10(frame_energy + 1e-10)
+        active = frame_db > frame_db.amax(dim=1, keepdim=True) - top_db
+        durations = active.float().mean(dim=1).numpy()
+
+        return [float(durations[Predictions.model_sources.index(instrument)]) for instrument in Predictions.catalog_instruments]
+
+    def fast_model(self, model_path):
+        """Model of the 'fast' tier, loaded once per process and reloaded when its checkpoint or shared weights change."""
+        from step4_ModelTraining import UNET
+
+        weights_paths = (model_path, os.path.splitext(model_path)[0] + '.npy')
+        stat = tuple((os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path) else None for path in weights_paths)
+
+        with _fast_models_lock:
+            cached = _fast_models.get(model_path)
+            if cached is None or cached[0] != stat:
+                cached = (stat, UNET.load(model_path))
+                _fast_models[model_path] = cached
+            return cached[1]
+
+    def estimated_seconds(self, tier, queue_depth):
+        """Expected latency of a tier with 'queue_depth' other embeddings sharing the CPU, None if never measured."""
+
+        cost = _tier_costs.get(tier)
+        return None if cost is None else cost * (1 + queue_depth)
+
+    def tier_fits(self, tier, latency_budget, queue_depth):
+        if latency_budget <= 0:
+            return False
+
+        estimate = self.estimated_seconds(tier, queue_depth)
+        if estimate is None:
+            # Not measured yet: only tried on an idle server
+            return queue_depth == 0
+        return estimate <= latency_budget
+
+    def register_request(self):
+        """Counts an embedding request as pending from the moment it is submitted to a worker thread.
+
+        The request must then be passed to 'embed_within_budget' with the returned time as
+        'submitted_at' (or given up with 'release_request'), so that the time it waited in the
+        queue of the workers is charged to its latency budget.
+
+        Returns
+        --------
+        Submission time (time.perf_counter())
+        """
+        global _requests_pending
+
+        with _serving_lock:
+            _requests_pending += 1
+        return time.perf_counter()
+
+    def release_request(self):
+        global _requests_pending
+
+        with _serving_lock:
+            _requests_pending -= 1
+
+    def embed_within_budget(self, waveform, latency_budget, fast_model_path=None, fast_image_size=(256, 256), cache_size=256, submitted_at=None):
+        """Embedding of a song chosen among the serving tiers to fit 'latency_budget' (seconds).
+
+        Tiers, from best to cheapest:
+          'full': 'calculate_instrument_durations'
+          'cached:full', 'cached:fast': a previous full or fast embedding of the same audio
+          'fast': 'fast_instrument_durations', with the smaller model at 'fast_model_path' if given
+
+        A full embedding is served from the cache. Otherwise the full pipeline runs when its
+        measured cost, scaled by the number of other pending requests, fits what is left of the
+        budget; a cached fast embedding or a new fast one is used when it does not, so overload
+        degrades the quality of the recommendations instead of their latency.
+
+        'submitted_at' is the time returned by 'register_request' when the request was queued
+        for a worker thread; the time since then is deducted from the budget. Without it the
+        request is registered on arrival.
+
+        Returns
+        --------
+        (durations, tier): durations in the order of the catalog columns, and the tier used
+        """
+
+        if submitted_at is None:
+            submitted_at = self.register_request()
+
+        try:
+            waveform = np.asarray(waveform, dtype=np.float32)
+            key = hashlib.sha1(waveform.tobytes()).hexdigest()
+
+            with _serving_lock:
+                cached = _embedding_cache.get(key)
+                if cached is not None:
+                    _embedding_cache.move_to_end(key)
+                queue_depth = _requests_pending - 1
+
+            waited = time.perf_counter() - submitted_at
+            remaining_budget = latency_budget - waited
+
+            full_fits = self.tier_fits('full', remaining_budget, queue_depth)
+            if cached is not None and (cached[0] == 'full' or not full_fits):
+                return cached[1], f'cached:{cached[0]}'
+
+            tier = 'full' if full_fits else 'fast'
+            started = time.perf_counter()
+            if tier == 'full':
+                durations = self.calculate_instrument_durations(waveform=waveform)
+            else:
+                durations = self.fast_instrument_durations(waveform, model_path=fast_model_path or os.path.join('Models', 'model_weights.pth'),
+                                                           image_size=fast_image_size)
+            elapsed = time.perf_counter() - started
+
+            with _serving_lock:
+                # Measured under load, normalized back to the cost on an idle server
+                cost = elapsed / (1 + queue_depth)
+                _tier_costs[tier] = cost if tier not in _tier_costs else 0.7 * _tier_costs[tier] + 0.3 * cost
+
+                _embedding_cache[key] = (tier, durations)
+                _embedding_cache.move_to_end(key)
+                while len(_embedding_cache) > cache_size:
+                    _embedding_cache.popitem(last=False)
+
+            logger.info(f"'{tier}' embedding in {elapsed:.2f} s after {waited:.2f} s in the queue "
+                        f"(budget {latency_budget:.2f} s, {queue_depth} other request(s) pending).")
+            return durations, tier
+
+        finally:
+            self.release_request()
+
+    def calculate_db_durations(self, test_folder=os.path.join('Audio_Dataset', 'test', 'Output'), instruments= ['Bass', 'Drums', 'Guitar', 'Piano', 'Others'], output_file_path='db_duration_matrix.npy', ids_file_path='db_track_ids.txt', envelopes_file_path=None, num_frames=360):
+        """Builds the catalog matrix (and, if 'envelopes_file_path' is given, the matching activity envelopes)."""
+        if envelopes_file_path is not None:
+            from temporal_embeddings import TemporalEmbedding
+            temporal_embedding = TemporalEmbedding()
 
-    def calculate_db_durations(self, test_folder=os.path.join('Audio_Dataset', 'test', 'Output'), instruments= ['Bass', 'Drums', 'Guitar', 'Piano', 'Others'], output_file_path='db_duration_matrix.npy'):
         # Initialize the matrix
         duration_matrix = []
+        envelopes = []
+        track_ids = []
         
         # Process each track folder
         for track_folder in sorted(os.listdir(test_folder)):
@@ -88,10 +288,13 @@ class SimScore:
 
             # Calculate durations for the current track
             track_durations = []
-            for instrument in instruments:
+            track_envelopes = np.zeros((len(instruments), num_frames), dtype=np.float16)
+            for index, instrument in enumerate(instruments):
                 instrument_file = os.path.join(track_path, f"{instrument}.wav")
                 if os.path.exists(instrument_file):
                     duration_percentage = self.get_instrument_duration(instrument_file)
+                    if envelopes_file_path is not None:
+                        track_envelopes[index] = temporal_embedding.file_envelope(instrument_file, num_frames)
                 else:
                     duration_percentage = 0.0
                     
@@ -99,28 +302,120 @@ class SimScore:
 
             # Append to the matrix
             duration_matrix.append(track_durations)
+            envelopes.append(track_envelopes)
+            track_ids.append(os.path.join('Audio_Dataset', 'test', 'Input', f"{track_folder}_mix.wav"))
 
         duration_matrix = np.array(duration_matrix)
         np.save(output_file_path, duration_matrix)
 
+        if envelopes_file_path is not None:
+            # (tracks x instruments x frames), same row order as the matrix
+            np.save(envelopes_file_path, np.stack(envelopes) if envelopes else np.zeros((0, len(instruments), num_frames), dtype=np.float16))
+
+        # Audio file of every row of the matrix
+        self.save_track_ids(track_ids, ids_file_path)
+
         # return duration_matrix
 
+    def catalog(self, catalog_folder='Catalog', envelopes_file_path='db_envelopes.npy'):
+        """Returns the catalog to serve from: the current published version if there is one,
+        else the matrix, ids and envelopes files written by 'calculate_db_durations'."""
+        from catalog_store import CatalogStore, CatalogVersion
+
+        catalog_store = CatalogStore(catalog_folder)
+        if catalog_store.exists():
+            return catalog_store.current()
+
+        track_ids = np.array([track_id.encode('utf-8') for track_id in self.load_track_ids()], dtype=bytes)
+        envelopes = np.load(envelopes_file_path, mmap_mode='r') if os.path.exists(envelopes_file_path) else None
+        return CatalogVersion(None, np.load('db_duration_matrix.npy', mmap_mode='r'), track_ids, envelopes)
+
     def generate_recommendations(self, user_preference):
         
         instrument_durations = self.calculate_instrument_durations()
 
+        return self.recommend_from_durations(instrument_durations, user_preference)
+
+    def generate_budgeted_recommendations(self, user_preference, latency_budget, waveform=None, **tier_options):
+        """'generate_recommendations' within a latency budget (seconds), see 'embed_within_budget'.
+
+        Returns
+        --------
+        Dictionary with the recommended track ('recommendation'), the embedding tier used
+        ('tier') and the time taken ('seconds')
+        """
+        from step2_DatasetLoading import DataLoadingProcessing
+
+        started = time.perf_counter()
+        if waveform is None:
+            waveform = np.zeros(10880 * 180, dtype=np.float32)
+            DataLoadingProcessing().stream_into_buffer(os.path.join('user_ip_wavfile_folder', 'wavfile.wav'), waveform)
+
+        instrument_durations, tier = self.embed_within_budget(waveform, latency_budget, **tier_options)
+        recommendation = self.recommend_from_durations(instrument_durations, user_preference)
+
+        return {'recommendation': recommendation, 'tier': tier, 'seconds': time.perf_counter() - started}
+
+    def recommend_from_durations(self, instrument_durations, user_preference):
+        """Scoring part of 'generate_recommendations', for an already computed query embedding."""
+
+        # One version for the whole request, even if a new one is published meanwhile
+        catalog = self.catalog()
+
         # print(f"**********instrument duration: {instrument_durations}")
-        db_durations = np.load('db_duration_matrix.npy')
+        db_durations = catalog.vectors
 
         # print(f"**********db duration: {db_durations}")
         cosine_similarity = self.calculate_similarity_score(instrument_durations, db_durations, user_preference)
         
         max_index = np.argmax(cosine_similarity)
-        song_options = sorted(os.listdir(os.path.join('Audio_Dataset', 'test', 'Input')))
         
-        recommendations_file_name = song_options[max_index]
+        recommendations_file_path = catalog.track_id(max_index)
         
-        return recommendations_file_name
+        return recommendations_file_path
+
+    def generate_temporal_recommendations(self, user_preference):
+        """Recommends the catalog track whose instruments play at the most similar times.
+
+        Same as 'generate_recommendations' with the activity envelopes instead of the
+        durations. The envelopes are memory-mapped and matched block by block, against their
+        FFTs computed once per catalog version ('CatalogVersion.envelope_spectra').
+        """
+        from temporal_embeddings import TemporalEmbedding
+
+        catalog = self.catalog()
+        db_envelopes = catalog.envelopes
+        if db_envelopes is None or db_envelopes.shape[0] != len(catalog):
+            raise ValueError("The catalog has no activity envelopes for all its tracks, rebuild it with '--temporal'.")
+
+        instrument_envelopes = self.calculate_instrument_envelopes(num_frames=db_envelopes.shape[-1])
+        preference_mask = self.preference_mask([user_preference], num_instruments=db_envelopes.shape[1])[0]
+
+        temporal_embedding = TemporalEmbedding()
+        similarity = temporal_embedding.similarity(instrument_envelopes, db_envelopes, preference_mask,
+                                                   catalog_spectra=catalog.envelope_spectra(temporal_embedding))
+
+        return catalog.track_id(int(np.argmax(similarity)))
+
+    def save_track_ids(self, track_ids, ids_file_path='db_track_ids.txt'):
+        """Writes the audio file path of every catalog row, one per line."""
+
+        with open(ids_file_path, 'w') as ids_file:
+            ids_file.write(''.join(f"{track_id}\n" for track_id in track_ids))
+
+    def load_track_ids(self, ids_file_path='db_track_ids.txt'):
+        """Reads the audio file path of every catalog row.
+
+        Catalogs built before the ids file existed only hold the test split, so the sorted
+        test input folder is used for them.
+        """
+
+        if not os.path.exists(ids_file_path):
+            input_folder = os.path.join('Audio_Dataset', 'test', 'Input')
+            return [os.path.join(input_folder, file_name) for file_name in sorted(os.listdir(input_folder))]
+
+        with open(ids_file_path, 'r') as ids_file:
+            return [line.rstrip('\n') for line in ids_file if line.strip()]
 
     def calculate_similarity_score(self, instrument_durations, db_durations, user_preference):
         
@@ -139,12 +434,130 @@ class SimScore:
         # cosine_similarity = np.dot(db_durations, instrument_durations) / (instrument_durations_magnitude * db_durations_magnitude)
         instrument_flattened = instrument_durations.flatten()
         
-        similarity = [cosine_similarity([instrument_flattened], [row])[0, 0] for row in db_durations]
+        # Same scores as sklearn's cosine_similarity row by row, computed for all rows at once
+        similarity = list(self.masked_cosine_similarity(instrument_flattened.reshape(1, -1), np.ones((1, len(user_preference)), dtype=bool), db_durations)[0])
         
         print(f"********cosine similarity: {np.array(similarity).shape}")
         
         return similarity
 
+    def preference_mask(self, user_preferences, num_instruments=5):
+        """Converts lists of preferred instrument indices (as given by the app) to a boolean (N_queries x instruments) mask."""
+
+        mask = np.zeros((len(user_preferences), num_instruments), dtype=bool)
+        for row, user_preference in enumerate(user_preferences):
+            mask[row, user_preference] = True
+
+        return mask
+
+    def masked_cosine_similarity(self, query_embeddings, preference_masks, db_block):
+        """Cosine similarity of every query with every catalog row, restricted to each query's instruments.
+
+        All the masked dot products and norms are computed with matrix multiplications. A zero
+        vector (e.g. no instrument selected) gets a similarity of 0, as with sklearn.
+
+        Parameters
+        -----------
+
+        query_embeddings: (N_queries x instruments) array
+        preference_masks: (N_queries x instruments) boolean array of the instruments each query keeps
+        db_block: (N_rows x instruments) array of catalog rows
+
+        Returns
+        --------
+        (N_queries x N_rows) float32 array of similarities
+        """
+
+        masks = preference_masks.astype(np.float32)
+        masked_queries = query_embeddings.astype(np.float32) * masks
+        db_block = db_block.astype(np.float32)
+
+        dot_products = masked_queries @ db_block.T
+        query_norms = np.linalg.norm(masked_queries, axis=1, keepdims=True)
+        db_norms = np.sqrt(masks @ (db_block ** 2).T)  # norm of every row restricted to every query's instruments
+
+        denominators = query_norms * db_norms
+        return np.divide(dot_products, denominators, out=np.zeros_like(dot_products), where=denominators > 0)
+
+    def batch_recommendations(self, query_embeddings, preference_masks, k=10, db_durations=None,
+                              track_ids=None, query_block_size=1024, db_block_size=65536, ann_index=None, num_probes=16):
+        """Scores many queries against the catalog and returns the top k catalog tracks of each.
+
+        The catalog is loaded once and scanned in blocks of 'db_block_size' rows for blocks of
+        'query_block_size' queries, keeping a running top k per query, so memory stays bounded by
+        one (query block x catalog block) score matrix whatever the number of queries.
+
+        Parameters
+        -----------
+
+        query_embeddings: (N_queries x 5) array of instrument durations (catalog column order)
+        preference_masks: (N_queries x 5) boolean array, see 'preference_mask'
+        k: Number of recommendations per query
+        db_durations: Catalog matrix, the current catalog (see 'catalog') if not given
+        track_ids: Catalog track ids, those of the current catalog if not given
+        ann_index: Optional 'IVFPQIndex' of the catalog: only 'num_probes' of its lists are
+                   scanned per query (approximate) and the best candidates are re-ranked exactly.
+                   An index built from another catalog version or row count is ignored (exact scan)
+
+        Returns
+        --------
+        (ids, scores): (N_queries x k) arrays of track ids and similarities, best first
+        """
+
+        catalog_version = None
+        if db_durations is None:
+            catalog = self.catalog()
+            db_durations, track_ids = catalog.vectors, catalog.track_ids_at(np.arange(len(catalog)))
+            catalog_version = catalog.version
+        elif track_ids is None:
+            track_ids = self.load_track_ids()
+
+        if ann_index is not None and not ann_index.matches(db_durations.shape[0], catalog_version):
+            logger.warning(f'The ANN index was built from catalog version {ann_index.catalog_version} ({len(ann_index.row_ids)} rows), '
+                           f'not {catalog_version} ({db_durations.shape[0]} rows): falling back to the exact search.')
+            ann_index = None
+
+        query_embeddings = np.asarray(query_embeddings)
+        preference_masks = np.asarray(preference_masks, dtype=bool)
+        num_queries = query_embeddings.shape[0]
+        k = min(k, db_durations.shape[0])
+
+        # Nothing to rank (empty catalog or k = 0): argpartition needs at least one column
+        if k <= 0:
+            return np.empty((num_queries, 0), dtype=object), np.empty((num_queries, 0), dtype=np.float32)
+
+        if ann_index is not None:
+            rows, scores = ann_index.search(query_embeddings, preference_masks, k=k, num_probes=num_probes, vectors=db_durations)
+            ids = np.asarray(track_ids, dtype=object)[np.maximum(rows, 0)]
+            ids[rows < 0] = None
+            return ids, scores
+
+        top_scores = np.full((num_queries, k), -np.inf, dtype=np.float32)
+        top_indices = np.zeros((num_queries, k), dtype=np.int64)
+
+        for query_start in range(0, num_queries, query_block_size):
+            query_slice = slice(query_start, query_start + query_block_size)
+            queries = query_embeddings[query_slice]
+            masks = preference_masks[query_slice]
+
+            for db_start in range(0, db_durations.shape[0], db_block_size):
+                scores = self.masked_cosine_similarity(queries, masks, np.asarray(db_durations[db_start:db_start + db_block_size]))
+                indices = np.arange(db_start, db_start + scores.shape[1])
+
+                # Merging the block with the running top k and keeping the k best
+                candidate_scores = np.concatenate([top_scores[query_slice], scores], axis=1)
+                candidate_indices = np.concatenate([top_indices[query_slice], np.broadcast_to(indices, scores.shape)], axis=1)
+                best = np.argpartition(-candidate_scores, k - 1, axis=1)[:, :k]
+                top_scores[query_slice] = np.take_along_axis(candidate_scores, best, axis=1)
+                top_indices[query_slice] = np.take_along_axis(candidate_indices, best, axis=1)
+
+        # Sorting the k best of every query
+        order = np.argsort(-top_scores, axis=1, kind='stable')
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        top_indices = np.take_along_axis(top_indices, order, axis=1)
+
+        return np.asarray(track_ids, dtype=object)[top_indices], top_scores
+
 
 if __name__ == "__main__":
 
@@ -167,6 +580,26 @@ if __name__ == "__main__":
     logger.addHandler(file_handler)
 
   # STARTING THE EXECUTION OF FUNCTIONS
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Builds the catalog embedding matrix.')
+    parser.add_argument('--temporal', action='store_true', help='Also build the activity envelopes used by the temporal recommendations')
+    args = parser.parse_args()
+
+    catalog_params = params['Catalog']
+    envelopes_file_path = catalog_params['Envelopes_File'] if args.temporal else None
+
+    # Envelopes of an earlier '--temporal' build would not match the rebuilt rows
+    if envelopes_file_path is None and os.path.exists(catalog_params['Envelopes_File']):
+        os.remove(catalog_params['Envelopes_File'])
+
     sc = SimScore()
-    sc.calculate_db_durations()
+    sc.calculate_db_durations(output_file_path=catalog_params['Catalog_File'], ids_file_path=catalog_params['Ids_File'], envelopes_file_path=envelopes_file_path)
+
+    # Publishing the new catalog so that running servers switch over to it
+    from catalog_store import CatalogStore
+
+    CatalogStore(catalog_params['Catalog_Folder'], catalog_params['Keep_Versions']).publish(
+        np.load(catalog_params['Catalog_File']), sc.load_track_ids(catalog_params['Ids_File']),
+        envelopes=np.load(envelopes_file_path) if envelopes_file_path else None)
     
\ No newline at end of file
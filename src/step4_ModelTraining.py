@@ -1,9 +1,7 @@
-from PIL import Image
 import torch
 import torch.nn as nn
 from torch.utils.data import Dataset, DataLoader
-from torchvision import transforms
-import soundfile as sf
+from torch.utils.checkpoint import checkpoint
 import os
 import logging
 import json
@@ -27,6 +25,10 @@ class UNetDataset(Dataset):
         return len(self.input_files)
 
     def __getitem__(self, idx):
+        # torchvision and PIL are only needed by the training data, not by the model used for serving
+        from PIL import Image
+        from torchvision import transforms
+
         # Load input image
         input_file = self.input_files[idx]
         input_path = os.path.join(self.input_dir, input_file)
@@ -67,37 +69,177 @@ class UNetDataset(Dataset):
 
 # Unet model
 class UNET(nn.Module):
+    """UNET with a configurable width, depth and convolution block.
+
+    The defaults (base width 32, five levels before the bottleneck, standard blocks) are the
+    original architecture, so its checkpoints load unchanged. Channels double at every level,
+    from 'base_width' to base_width x 2^depth in the bottleneck.
+
+    block_type: 'standard' (two 3x3 convolutions) or 'separable' (two depthwise 3x3 +
+                pointwise 1x1 convolutions, several times fewer FLOPs and parameters)
+
+    Training memory can be traded for compute with 'enable_gradient_checkpointing': the
+    activations inside the chosen blocks are recomputed in the backward pass instead of
+    being stored. It changes neither the weights nor the outputs.
+    """
+
+    block_types = ['standard', 'separable']
+    checkpointing_presets = ['all', 'encoders', 'decoders']
  
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, base_width=32, depth=5, block_type='standard'):
         super().__init__()
 
+        if block_type not in self.block_types:
+            raise ValueError(f"Unknown block type '{block_type}', expected one of {self.block_types}.")
+
+        self.base_width = base_width
+        self.depth = depth
+        self.block_type = block_type
+
+        widths = [base_width * 2 ** level for level in range(depth + 1)]
+
         # Encoder part of unet
-        self.encoder1 = self.conv_block(in_channels, 32)
-        self.encoder2 = self.conv_block(32, 64)
-        self.encoder3 = self.conv_block(64, 128)
-        self.encoder4 = self.conv_block(128, 256)
-        self.encoder5 = self.conv_block(256, 512)
+        for level in range(depth):
+            setattr(self, f'encoder{level + 1}', self.conv_block(in_channels if level == 0 else widths[level - 1], widths[level]))
 
         # bottleneck layer
-        self.bottleneck = self.conv_block(512, 1024)
+        self.bottleneck = self.conv_block(widths[depth - 1], widths[depth])
 
         # Decoder part of unet
-        self.upsampling5 = self.upsampling_block(1024, 512)
-        self.decoder5 = self.conv_block(1024, 512)
-        self.upsampling4 = self.upsampling_block(512, 256)
-        self.decoder4 = self.conv_block(512, 256)
-        self.upsampling3 = self.upsampling_block(256, 128)
-        self.decoder3 = self.conv_block(256, 128)
-        self.upsampling2 = self.upsampling_block(128, 64)
-        self.decoder2 = self.conv_block(128, 64)
-        self.upsampling1 = self.upsampling_block(64, 32)
-        self.decoder1 = self.conv_block(64, 32)
+        for level in reversed(range(depth)):
+            setattr(self, f'upsampling{level + 1}', self.upsampling_block(widths[level + 1], widths[level]))
+            setattr(self, f'decoder{level + 1}', self.conv_block(2 * widths[level], widths[level]))
 
+        self.pool = nn.MaxPool2d(2)
 
         # changing to desired number of channels
-        self.output = nn.Conv2d(32, out_channels, kernel_size=1)
+        self.output = nn.Conv2d(base_width, out_channels, kernel_size=1)
+
+        # Blocks recomputed in the backward pass, see 'enable_gradient_checkpointing'
+        self.checkpointed_blocks = set()
+
+    @classmethod
+    def from_architecture(cls, architecture=None, in_channels=1, out_channels=5):
+        """Builds the model from the 'Architecture' section of params.yaml (the default model if None)."""
+
+        architecture = architecture or dict()
+        return cls(in_channels, out_channels, base_width=architecture.get('Base_Width', 32),
+                   depth=architecture.get('Depth', 5), block_type=architecture.get('Block_Type', 'standard'))
+
+    @classmethod
+    def from_checkpoint(cls, checkpoint_path, map_location='cpu'):
+        """Loads a checkpoint, reading the architecture from the shapes of its weights.
+
+        Checkpoints therefore do not need to be paired with a configuration, and those saved
+        before the architecture was configurable load as the default model.
+        """
+
+        state_dict = torch.load(checkpoint_path, map_location=torch.device(map_location), weights_only=True)
+        return cls.from_state_dict(state_dict)
+
+    @classmethod
+    def from_state_dict(cls, state_dict, assign=False):
+        """Builds the model matching the shapes of 'state_dict' and loads it.
+
+        With 'assign' the model is built without allocating weights and its parameters are the
+        tensors of 'state_dict' themselves, not copies of them.
+        """
+
+        depth = sum(1 for key in state_dict if key.startswith('encoder') and key.endswith('.0.weight'))
+        # Separable blocks start with a depthwise convolution followed by a pointwise one (index 1)
+        block_type = 'separable' if 'encoder1.1.weight' in state_dict else 'standard'
+        first_conv = state_dict['encoder1.1.weight' if block_type == 'separable' else 'encoder1.0.weight']
+
+        with torch.device('meta' if assign else 'cpu'):
+            model = cls(first_conv.shape[1], state_dict['output.weight'].shape[0], base_width=first_conv.shape[0],
+                        depth=depth, block_type=block_type)
+        model.load_state_dict(state_dict, assign=assign)
+
+        return model
+
+    @classmethod
+    def from_shared_weights(cls, weights_path):
+        """Inference model whose weights are the read-only pages of a memory-mapped weights blob.
+
+        All the processes of a host loading the same blob share one copy of the weights, see
+        'shared_weights.export_checkpoint' for writing the blob.
+        """
+        from shared_weights import map_state_dict
+
+        model = cls.from_state_dict(map_state_dict(weights_path), assign=True)
+        model.requires_grad_(False)
+
+        return model.eval()
+
+    @classmethod
+    def load(cls, checkpoint_path, map_location='cpu', shared_weights_path=None):
+        """Loads a model for inference, from its shared weights when they are up to date.
+
+        The shared weights (the checkpoint path with a .npy extension by default) are used
+        when they exist, are not older than the checkpoint and the model stays on the CPU;
+        the checkpoint is read otherwise.
+        """
+
+        shared_weights_path = shared_weights_path or os.path.splitext(checkpoint_path)[0] + '.npy'
+        if (str(map_location) == 'cpu' and os.path.exists(shared_weights_path)
+                and (not os.path.exists(checkpoint_path) or os.path.getmtime(shared_weights_path) >= os.path.getmtime(checkpoint_path))):
+            return cls.from_shared_weights(shared_weights_path)
+
+        return cls.from_checkpoint(checkpoint_path, map_location=map_location)
+
+    def block_names(self):
+        return [f'encoder{level}' for level in range(1, self.depth + 1)] + ['bottleneck'] + \
+            [f'decoder{level}' for level in range(1, self.depth + 1)]
+
+    def enable_gradient_checkpointing(self, blocks='all'):
+        """Recomputes the activations of 'blocks' in the backward pass instead of storing them.
+
+        blocks: 'all', 'encoders' (with the bottleneck), 'decoders', a list of block names
+                ('encoder1', ..., 'bottleneck', 'decoder1', ...), or None to store everything
+
+        Only the input of every checkpointed block is kept (the pooled skip connection for an
+        encoder, the upsampled and skip tensors before their concatenation for a decoder), so
+        the peak training memory drops by roughly the size of the block intermediates at the
+        cost of one more forward pass through those blocks. Returns the model.
+        """
+
+        if blocks is None:
+            blocks = []
+        elif blocks == 'all':
+            blocks = self.block_names()
+        elif blocks == 'encoders':
+            blocks = [name for name in self.block_names() if not name.startswith('decoder')]
+        elif blocks == 'decoders':
+            blocks = [name for name in self.block_names() if name.startswith('decoder')]
+        elif isinstance(blocks, str):
+            raise ValueError(f"Unknown checkpointing preset '{blocks}', expected one of {self.checkpointing_presets} or a list of blocks.")
+
+        unknown = set(blocks) - set(self.block_names())
+        if unknown:
+            raise ValueError(f"Unknown blocks {sorted(unknown)}, expected some of {self.block_names()}.")
+
+        self.checkpointed_blocks = set(blocks)
+        return self
+
+    def run_block(self, name, function, *inputs):
+        """Applies 'function' (the block 'name' and what precedes it) to 'inputs', checkpointed if required."""
+
+        if name in self.checkpointed_blocks and self.training and torch.is_grad_enabled():
+            return checkpoint(function, *inputs, use_reentrant=False)
+
+        return function(*inputs)
 
     def conv_block(self, in_channels, out_channels):
+        if self.block_type == 'separable':
+            return nn.Sequential(
+                nn.Conv2d(in_channels, in_channels, kernel_size=3, padding=1, groups=in_channels),
+                nn.Conv2d(in_channels, out_channels, kernel_size=1),
+                nn.ReLU(),
+                nn.Conv2d(out_channels, out_channels, kernel_size=3, padding=1, groups=out_channels),
+                nn.Conv2d(out_channels, out_channels, kernel_size=1),
+                nn.ReLU()
+            )
+
         conv =  nn.Sequential(
             nn.Conv2d(in_channels, out_channels, kernel_size=3, padding=1),
             nn.ReLU(),
@@ -112,38 +254,23 @@ class UNET(nn.Module):
 
     def forward(self, input):
 
-        # Encoder part of unet
-        encoder1 = self.encoder1(input)
-        encoder2 = self.encoder2(nn.MaxPool2d(2)(encoder1))
-        encoder3 = self.encoder3(nn.MaxPool2d(2)(encoder2))
-        encoder4 = self.encoder4(nn.MaxPool2d(2)(encoder3))
-        encoder5 = self.encoder5(nn.MaxPool2d(2)(encoder4))
+        # Encoder part of unet (pooling inside the checkpointed function so that only the skip tensors are stored)
+        encoders = [self.run_block('encoder1', self.encoder1, input)]
+        for level in range(2, self.depth + 1):
+            encoder = getattr(self, f'encoder{level}')
+            encoders.append(self.run_block(f'encoder{level}', lambda x, encoder=encoder: encoder(self.pool(x)), encoders[-1]))
 
         # bottleneck layer
-        bottleneck = self.bottleneck(nn.MaxPool2d(2)(encoder5))
+        decoder = self.run_block('bottleneck', lambda x: self.bottleneck(self.pool(x)), encoders[-1])
 
         # decoder part of unet
-        decoder5 = self.upsampling5(bottleneck)
-        decoder5 = torch.cat((decoder5, encoder5), dim=1)
-        decoder5 = self.decoder5(decoder5)
-
-        decoder4 = self.upsampling4(decoder5)
-        decoder4 = torch.cat((decoder4, encoder4), dim=1)
-        decoder4 = self.decoder4(decoder4)
-
-        decoder3 = self.upsampling3(decoder4)
-        decoder3 = torch.cat((decoder3, encoder3), dim=1)
-        decoder3 = self.decoder3(decoder3)
+        for level in reversed(range(1, self.depth + 1)):
+            decoder = getattr(self, f'upsampling{level}')(decoder)
+            block = getattr(self, f'decoder{level}')
+            decoder = self.run_block(f'decoder{level}', lambda x, skip, block=block: block(torch.cat((x, skip), dim=1)),
+                                     decoder, encoders[level - 1])
 
-        decoder2 = self.upsampling2(decoder3)
-        decoder2 = torch.cat((decoder2, encoder2), dim=1)
-        decoder2 = self.decoder2(decoder2)
-
-        decoder1 = self.upsampling1(decoder2)
-        decoder1 = torch.cat((decoder1, encoder1), dim=1)
-        decoder1 = self.decoder1(decoder1)
-
-        output = self.output(decoder1)
+        output = self.output(decoder)
         return output
 
 # Custom Loss Function: MSE Loss weighted by energy of label spectrograms
@@ -177,7 +304,7 @@ class EnergyBasedLossFunction(nn.Module):
 # Training and Testing
 class TrainingTesting:
     # training
-    def train(self, dataloader, model, loss_fn, optimizer):
+    def train(self, dataloader, model, loss_fn, optimizer, device='cpu', verbose=True):
         size = len(dataloader.dataset)
         model.train()
         for batch, (X, y) in enumerate(dataloader):
@@ -192,12 +319,12 @@ class TrainingTesting:
             loss.backward()
             optimizer.step()
 
-            if batch % 5 == 0:
+            if verbose and batch % 5 == 0:
                 loss, current = loss.item(), batch * len(X)
                 print(f"loss: {loss:>7f}  [{current:>5d}/{size:>5d}]")
 
     # testing
-    def test(self, dataloader, model, loss_fn):
+    def test(self, dataloader, model, loss_fn, device='cpu'):
         size = len(dataloader.dataset)
         num_batches = len(dataloader)
 
@@ -225,6 +352,8 @@ class TrainingTesting:
         print(f"Avg MSE loss: {test_loss:>8f}")
 
 if __name__ == "__main__":
+    import argparse
+    from torchvision import transforms
 
     # SETTING UP THE LOGGING MECHANISM
     logger = logging.getLogger(__name__)
@@ -249,64 +378,109 @@ if __name__ == "__main__":
     device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
     # Type of data
-    data = 'train'
+    parser = argparse.ArgumentParser(description='Trains or evaluates the UNET source separation model.')
+    parser.add_argument('--data', default='train', choices=['train', 'validation', 'test'], help='Split to train or evaluate on')
+    parser.add_argument('--data-source', default='images', choices=['images', 'stem_cache'],
+                        help="'images': Final_Dataset spectrograms and masks, 'stem_cache': mixtures synthesized from the stem cache")
+    parser.add_argument('--separation-metrics', action='store_true',
+                        help='After training, score the separation quality (SI-SDR, SDR) of the model on the validation audio')
+    args = parser.parse_args()
+    data = args.data
+
+    # Hyperparameters
+    training_params = params['Training']
     
     # Paths and dimensions
-    input_dir = os.path.join('Final_Dataset', data, 'Input')
-    output_dir = os.path.join('Final_Dataset', data, 'Output')
+    input_dir = os.path.join(params['Data']['Final_Dataset'], data, 'Input')
+    output_dir = os.path.join(params['Data']['Final_Dataset'], data, 'Output')
     
     # Define transformations
     transform = transforms.Compose([
         transforms.ToTensor()
     ])
     
-    # Create dataset
-    dataset = UNetDataset(input_dir, output_dir, transform=transform)
+    if args.data_source == 'stem_cache':
+        from mixture_synthesis import StemCacheDataset, MixtureCollator
+
+        # New random mixtures at every epoch for training, plain mixtures of the cached songs otherwise
+        synthesis_params = params['Mixture_Synthesis']
+        if data == 'train':
+            dataset = StemCacheDataset(synthesis_params['Cache_Folder'], data=data, examples_per_epoch=synthesis_params['Examples_Per_Epoch'])
+            collator = MixtureCollator(gain_range_db=tuple(synthesis_params['Gain_Range_dB']),
+                                       stem_dropout=synthesis_params['Stem_Dropout'],
+                                       remix_probability=synthesis_params['Remix_Probability'])
+        else:
+            dataset = StemCacheDataset(synthesis_params['Cache_Folder'], data=data)
+            collator = MixtureCollator(gain_range_db=(0.0, 0.0), stem_dropout=0.0, remix_probability=0.0)
 
-    # DataLoader for batching and shuffling
-    dataloader = DataLoader(dataset, batch_size=10, shuffle=True)
+        dataloader = DataLoader(dataset, batch_size=training_params['Batch_Size'], shuffle=True, collate_fn=collator)
+
+    else:
+        # Create dataset
+        dataset = UNetDataset(input_dir, output_dir, transform=transform)
+
+        # DataLoader for batching and shuffling
+        dataloader = DataLoader(dataset, batch_size=training_params['Batch_Size'], shuffle=True)
 
     logger.info('Dataset loaded successfully.')
     
     # Initializing the model
     in_channels, out_channels = 1, 5
-    model = UNET(in_channels, out_channels).to(device)
+    model = UNET.from_architecture(params['Model']['Architecture'], in_channels, out_channels).to(device)
+    model.enable_gradient_checkpointing(training_params['Gradient_Checkpointing'])
 
     logger.info('Model Initialized.')
     
     # Loss and optimizer for training the model
-    optimizer = torch.optim.Adam(model.parameters(), lr=1e-3, betas=(0.9, 0.999), eps=1e-8, weight_decay=0.01)
+    optimizer = torch.optim.Adam(model.parameters(), lr=training_params['Learning_Rate'], betas=(0.9, 0.999), eps=1e-8, weight_decay=training_params['Weight_Decay'])
     loss_fn = EnergyBasedLossFunction() 
     
     # Epochs
-    epochs = 1
+    epochs = training_params['Epochs']
 
     # Train
     if data == 'train':
         for epoch in range(epochs):
             print(f"Epoch {epoch + 1}\n-------------------------")
             tt = TrainingTesting()
-            tt.train(dataloader, model, loss_fn, optimizer)
+            tt.train(dataloader, model, loss_fn, optimizer, device=device)
 
         # Saving the trained model
         if not os.path.exists('Models'):
             os.makedirs('Models')
         torch.save(model.state_dict(), os.path.join('Models', 'model_weights.pth'))
 
+        # Memory-mappable copy of the weights shared by the serving processes
+        from shared_weights import export_state_dict
+        export_state_dict(model.state_dict(), os.path.join('Models', params['Model']['Shared_Weights_Name']))
+
         logger.info('Model Trained Successfully')
 
+        if args.separation_metrics:
+            from separation_evaluation import SeparationEvaluator
+
+            evaluation_params = params['Evaluation']
+            metrics_folder_name = params['Model']['Metrics']['Metrics_Folder']
+            Utility().create_folder(metrics_folder_name)
+
+            evaluator = SeparationEvaluator(None, batch_size=evaluation_params['Batch_Size'])
+            metrics = evaluator.evaluate(os.path.join('Models', 'model_weights.pth'), data='validation', num_workers=evaluation_params['Num_Workers'])
+            evaluator.write_metrics(metrics, os.path.join(metrics_folder_name, params['Model']['Metrics']['Metrics_File']))
+
+            logger.info(f'Separation metrics on validation: {metrics}')
+
     # Validation
     elif data == 'validation':
         logger.info('Checking trained model performance on validation data.')
         tt = TrainingTesting()
-        tt.test(dataloader, model, loss_fn)
+        tt.test(dataloader, model, loss_fn, device=device)
         logger.info('Model performance checked on the validation data.')
 
     # Test
     elif data == 'test':
         logger.info('Making predictions using trained model on test data')
         tt = TrainingTesting()
-        tt.test(dataloader, model, loss_fn)
+        tt.test(dataloader, model, loss_fn, device=device)
         logger.info('Model performance checked on the test data')
 
 
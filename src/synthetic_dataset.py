@@ -0,0 +1,183 @@
+import os
+import uuid
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import yaml
+from step0_utility_functions import Utility
+
+logger = logging.getLogger(__name__)
+
+# Instrument classes of the Slakh2100 metadata besides the four main ones, with a MIDI program of each
+OTHER_CLASSES = {'Strings': 48, 'Organ': 16, 'Synth Pad': 88, 'Synth Lead': 80, 'Brass': 61,
+                 'Reed': 65, 'Pipe': 73, 'Chromatic Percussion': 11, 'Ensemble': 52}
+MAIN_CLASSES = {'Piano': 0, 'Guitar': 25, 'Bass': 33, 'Drums': 0}
+
+# Pitch range (MIDI notes) and note decay rate (1/s) of the synthesized stems of every class
+PITCH_RANGES = {'Bass': (28, 52), 'Guitar': (40, 76), 'Piano': (36, 96)}
+DECAY_RATES = {'Piano': 3.0, 'Guitar': 4.0, 'Bass': 2.0, 'Drums': 25.0}
+
+
+class SyntheticSlakhGenerator:
+    """Writes a Slakh2100-shaped dataset of synthesized audio, for load tests without the real data.
+
+    Layout of every split, as read by step1 and step2::
+
+        <output_folder>/<split>/TrackXXXXX/metadata.yaml
+        <output_folder>/<split>/TrackXXXXX/stems/S00.flac, S01.flac, ...
+        <output_folder>/<split>/TrackXXXXX/mix.flac
+
+    Stems are note sequences (decaying harmonic tones, noise bursts for the drums) with silent
+    sections, so that the instrument durations of step3 differ between tracks. Every track is
+    generated from its own seed, so a dataset can be generated in parallel and reproduced.
+    """
+
+    def __init__(self, output_folder='Slakh2100', sample_rate=44100, stems_per_track=(4, 10), duration=(60, 240),
+                 complete_fraction=0.8, seed=0):
+        self.output_folder = output_folder
+        self.sample_rate = sample_rate
+        self.stems_per_track = stems_per_track  # (min, max) number of stems of a track
+        self.duration = duration  # (min, max) duration of a track in seconds
+        self.complete_fraction = complete_fraction  # Fraction of tracks with all four main instruments
+        self.seed = seed
+
+    def track_instruments(self, rng):
+        """Instrument classes of the stems of a track; incomplete tracks lack one main instrument."""
+
+        num_stems = int(rng.integers(self.stems_per_track[0], self.stems_per_track[1] + 1))
+        main = list(MAIN_CLASSES)
+        if rng.random() >= self.complete_fraction:
+            main.remove(main[rng.integers(len(main))])
+
+        others = [str(instrument) for instrument in rng.choice(list(OTHER_CLASSES), size=max(0, num_stems - len(main)))]
+        return (main + others)[:max(num_stems, 1)]
+
+    def note_sequence(self, rng, num_samples, instrument):
+        """Synthesized stem: notes of 0.1 to 1 s played during random active sections."""
+
+        sample_rate = self.sample_rate
+        note_lengths = rng.integers(sample_rate // 10, sample_rate, size=num_samples // (sample_rate // 10) + 1)
+        note_starts = np.concatenate([[0], np.cumsum(note_lengths)])
+        note_starts = note_starts[note_starts < num_samples]
+        note_index = np.repeat(np.arange(len(note_starts)), np.diff(np.append(note_starts, num_samples)))
+        time_in_note = (np.arange(num_samples) - note_starts[note_index]) / sample_rate
+
+        envelope = np.exp(-DECAY_RATES.get(instrument, 1.5) * time_in_note, dtype=np.float32)
+
+        # Sections of 5 to 30 s where the instrument is playing or silent
+        section_lengths = rng.integers(5 * sample_rate, 30 * sample_rate, size=num_samples // (5 * sample_rate) + 1)
+        section_starts = np.concatenate([[0], np.cumsum(section_lengths)])
+        active = rng.random(len(section_starts)) < rng.uniform(0.4, 0.9)
+        envelope *= active[np.searchsorted(section_starts, np.arange(num_samples), side='right') - 1]
+
+        if instrument == 'Drums':
+            return (rng.standard_normal(num_samples).astype(np.float32) * envelope)
+
+        low, high = PITCH_RANGES.get(instrument, (48, 84))
+        pitches = rng.integers(low, high, size=len(note_starts))
+        frequencies = 440.0 * 2.0 ** ((pitches[note_index] - 69) / 12.0)
+        phase = np.cumsum(2 * np.pi * frequencies / sample_rate)
+
+        # Fundamental and two harmonics
+        tone = np.sin(phase) + 0.5 * np.sin(2 * phase) + 0.25 * np.sin(3 * phase)
+        return (tone.astype(np.float32) * envelope)
+
+    def metadata(self, rng, instruments):
+        stems = dict()
+        for index, instrument in enumerate(instruments):
+            program = MAIN_CLASSES.get(instrument, OTHER_CLASSES.get(instrument, 0))
+            stems[f'S{index:02d}'] = {'audio_rendered': True, 'inst_class': instrument,
+                                      'integrated_loudness': float(np.round(rng.uniform(-30, -15), 2)),
+                                      'is_drum': instrument == 'Drums', 'midi_program_name': instrument,
+                                      'plugin_name': f'synthetic_{instrument.lower().replace(" ", "_")}.nkm',
+                                      'program_num': program}
+
+        return {'UUID': uuid.UUID(bytes=rng.bytes(16)).hex, 'audio_dir': 'stems', 'normalized': True, 'stems': stems}
+
+    def generate_track(self, split, track_number):
+        """Writes one track and returns the number of bytes written."""
+        import soundfile as sf
+
+        rng = np.random.default_rng([self.seed, track_number])
+        track_folder = os.path.join(self.output_folder, split, f'Track{track_number:05d}')
+        os.makedirs(os.path.join(track_folder, 'stems'), exist_ok=True)
+
+        instruments = self.track_instruments(rng)
+        num_samples = int(rng.uniform(*self.duration) * self.sample_rate)
+
+        mix = np.zeros(num_samples, dtype=np.float32)
+        for index, instrument in enumerate(instruments):
+            stem = self.note_sequence(rng, num_samples, instrument)
+            stem *= 0.5 / (np.max(np.abs(stem)) + 1e-10)
+            mix += stem
+            sf.write(os.path.join(track_folder, 'stems', f'S{index:02d}.flac'), stem, self.sample_rate, subtype='PCM_16')
+
+        mix /= np.max(np.abs(mix)) + 1e-10
+        sf.write(os.path.join(track_folder, 'mix.flac'), mix, self.sample_rate, subtype='PCM_16')
+
+        with open(os.path.join(track_folder, 'metadata.yaml'), 'w') as yaml_file:
+            yaml.safe_dump(self.metadata(rng, instruments), yaml_file, sort_keys=True)
+
+        return sum(entry.stat().st_size for entry in os.scandir(os.path.join(track_folder, 'stems'))) + \
+            os.path.getsize(os.path.join(track_folder, 'mix.flac'))
+
+    def generate(self, num_tracks, splits={'train': 0.8, 'validation': 0.1, 'test': 0.1}, num_workers=1):
+        """Writes 'num_tracks' tracks numbered from 1, split in the given proportions.
+
+        Returns
+        --------
+        Dictionary mapping every split to its number of tracks
+        """
+
+        counts = {split: int(round(num_tracks * fraction)) for split, fraction in splits.items()}
+        # Rounding leftovers go to the first split
+        first_split = next(iter(splits))
+        counts[first_split] += num_tracks - sum(counts.values())
+
+        jobs, track_number = list(), 1
+        for split, count in counts.items():
+            jobs.extend((split, number) for number in range(track_number, track_number + count))
+            track_number += count
+
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            written = sum(executor.map(self.generate_track, [split for split, _ in jobs], [number for _, number in jobs], chunksize=4))
+
+        logger.info(f'{num_tracks} synthetic tracks ({written / 2**30:.2f} GB of audio) written to {self.output_folder}.')
+        return counts
+
+
+if __name__ == "__main__":
+
+    # SETTING UP THE LOGGING MECHANISM
+    logger.setLevel(logging.INFO)
+
+    Utility().create_folder('Logs')
+    params = Utility().read_params()
+
+    main_log_folderpath = params['Logs']['Logs_Folder']
+    data_restructuring_processing_logfile_path = params['Logs']['Data_Restructuring_Processing']
+
+    file_handler = logging.FileHandler(os.path.join(
+        main_log_folderpath, data_restructuring_processing_logfile_path))
+    formatter = logging.Formatter(
+        '%(asctime)s : %(levelname)s : %(filename)s : %(message)s')
+
+    file_handler.setFormatter(formatter)
+    logger.addHandler(file_handler)
+
+    # STARTING THE EXECUTION OF FUNCTIONS
+    parser = argparse.ArgumentParser(description='Writes a synthetic Slakh2100-shaped dataset.')
+    parser.add_argument('--tracks', type=int, default=100, help='Number of tracks over all the splits')
+    parser.add_argument('--output', default=params['Data']['RawDataFolder'], help='Dataset folder to write')
+    parser.add_argument('--stems', type=int, nargs=2, default=[4, 10], metavar=('MIN', 'MAX'), help='Stems per track')
+    parser.add_argument('--duration', type=float, nargs=2, default=[60, 240], metavar=('MIN', 'MAX'), help='Track duration in seconds')
+    parser.add_argument('--complete-fraction', type=float, default=0.8, help='Fraction of tracks with the four main instruments')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Number of worker processes')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    generator = SyntheticSlakhGenerator(args.output, stems_per_track=tuple(args.stems), duration=tuple(args.duration),
+                                        complete_fraction=args.complete_fraction, seed=args.seed)
+    counts = generator.generate(args.tracks, num_workers=args.workers)
+    logger.info(f'Tracks per split: {counts}')
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+class TemporalEmbedding:
+    """Per-instrument activity envelopes and their shift-tolerant matching.
+
+    The duration embedding keeps one number per instrument (how much of the track it plays).
+    The envelope embedding keeps *when* it plays: the RMS of every source over fixed frames
+    ('frame_rate' frames per second), scaled to the loudest frame of the track and stored as
+    float16, i.e. (instruments x frames) values per track (5 x 360 at 2 frames/s for 180 s).
+
+    Two tracks are compared with the cross-correlation of their envelopes, summed over the
+    selected instruments and maximized over the lags within 'max_shift_seconds', normalized
+    like a cosine similarity. The correlations of a query with a whole catalog block are
+    computed with one batched real FFT.
+    """
+
+    def __init__(self, frame_rate=2.0, sample_rate=10880, max_shift_seconds=10.0):
+        self.frame_rate = frame_rate
+        self.sample_rate = sample_rate
+        self.max_shift_seconds = max_shift_seconds
+
+    @property
+    def frame_length(self):
+        return int(round(self.sample_rate / self.frame_rate))
+
+    def envelopes(self, waveforms, num_frames=None):
+        """Computes the activity envelopes of a stack of waveforms.
+
+        Parameters
+        -----------
+
+        waveforms: (sources x samples) array at 'sample_rate'
+        num_frames: Number of frames to keep (padded with silence), all the frames if None
+
+        Returns
+        --------
+        float16 array of shape (sources x frames), every source scaled to its loudest frame
+        """
+
+        waveforms = np.asarray(waveforms, dtype=np.float32)
+        frame_length = self.frame_length
+        num_frames = num_frames or waveforms.shape[-1] // frame_length
+
+        frames = np.zeros((waveforms.shape[0], num_frames * frame_length), dtype=np.float32)
+        used = min(frames.shape[-1], waveforms.shape[-1])
+        frames[:, :used] = waveforms[:, :used]
+
+        rms = np.sqrt(np.mean(frames.reshape(waveforms.shape[0], num_frames, frame_length) ** 2, axis=-1))
+        peaks = rms.max(axis=-1, keepdims=True)
+        envelopes = np.divide(rms, peaks, out=np.zeros_like(rms), where=peaks > 0)
+
+        return envelopes.astype(np.float16)
+
+    def file_envelope(self, file_path, num_frames):
+        """Envelope of a single audio file (e.g. an instrument stem of the catalog)."""
+        import librosa
+
+        y, _ = librosa.load(file_path, sr=self.sample_rate, mono=True, duration=num_frames / self.frame_rate)
+        return self.envelopes(y[np.newaxis], num_frames=num_frames)[0]
+
+    def fft_length(self, num_frames):
+        """Smallest 2^a x 3^b length at least frames + maximum shift.
+
+        With that much zero padding, the circular correlation equals the linear one for all the
+        lags within the maximum shift (the lags beyond it, which would wrap around, are not used).
+        """
+
+        minimum = num_frames + self.max_shift(num_frames)
+        return min(2 ** a * 3 ** b for a in range(int(np.log2(minimum)) + 2) for b in range(3) if 2 ** a * 3 ** b >= minimum)
+
+    def max_shift(self, num_frames):
+        return min(int(round(self.max_shift_seconds * self.frame_rate)), num_frames - 1)
+
+    def catalog_spectra(self, db_envelopes, block_size=4096):
+        """Precomputes the FFT of every catalog envelope and the energy of every instrument.
+
+        The transform of the catalog is most of the cost of a query, and it does not depend on
+        the query, so a serving process computes it once and passes it to 'similarity'.
+
+        Returns
+        --------
+        (spectra, energies): complex64 (N_tracks x instruments x frequencies) and float32
+        (N_tracks x instruments) arrays
+        """
+
+        n_fft = self.fft_length(db_envelopes.shape[-1])
+        spectra = np.empty(db_envelopes.shape[:2] + (n_fft // 2 + 1,), dtype=np.complex64)
+        energies = np.empty(db_envelopes.shape[:2], dtype=np.float32)
+
+        for start in range(0, db_envelopes.shape[0], block_size):
+            block = np.asarray(db_envelopes[start:start + block_size], dtype=np.float32)
+            spectra[start:start + block.shape[0]] = np.fft.rfft(block, n=n_fft, axis=-1)
+            energies[start:start + block.shape[0]] = np.sum(block ** 2, axis=-1)
+
+        return spectra, energies
+
+    def similarity(self, query_envelopes, db_envelopes, preference_mask, catalog_spectra=None, block_size=4096):
+        """Shift-tolerant similarity of one query with every catalog track.
+
+        Parameters
+        -----------
+
+        query_envelopes: (instruments x frames) array
+        db_envelopes: (N_tracks x instruments x frames) array, may be memory-mapped
+        preference_mask: (instruments,) boolean array of the instruments to compare
+        catalog_spectra: Output of 'catalog_spectra' for 'db_envelopes', computed per block if None
+        block_size: Number of catalog tracks scored at once
+
+        Returns
+        --------
+        (N_tracks,) float32 array of similarities in [0, 1]
+        """
+
+        num_frames = db_envelopes.shape[-1]
+        max_shift = self.max_shift(num_frames)
+        n_fft = self.fft_length(num_frames)
+        # Lags 0..max_shift are at the start of the correlation, lags -max_shift..-1 at its end
+        lags = np.r_[0:max_shift + 1, n_fft - max_shift:n_fft]
+
+        mask = np.asarray(preference_mask, dtype=bool)
+        query = np.asarray(query_envelopes, dtype=np.float32)[mask]
+        query_spectrum = np.conj(np.fft.rfft(query, n=n_fft, axis=-1)).astype(np.complex64)
+        query_norm = np.linalg.norm(query)
+
+        similarities = np.zeros(db_envelopes.shape[0], dtype=np.float32)
+        for start in range(0, db_envelopes.shape[0], block_size):
+            stop = min(start + block_size, db_envelopes.shape[0])
+            if catalog_spectra is None:
+                spectra, energies = self.catalog_spectra(db_envelopes[start:stop], block_size=block_size)
+            else:
+                spectra, energies = catalog_spectra[0][start:stop], catalog_spectra[1][start:stop]
+
+            # Correlations summed over the instruments in the frequency domain: one inverse FFT per track
+            cross_spectrum = np.einsum('bif,if->bf', spectra[:, mask], query_spectrum)
+            correlations = np.fft.irfft(cross_spectrum, n=n_fft, axis=-1)[:, lags]
+
+            denominators = query_norm * np.sqrt(energies[:, mask].sum(axis=1))
+            np.divide(correlations.max(axis=1), denominators, out=similarities[start:stop], where=denominators > 0)
+
+        return similarities